@@ -0,0 +1,98 @@
+"""
+Embedding Backend Benchmark: PyTorch vs ONNX Runtime
+
+Embeds the chunk texts of a synthetic dataset with the PyTorch
+sentence-transformer (HuggingFaceEmbeddings) and with the ONNX export used by
+`--embedding-backend onnx`, fp32 and int8, then reports throughput for each and
+the cosine similarity between every ONNX vector and its PyTorch counterpart.
+Exits non-zero when the mean or minimum similarity is below the thresholds.
+
+Needs torch, sentence-transformers, onnxruntime and tokenizers. Without
+--onnx-model the model is exported (and quantized) into a temporary directory.
+
+Usage:
+    python benchmarks/bench_embeddings.py --texts 2000
+    python benchmarks/bench_embeddings.py --onnx-model models/minilm-onnx --threads 4
+"""
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+current_dir = os.path.dirname(os.path.abspath(__file__))  # /benchmarks
+parent_dir = os.path.dirname(current_dir)  # Project root
+sys.path.append(parent_dir)
+sys.path.append(current_dir)
+
+import numpy as np
+import ragpsy
+from synthetic_data import generate_dataset
+
+def chunk_texts(count, seed):
+    """Chunk texts exactly as the index would embed them"""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        generate_dataset(tmp_dir, max(count // 2, 1), seed=seed)
+        documents = ragpsy.create_student_documents(ragpsy.load_data(tmp_dir))
+    texts, _ = ragpsy.split_student_documents(documents)
+    return texts[:count]
+
+def throughput(embeddings, texts):
+    """Embed texts once to warm up, then time a full pass; returns (vectors, texts per second)"""
+    embeddings.embed_documents(texts[:32])
+    t0 = time.perf_counter()
+    vectors = np.asarray(embeddings.embed_documents(texts), dtype=np.float32)
+    return vectors, len(texts) / (time.perf_counter() - t0)
+
+def cosine_parity(reference, candidate):
+    """Row-wise cosine similarity between two embeddings of the same texts"""
+    reference = reference / np.linalg.norm(reference, axis=1, keepdims=True)
+    candidate = candidate / np.linalg.norm(candidate, axis=1, keepdims=True)
+    similarity = (reference * candidate).sum(axis=1)
+    return {
+        "mean": round(float(similarity.mean()), 5),
+        "p1": round(float(np.percentile(similarity, 1)), 5),
+        "min": round(float(similarity.min()), 5)
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the PyTorch and ONNX embedding backends")
+    parser.add_argument('--texts', type=int, default=2000)
+    parser.add_argument('--onnx-model', help="Existing export directory (default: export to a temp dir)")
+    parser.add_argument('--threads', type=int, default=0, help="onnxruntime intra-op threads (0: default)")
+    parser.add_argument('--batch-size', type=int, default=64)
+    parser.add_argument('--min-mean-cosine', type=float, default=0.99)
+    parser.add_argument('--min-cosine', type=float, default=0.95)
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    texts = chunk_texts(args.texts, args.seed)
+    reference, torch_rate = throughput(ragpsy.create_embeddings("torch"), texts)
+    results = {"texts": len(texts), "torch": {"texts_per_s": round(torch_rate, 1)}}
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        model_dir = args.onnx_model or ragpsy.export_onnx_model(os.path.join(tmp_dir, "onnx"))
+        failures = []
+        for name, quantized in (("onnx_fp32", False), ("onnx_int8", True)):
+            embeddings = ragpsy.OnnxEmbeddings(model_dir, quantized=quantized, batch_size=args.batch_size,
+                                               threads=args.threads)
+            if quantized and not embeddings.quantized:
+                continue
+            vectors, rate = throughput(embeddings, texts)
+            parity = cosine_parity(reference, vectors)
+            results[name] = {
+                "texts_per_s": round(rate, 1),
+                "speedup": round(rate / torch_rate, 2),
+                "cosine_to_torch": parity
+            }
+            if parity["mean"] < args.min_mean_cosine or parity["min"] < args.min_cosine:
+                failures.append(name)
+
+    results["parity_failures"] = failures
+    print(json.dumps(results, indent=2))
+    return 1 if failures else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
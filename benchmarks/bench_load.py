@@ -0,0 +1,89 @@
+"""
+Dataset Load Benchmark for the Psychology Course RAG System
+
+Times ragpsy.load_data on a synthetic dataset when it has to parse and merge
+the CSV files (cold) and when it reads the typed Parquet cache written by the
+first load (warm), with and without column projection, and reports the
+in-memory size of the resulting DataFrame.
+
+Usage:
+    python benchmarks/bench_load.py --students 100000
+"""
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+current_dir = os.path.dirname(os.path.abspath(__file__))  # /benchmarks
+parent_dir = os.path.dirname(current_dir)  # Project root
+sys.path.append(parent_dir)
+sys.path.append(current_dir)
+
+import pandas as pd
+import ragpsy
+from synthetic_data import generate_dataset
+
+PLOT_COLUMNS = ['gender', 'international_student', 'final_exam', 'study_hours_per_week', 'attendance_rate']
+
+def timed_load(data_dir, columns=None, repeats=3):
+    """Best wall time of load_data in seconds and the DataFrame it returned"""
+    best, df = None, None
+    for _ in range(repeats):
+        t0 = time.perf_counter()
+        df = ragpsy.load_data(data_dir, columns=columns)
+        elapsed = time.perf_counter() - t0
+        best = elapsed if best is None else min(best, elapsed)
+    return best, df
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare CSV and Parquet dataset loads")
+    parser.add_argument('--students', type=int, default=100_000)
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        data_dir = os.path.join(tmp_dir, "data")
+        generate_dataset(data_dir, args.students, seed=args.seed)
+        ragpsy.DATASET_CACHE_SETTINGS["dir"] = os.path.join(tmp_dir, "cache")
+
+        # The untyped frame the loader used to return, for the memory comparison
+        t0 = time.perf_counter()
+        raw = pd.merge(
+            pd.read_csv(os.path.join(data_dir, 'psych101-quantitative.csv'))[ragpsy.QUANT_COLUMNS],
+            pd.read_csv(os.path.join(data_dir, 'psych101-qualitative.csv'))[ragpsy.QUAL_COLUMNS],
+            on='student_id'
+        )
+        csv_s = time.perf_counter() - t0
+
+        t0 = time.perf_counter()
+        typed = ragpsy.load_data(data_dir)
+        cold_s = time.perf_counter() - t0
+        warm_s, _ = timed_load(data_dir)
+        projected_s, projected = timed_load(data_dir, columns=PLOT_COLUMNS)
+
+        cache_path = ragpsy._dataset_cache_path(data_dir)
+        results = {
+            "students": args.students,
+            "csv_bytes": sum(os.path.getsize(os.path.join(data_dir, name)) for name in os.listdir(data_dir)
+                             if name.endswith(".csv")),
+            "parquet_bytes": os.path.getsize(cache_path),
+            "seconds": {
+                "csv_untyped": round(csv_s, 4),
+                "csv_typed_and_cache_write": round(cold_s, 4),
+                "parquet": round(warm_s, 4),
+                "parquet_plot_columns": round(projected_s, 4)
+            },
+            "dataframe_bytes": {
+                "csv_untyped": int(raw.memory_usage(deep=True).sum()),
+                "typed": int(typed.memory_usage(deep=True).sum()),
+                "plot_columns": int(projected.memory_usage(deep=True).sum())
+            }
+        }
+
+    print(json.dumps(results, indent=2))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+"""
+Vectorstore Memory Benchmark for the Psychology Course RAG System
+
+Builds the index for a synthetic dataset twice - once with the per-chunk
+Document docstore of FAISS.from_texts and once with ragpsy.build_vectorstore's
+columnar docstore - and reports the Python heap bytes per chunk that each
+keeps alive, measured with tracemalloc.
+
+Usage:
+    python benchmarks/bench_memory.py --students 20000
+"""
+
+import argparse
+import gc
+import json
+import os
+import sys
+import tempfile
+import tracemalloc
+
+current_dir = os.path.dirname(os.path.abspath(__file__))  # /benchmarks
+parent_dir = os.path.dirname(current_dir)  # Project root
+sys.path.append(parent_dir)
+sys.path.append(current_dir)
+
+import numpy as np
+import ragpsy
+from langchain_community.vectorstores import FAISS
+from fakes import HashingEmbeddings
+from synthetic_data import generate_dataset
+
+class PrecomputedEmbeddings(HashingEmbeddings):
+    """Returns vectors computed up front, so only the store itself is measured"""
+    def __init__(self, vectors):
+        super().__init__(size=vectors.shape[1])
+        self.vectors = vectors
+        self.position = 0
+
+    def embed_documents(self, texts):
+        batch = self.vectors[self.position:self.position + len(texts)]
+        self.position += len(texts)
+        return batch
+
+def measure(build):
+    """Heap bytes still held by the object returned from build()"""
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    store = build()
+    gc.collect()
+    retained = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    return store, retained
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare docstore memory per chunk")
+    parser.add_argument('--students', type=int, default=20_000)
+    parser.add_argument('--embedding-dim', type=int, default=384)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        generate_dataset(tmp_dir, args.students)
+        documents = ragpsy.create_student_documents(ragpsy.load_data(tmp_dir))
+    texts, metadatas = ragpsy.split_student_documents(documents)
+    del documents
+    vectors = np.asarray(HashingEmbeddings(args.embedding_dim).embed_documents(texts), dtype=np.float32)
+    index_bytes = vectors.nbytes
+
+    def legacy():
+        embeddings = PrecomputedEmbeddings(vectors)
+        return FAISS.from_embeddings(list(zip(texts, vectors.tolist())), embeddings, metadatas=metadatas)
+
+    def columnar():
+        return ragpsy.build_vectorstore(texts, metadatas, PrecomputedEmbeddings(vectors))
+
+    # The legacy Documents reuse the caller's text strings while the columnar store
+    # copies them into its buffer, so the columnar figure includes the chunk text
+    results = {"students": args.students, "chunks": len(texts)}
+    for name, build in (("per_chunk_documents", legacy), ("columnar", columnar)):
+        store, retained = measure(build)
+        # FAISS keeps the vectors in C++ memory that tracemalloc does not see
+        results[name] = {
+            "heap_bytes_per_chunk": round(retained / len(texts), 1),
+            "index_bytes_per_chunk": round(index_bytes / len(texts), 1)
+        }
+        del store
+
+    print(json.dumps(results, indent=2))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,172 @@
+"""
+Ingest and Query Benchmark for the Psychology Course RAG System
+
+Generates (or reuses) a synthetic dataset, then times every ingest stage
+(load_data, create_student_documents, chunking, embedding, index build) and
+measures query_rag latency and throughput with an offline embedder and LLM.
+Results are written as JSON so they can be compared between commits.
+
+Usage:
+    python benchmarks/bench_pipeline.py --students 10000 --output bench_results.json
+    python benchmarks/bench_pipeline.py --data-dir /tmp/psych-1m --queries 200 --concurrency 8
+"""
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+current_dir = os.path.dirname(os.path.abspath(__file__))  # /benchmarks
+parent_dir = os.path.dirname(current_dir)  # Project root
+sys.path.append(parent_dir)
+sys.path.append(current_dir)
+
+import ragpsy
+from langchain_community.vectorstores import FAISS
+from fakes import HashingEmbeddings, make_fake_llm
+from synthetic_data import generate_dataset
+
+BENCH_QUESTIONS = [
+    ("How do international students perform in exams?", {"international_student": "Yes"}),
+    ("What challenges do first-generation students mention?", {"first_gen_student": "Yes"}),
+    ("What's the relationship between study hours and final exam scores?", None),
+    ("How do female students describe the course?", {"gender": "Female"}),
+    ("Compare male and female student performance", None),
+    ("What do students say about office hours?", None),
+]
+
+def _timed(results, stage, fn, *args, **kwargs):
+    """Run fn and store its wall time in seconds under results[stage]"""
+    t0 = time.perf_counter()
+    value = fn(*args, **kwargs)
+    results[stage] = round(time.perf_counter() - t0, 4)
+    return value
+
+def _git_commit():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "HEAD"], cwd=parent_dir, stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except Exception:
+        return None
+
+def _latency_summary(latencies_ms):
+    ordered = sorted(latencies_ms)
+    return {
+        "count": len(ordered),
+        "mean_ms": round(sum(ordered) / len(ordered), 3) if ordered else 0.0,
+        "p50_ms": ragpsy._percentile(ordered, 50),
+        "p95_ms": ragpsy._percentile(ordered, 95),
+        "p99_ms": ragpsy._percentile(ordered, 99)
+    }
+
+def run_ingest_benchmark(data_dir, embeddings):
+    """Time each ingest stage and return the built vectorstore with the stage timings"""
+    seconds = {}
+    df = _timed(seconds, "load_data", ragpsy.load_data, data_dir)
+    documents = _timed(seconds, "create_student_documents", ragpsy.create_student_documents, df)
+    texts, metadatas = _timed(seconds, "chunking", ragpsy.split_student_documents, documents)
+    vectors = _timed(seconds, "embedding", embeddings.embed_documents, texts)
+    vectorstore = _timed(
+        seconds, "index_build", FAISS.from_embeddings,
+        list(zip(texts, vectors)), embeddings, metadatas=metadatas
+    )
+
+    ingest = {
+        "students": len(df),
+        "chunks": len(texts),
+        "seconds": seconds,
+        "students_per_s": round(len(df) / max(sum(seconds.values()), 1e-9), 1),
+        "chunks_embedded_per_s": round(len(texts) / max(seconds["embedding"], 1e-9), 1)
+    }
+    return vectorstore, ingest
+
+def run_query_benchmark(vectorstore, llm, queries, concurrency):
+    """Run query_rag repeatedly and report latency percentiles, QPS and per-stage timings"""
+    ragpsy.METRICS.reset()
+    workload = [BENCH_QUESTIONS[i % len(BENCH_QUESTIONS)] for i in range(queries)]
+
+    def run_one(item):
+        question, filter_metadata = item
+        t0 = time.perf_counter()
+        ragpsy.query_rag(vectorstore, llm, question, filter_metadata)
+        return (time.perf_counter() - t0) * 1000
+
+    t0 = time.perf_counter()
+    if concurrency > 1:
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            latencies = list(pool.map(run_one, workload))
+    else:
+        latencies = [run_one(item) for item in workload]
+    elapsed = time.perf_counter() - t0
+
+    snapshot = ragpsy.METRICS.snapshot()
+    return {
+        "queries": queries,
+        "concurrency": concurrency,
+        "qps": round(queries / max(elapsed, 1e-9), 2),
+        "latency": _latency_summary(latencies),
+        "stages": {
+            name[len("query_rag."):]: summary
+            for name, summary in snapshot["histograms"].items()
+            if name.startswith("query_rag.")
+        },
+        "counters": snapshot["counters"]
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark ragpsy ingest and query throughput")
+    parser.add_argument('--students', type=int, default=10_000, help="Synthetic students to generate")
+    parser.add_argument('--data-dir', help="Use an existing dataset instead of generating one")
+    parser.add_argument('--queries', type=int, default=100, help="Number of query_rag calls")
+    parser.add_argument('--concurrency', type=int, default=1, help="Concurrent query_rag callers")
+    parser.add_argument('--llm-latency-ms', type=float, default=0, help="Simulated LLM latency")
+    parser.add_argument('--embedding-dim', type=int, default=384)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--output', help="Write JSON results here (default: stdout)")
+    args = parser.parse_args()
+
+    # Coalescing would hide repeated questions; measure every call
+    ragpsy.LLM_CALL_SETTINGS["coalesce"] = False
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        data_dir = args.data_dir
+        generated = {}
+        if data_dir is None:
+            data_dir = os.path.join(tmp_dir, "data")
+            _timed(generated, "generate_data", generate_dataset, data_dir, args.students, seed=args.seed)
+
+        embeddings = HashingEmbeddings(size=args.embedding_dim)
+        vectorstore, ingest = run_ingest_benchmark(data_dir, embeddings)
+        ingest["seconds"].update(generated)
+
+        llm = make_fake_llm(latency_ms=args.llm_latency_ms)
+        query = run_query_benchmark(vectorstore, llm, args.queries, args.concurrency)
+
+    results = {
+        "benchmark": "ragpsy_pipeline",
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "git_commit": _git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "config": vars(args),
+        "ingest": ingest,
+        "query": query
+    }
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + "\n")
+        print(f"Wrote benchmark results to {args.output}")
+    else:
+        print(output)
+
+if __name__ == "__main__":
+    main()
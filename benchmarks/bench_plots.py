@@ -0,0 +1,102 @@
+"""
+Plot Benchmark for the Psychology Course RAG System
+
+Times the visualization example on a synthetic dataset: computing the binned
+aggregates from the CSV files (cold), loading them from the plot cache (warm)
+and rendering the three figures from them. With --raw it also times the
+row-level seaborn scatter and box plots the example used to draw, on the same
+students.
+
+Usage:
+    python benchmarks/bench_plots.py --students 1000000
+    python benchmarks/bench_plots.py --students 100000 --raw
+"""
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+current_dir = os.path.dirname(os.path.abspath(__file__))  # /benchmarks
+parent_dir = os.path.dirname(current_dir)  # Project root
+sys.path.append(parent_dir)
+sys.path.append(current_dir)
+sys.path.append(os.path.join(parent_dir, 'examples', 'scripts'))
+
+import matplotlib
+matplotlib.use("Agg")
+import matplotlib.pyplot as plt
+import ragpsy
+import visualization_example
+from synthetic_data import generate_dataset
+
+PLOTS = [
+    visualization_example.plot_grade_distribution,
+    visualization_example.plot_study_hours,
+    visualization_example.plot_attendance
+]
+
+def render(aggregates, out_dir):
+    """Seconds to draw and save every figure from the aggregates"""
+    t0 = time.perf_counter()
+    for plot in PLOTS:
+        plot(aggregates, os.path.join(out_dir, f"{plot.__name__}.png"))
+    return time.perf_counter() - t0
+
+def render_raw(df, out_dir):
+    """Seconds to draw the row-level seaborn plots the example used before aggregation"""
+    import seaborn as sns
+
+    t0 = time.perf_counter()
+    fig, ax = plt.subplots(figsize=(10, 6))
+    sns.scatterplot(data=df, x='study_hours_per_week', y='final_exam', hue='gender',
+                    style='international_student', ax=ax)
+    fig.savefig(os.path.join(out_dir, "raw_scatter.png"))
+    plt.close(fig)
+    fig, ax = plt.subplots(figsize=(12, 5))
+    sns.boxplot(data=df, x='attendance_rate', y='final_exam', ax=ax)
+    fig.savefig(os.path.join(out_dir, "raw_box.png"))
+    plt.close(fig)
+    return time.perf_counter() - t0
+
+def main():
+    parser = argparse.ArgumentParser(description="Time aggregated plot rendering")
+    parser.add_argument('--students', type=int, default=1_000_000)
+    parser.add_argument('--raw', action='store_true', help="Also time the row-level seaborn plots")
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        data_dir = os.path.join(tmp_dir, "data")
+        generate_dataset(data_dir, args.students, seed=args.seed)
+        ragpsy.DATASET_CACHE_SETTINGS["dir"] = os.path.join(tmp_dir, "cache")
+
+        t0 = time.perf_counter()
+        aggregates = ragpsy.load_plot_aggregates(data_dir)
+        cold_s = time.perf_counter() - t0
+        t0 = time.perf_counter()
+        aggregates = ragpsy.load_plot_aggregates(data_dir)
+        warm_s = time.perf_counter() - t0
+        render(aggregates, tmp_dir)  # matplotlib warm-up
+        render_s = render(aggregates, tmp_dir)
+
+        results = {
+            "students": args.students,
+            "aggregate_bytes": os.path.getsize(ragpsy._dataset_cache_path(data_dir, "plot_aggregates", "npz")),
+            "seconds": {
+                "aggregate_from_csv": round(cold_s, 4),
+                "aggregate_from_cache": round(warm_s, 4),
+                "render": round(render_s, 4),
+                "regenerate": round(warm_s + render_s, 4)
+            }
+        }
+        if args.raw:
+            df = ragpsy.load_data(data_dir, columns=ragpsy.PLOT_COLUMNS)
+            results["seconds"]["render_raw_rows"] = round(render_raw(df, tmp_dir), 4)
+
+    print(json.dumps(results, indent=2))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+"""
+Prompt Prefix Cache Benchmark for the Psychology Course RAG System
+
+Answers a mix of question shapes with query_rag against a fake chat model that
+simulates a serving stack's prompt prefix cache, where only uncached prompt
+tokens add prefill time before the first token. It runs the mix twice with a
+cold cache each time. The first run uses the registry layout (static prefix
+first). The second renders the same prompts with their per-call fields first,
+as the old templates did. For each layout it reports prompt tokens, the share
+served from the prefix cache and time to first token.
+
+Usage:
+    python benchmarks/bench_prompt_cache.py --queries 300
+    python benchmarks/bench_prompt_cache.py --students 20000 --prefill-ms-per-token 0.2
+"""
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+
+current_dir = os.path.dirname(os.path.abspath(__file__))  # /benchmarks
+parent_dir = os.path.dirname(current_dir)  # Project root
+sys.path.append(parent_dir)
+sys.path.append(current_dir)
+
+import numpy as np
+import ragpsy
+from fakes import HashingEmbeddings, make_fake_llm
+from synthetic_data import generate_dataset
+
+QUESTION_TEMPLATES = [
+    ("How do students who study more than {n} hours per week do on the final?", None),
+    ("What do students with attendance below {n}% say about the course?", {"gender": "Female"}),
+    ("How do international students rate lecture {n}?", {"international_student": "Yes"}),
+    ("Compare male and female student performance in week {n}", None),
+    ("What common themes appear in course reviews?", None),
+]
+
+class DynamicFirstRegistry(ragpsy.PromptRegistry):
+    """The registry's prompts with the per-call fields sent before the instructions"""
+    def parts(self, name, **values):
+        prefix, dynamic = super().parts(name, **values)
+        return "", dynamic + "\n\n" + prefix
+
+def dynamic_first(registry):
+    legacy = DynamicFirstRegistry(registry.preamble)
+    legacy._prompts = registry._prompts
+    return legacy
+
+def run_layout(vectorstore, questions, prefill_ms_per_token):
+    """Answer every question with a cold prefix cache; returns token and first-token stats"""
+    llm = make_fake_llm(prefix_cache=True, prefill_ms_per_token=prefill_ms_per_token)
+    prompt_tokens, cached_tokens, first_token_ms = 0, 0, []
+    for question, filter_metadata in questions:
+        trace = ragpsy.QueryTrace()
+        ragpsy.query_rag(vectorstore, llm, question, filter_metadata, trace=trace)
+        prompt_tokens += trace.counters.get("prompt_tokens", 0)
+        cached_tokens += trace.counters.get("prompt_cached_tokens", 0)
+        first_token_ms += [span["ms"] for span in trace.spans if span["stage"] == "llm_first_token"]
+    ordered = sorted(first_token_ms)
+    return {
+        "prompt_tokens": prompt_tokens,
+        "cached_tokens": cached_tokens,
+        "cached_ratio": round(cached_tokens / prompt_tokens, 3) if prompt_tokens else 0.0,
+        "first_token_p50_ms": round(ragpsy._percentile(ordered, 50), 2),
+        "first_token_p95_ms": round(ragpsy._percentile(ordered, 95), 2)
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure prompt prefix reuse across query shapes")
+    parser.add_argument('--students', type=int, default=5_000)
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--prefill-ms-per-token', type=float, default=0.1,
+                        help="Simulated prefill cost of each uncached prompt token")
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    # Responses must come from the fake model, not LangChain's response cache
+    ragpsy.LLM_CALL_SETTINGS["stream"] = True
+    ragpsy.LLM_CACHE_SETTINGS["max_entries"] = 0
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        generate_dataset(tmp_dir, args.students, seed=args.seed)
+        vectorstore, _, _ = ragpsy.setup_rag(tmp_dir, embeddings=HashingEmbeddings(), llm=make_fake_llm())
+    if vectorstore is None:
+        print("setup_rag failed", file=sys.stderr)
+        return 1
+
+    rng = np.random.default_rng(args.seed)
+    questions = []
+    for _ in range(args.queries):
+        template, filter_metadata = QUESTION_TEMPLATES[rng.integers(len(QUESTION_TEMPLATES))]
+        questions.append((template.format(n=int(rng.integers(1, 1000))), filter_metadata))
+
+    registry = ragpsy.PROMPTS
+    results = {
+        "queries": len(questions),
+        "static_prefix_words": {name: len(registry.prefix(name).split()) for name in registry._prompts}
+    }
+    try:
+        results["static_first"] = run_layout(vectorstore, questions, args.prefill_ms_per_token)
+        ragpsy.PROMPTS = dynamic_first(registry)
+        results["dynamic_first"] = run_layout(vectorstore, questions, args.prefill_ms_per_token)
+    finally:
+        ragpsy.PROMPTS = registry
+    print(json.dumps(results, indent=2))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
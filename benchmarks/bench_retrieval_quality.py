@@ -0,0 +1,160 @@
+"""
+Retrieval Quality Benchmark: Character Chunks vs Field Vectors
+
+Indexes a synthetic dataset in both indexing modes ("chunks" splits the whole
+student document, "fields" embeds course_review and learning_outcomes_assessment
+separately) and compares ingest cost and retrieval quality.
+
+Synthetic reviews are built from a fixed pool of sentences, so two sentences
+taken from one student's text form a query whose relevant students are the
+ones whose review or assessment contains both. Quality is reported per
+student: precision@k over the first k distinct students returned, how many
+distinct students the raw top-k results contain and how many context characters
+each of them costs. Chunk retrieval is measured with and without the
+per-student MMR diversification. The adaptive section compares
+retrieve_adaptive with a fixed k on the chunk index: results kept, recall and
+precision over them, prompt context per query and why retrieval stopped,
+separately for narrow queries (at most k relevant students) and broad ones.
+
+Usage:
+    python benchmarks/bench_retrieval_quality.py --students 5000 --queries 50
+"""
+
+import argparse
+import json
+import os
+import re
+import sys
+import tempfile
+import time
+
+current_dir = os.path.dirname(os.path.abspath(__file__))  # /benchmarks
+parent_dir = os.path.dirname(current_dir)  # Project root
+sys.path.append(parent_dir)
+sys.path.append(current_dir)
+
+import numpy as np
+import ragpsy
+from fakes import HashingEmbeddings
+from synthetic_data import generate_dataset
+
+def build_queries(df, count, seed, count_per_query=2):
+    """Use sentences of a random student's text as a query; relevant students contain all of them"""
+    rng = np.random.default_rng(seed)
+    texts = (df['course_review'].fillna('') + ' ' + df['learning_outcomes_assessment'].fillna('')).tolist()
+    ids = df['student_id'].tolist()
+
+    queries = []
+    for row in rng.choice(len(texts), size=min(count, len(texts)), replace=False):
+        sentences = [s.strip() for s in re.split(r'(?<=[.!?])\s+', texts[row]) if s.strip()]
+        if len(sentences) < count_per_query:
+            continue
+        picked = [sentences[i] for i in sorted(rng.choice(len(sentences), size=count_per_query, replace=False))]
+        relevant = {student_id for student_id, text in zip(ids, texts) if all(p in text for p in picked)}
+        queries.append((" ".join(picked), relevant))
+    return queries
+
+def evaluate(vectorstore, queries, k):
+    """Precision@k over distinct students and distinct students in the raw top-k"""
+    precisions, distinct, chars, latencies = [], [], [], []
+    for question, relevant in queries:
+        t0 = time.perf_counter()
+        raw = ragpsy.retrieve_documents(vectorstore, question, k)
+        latencies.append((time.perf_counter() - t0) * 1000)
+        distinct.append(len({doc.metadata['student_id'] for doc in raw}))
+        chars.append(sum(len(doc.page_content) for doc in raw) / max(distinct[-1], 1))
+
+        # Chunk results can repeat a student, so look further for k distinct students
+        students = []
+        for doc in ragpsy.retrieve_documents(vectorstore, question, k * 4):
+            if doc.metadata['student_id'] not in students:
+                students.append(doc.metadata['student_id'])
+        students = students[:k]
+        precisions.append(sum(s in relevant for s in students) / k)
+
+    return {
+        "precision_at_k": round(float(np.mean(precisions)), 4),
+        "distinct_students_in_top_k": round(float(np.mean(distinct)), 2),
+        "context_chars_per_student": round(float(np.mean(chars)), 1),
+        "mean_retrieval_ms": round(float(np.mean(latencies)), 3)
+    }
+
+def evaluate_adaptive(vectorstore, queries, k):
+    """Fixed k against adaptive k: results, recall and precision of relevant students, context size"""
+    def summarize(runs):
+        return {
+            "mean_results": round(float(np.mean([len(docs) for docs, _, _ in runs])), 2),
+            "recall": round(float(np.mean([len(found & relevant) / len(relevant)
+                                           for _, found, relevant in runs])), 4),
+            "precision": round(float(np.mean([len(found & relevant) / max(len(docs), 1)
+                                              for docs, found, relevant in runs])), 4),
+            "context_chars_per_query": round(float(np.mean([sum(len(doc.page_content) for doc in docs)
+                                                            for docs, _, _ in runs])), 1)
+        }
+
+    results = {}
+    for question, relevant in queries:
+        # Narrow queries have at most k relevant students, broad ones more
+        group = results.setdefault("narrow" if len(relevant) <= k else "broad",
+                                   {"fixed": [], "adaptive": [], "reasons": {}, "latencies": []})
+        docs = ragpsy.retrieve_documents(vectorstore, question, k)
+        group["fixed"].append((docs, {doc.metadata['student_id'] for doc in docs}, relevant))
+
+        trace = ragpsy.QueryTrace("retrieve_adaptive")
+        t0 = time.perf_counter()
+        docs = ragpsy.retrieve_adaptive(vectorstore, question, k, trace=trace)
+        group["latencies"].append((time.perf_counter() - t0) * 1000)
+        group["adaptive"].append((docs, {doc.metadata['student_id'] for doc in docs}, relevant))
+        reason = trace.attributes["adaptive_k"]["reason"]
+        group["reasons"][reason] = group["reasons"].get(reason, 0) + 1
+
+    return {
+        name: {
+            "queries": len(group["fixed"]),
+            "fixed_k": summarize(group["fixed"]),
+            "adaptive_k": {**summarize(group["adaptive"]),
+                           "mean_retrieval_ms": round(float(np.mean(group["latencies"])), 3),
+                           "stop_reasons": group["reasons"]}
+        }
+        for name, group in sorted(results.items())
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare retrieval quality of the indexing modes")
+    parser.add_argument('--students', type=int, default=5_000)
+    parser.add_argument('--queries', type=int, default=50)
+    parser.add_argument('--k', type=int, default=3)
+    parser.add_argument('--embedding-dim', type=int, default=384)
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    results = {"students": args.students, "k": args.k, "modes": {}}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        generate_dataset(tmp_dir, args.students, seed=args.seed)
+        df = ragpsy.load_data(tmp_dir)
+        queries = build_queries(df, args.queries, args.seed)
+        results["queries"] = len(queries)
+
+        for mode in ragpsy.INDEXING_MODES:
+            embeddings = HashingEmbeddings(size=args.embedding_dim)
+            t0 = time.perf_counter()
+            vectorstore, _, _ = ragpsy.setup_rag(tmp_dir, embeddings=embeddings, llm=object(), indexing=mode)
+            ingest_s = time.perf_counter() - t0
+
+            results["modes"][mode] = {
+                "vectors": vectorstore.index.ntotal,
+                "ingest_s": round(ingest_s, 3),
+                **evaluate(vectorstore, queries, args.k)
+            }
+            if mode == "chunks":
+                # Four sentences rarely occur together, so those queries have one or two relevant students
+                narrow = build_queries(df, args.queries, args.seed + 1, count_per_query=4)
+                results["adaptive"] = evaluate_adaptive(vectorstore, queries + narrow, args.k)
+                ragpsy.RETRIEVAL_SETTINGS["diversify"] = False
+                results["modes"]["chunks_without_mmr"] = evaluate(vectorstore, queries, args.k)
+                ragpsy.RETRIEVAL_SETTINGS["diversify"] = True
+
+    print(json.dumps(results, indent=2))
+
+if __name__ == "__main__":
+    main()
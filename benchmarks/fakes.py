@@ -0,0 +1,140 @@
+"""
+Offline stand-ins for the embedding model and LLM used by the benchmarks.
+
+HashingEmbeddings maps words into a fixed number of hashed buckets, so texts
+that share vocabulary end up close together without downloading a model.
+make_fake_llm returns a chat model with a configurable response latency. With
+prefix_cache it also simulates a serving stack's prompt prefix cache: prompts
+are hashed in blocks of words, leading blocks seen before count as cached
+tokens (reported like OpenAI's input_token_details.cache_read), and only the
+uncached tokens add prefill time before the first token.
+"""
+
+import hashlib
+import re
+import threading
+import time
+import zlib
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+from langchain_core.language_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+from pydantic import PrivateAttr
+
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+")
+
+class HashingEmbeddings(Embeddings):
+    """Deterministic bag-of-words embeddings using signed feature hashing"""
+    def __init__(self, size=384, max_cached_tokens=200_000):
+        self.size = size
+        self.max_cached_tokens = max_cached_tokens
+        self._bucket_cache = {}
+
+    def _bucket(self, token):
+        """Hash a token to a (bucket, sign) pair"""
+        cached = self._bucket_cache.get(token)
+        if cached is None:
+            h = zlib.crc32(token.encode("utf-8"))
+            cached = (h % self.size, 1.0 if (h >> 16) & 1 else -1.0)
+            if len(self._bucket_cache) < self.max_cached_tokens:
+                self._bucket_cache[token] = cached
+        return cached
+
+    def _embed(self, text):
+        vector = np.zeros(self.size, dtype=np.float32)
+        for token in TOKEN_PATTERN.findall(text.lower()):
+            bucket, sign = self._bucket(token)
+            vector[bucket] += sign
+        norm = np.linalg.norm(vector)
+        if norm > 0:
+            vector /= norm
+        return vector.tolist()
+
+    def embed_documents(self, texts):
+        return [self._embed(text) for text in texts]
+
+    def embed_query(self, text):
+        return self._embed(text)
+
+class FakeLatencyChatModel(BaseChatModel):
+    """Chat model that answers with fixed text after a configurable delay"""
+    response: str = "Synthetic analysis of the retrieved student records."
+    latency_ms: float = 0.0
+    first_token_ms: float = 0.0
+    prefix_cache: bool = False
+    prefill_ms_per_token: float = 0.0
+    cache_block_tokens: int = 16
+    max_cached_blocks: int = 100_000
+    _blocks: set = PrivateAttr(default_factory=set)
+    _lock: threading.Lock = PrivateAttr(default_factory=threading.Lock)
+
+    @property
+    def _llm_type(self):
+        return "fake-latency-chat-model"
+
+    def _cached_tokens(self, words):
+        """Leading words covered by previously seen blocks; records this prompt's blocks"""
+        if not self.prefix_cache:
+            return 0
+        digest = hashlib.blake2b(digest_size=16)
+        cached, hit = 0, True
+        with self._lock:
+            if len(self._blocks) > self.max_cached_blocks:
+                self._blocks.clear()
+            # Each block's key covers every word before it, like a KV cache's block hashes
+            for start in range(0, len(words) - self.cache_block_tokens + 1, self.cache_block_tokens):
+                digest.update(" ".join(words[start:start + self.cache_block_tokens]).encode("utf-8"))
+                key = digest.digest()
+                if hit and key in self._blocks:
+                    cached += self.cache_block_tokens
+                else:
+                    hit = False
+                    self._blocks.add(key)
+        return cached
+
+    def _usage(self, messages):
+        words = [word for m in messages for word in str(m.content).split()]
+        prompt_tokens = len(words)
+        cached = self._cached_tokens(words)
+        completion_tokens = len(self.response.split())
+        return {
+            "input_tokens": prompt_tokens,
+            "output_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+            "input_token_details": {"cache_read": cached}
+        }
+
+    def _prefill_s(self, usage):
+        uncached = usage["input_tokens"] - usage["input_token_details"]["cache_read"]
+        return uncached * self.prefill_ms_per_token / 1000.0
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        usage = self._usage(messages)
+        delay = self.latency_ms / 1000.0 + self._prefill_s(usage)
+        if delay:
+            time.sleep(delay)
+        message = AIMessage(content=self.response, usage_metadata=usage)
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+    def _stream(self, messages, stop=None, run_manager=None, **kwargs):
+        words = self.response.split(" ")
+        usage = self._usage(messages)
+        delay = self.first_token_ms / 1000.0 + self._prefill_s(usage)
+        if delay:
+            time.sleep(delay)
+        # Spread the remaining latency over the rest of the words
+        per_word = max(0.0, self.latency_ms - self.first_token_ms) / 1000.0 / max(1, len(words) - 1)
+        for i, word in enumerate(words):
+            if i and per_word:
+                time.sleep(per_word)
+            yield ChatGenerationChunk(message=AIMessageChunk(content=word if i == 0 else " " + word))
+        yield ChatGenerationChunk(message=AIMessageChunk(content="", usage_metadata=usage))
+
+def make_fake_llm(latency_ms=0, first_token_ms=None, prefix_cache=False, prefill_ms_per_token=0.0):
+    """Offline chat model with the given total latency and time to first token"""
+    if first_token_ms is None:
+        first_token_ms = latency_ms / 4
+    return FakeLatencyChatModel(latency_ms=latency_ms, first_token_ms=first_token_ms,
+                                prefix_cache=prefix_cache, prefill_ms_per_token=prefill_ms_per_token)
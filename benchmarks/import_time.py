@@ -0,0 +1,117 @@
+"""
+Import-Time Benchmark for ragpsy
+
+Measures how long the lightweight entry points take in a fresh interpreter,
+relative to a bare `python -c pass`, and checks that none of them pull in
+heavy dependencies. Budgets live in import_budget.json; the script exits
+non-zero when an entry point is over budget or loads a forbidden module.
+
+Usage:
+    python benchmarks/import_time.py
+    python benchmarks/import_time.py --runs 10 --output import_times.json
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+current_dir = os.path.dirname(os.path.abspath(__file__))  # /benchmarks
+parent_dir = os.path.dirname(current_dir)  # Project root
+BUDGET_FILE = os.path.join(current_dir, 'import_budget.json')
+
+# Each entry point prints the top-level modules it loaded as JSON on its last line
+REPORT_MODULES = "import sys, json; print(json.dumps(sorted({m.split('.')[0] for m in sys.modules})))"
+
+ENTRY_POINTS = {
+    "import": "import ragpsy",
+    "routing": "import ragpsy; ragpsy.is_comparative_question('Compare male and female student performance')",
+    "cli_help": None,  # Runs `python ragpsy.py --help`
+    "precomputed_answer": (
+        "import ragpsy; ragpsy.build_degraded_response('Student Feedback: helpful course', "
+        "{'student_count': 1, 'overall': {}, 'groups': {}})"
+    ),
+}
+
+def _run(code):
+    """Run one entry point in a fresh interpreter and return (elapsed_ms, loaded modules)"""
+    if code is None:
+        cmd = [sys.executable, os.path.join(parent_dir, 'ragpsy.py'), '--help']
+    else:
+        cmd = [sys.executable, '-c', f"{code}; {REPORT_MODULES}"]
+
+    t0 = time.perf_counter()
+    result = subprocess.run(cmd, cwd=parent_dir, capture_output=True, text=True)
+    elapsed = (time.perf_counter() - t0) * 1000
+    if result.returncode != 0:
+        raise RuntimeError(f"{cmd} failed:\n{result.stderr}")
+
+    modules = json.loads(result.stdout.strip().splitlines()[-1]) if code is not None else []
+    return elapsed, modules
+
+def _cli_help_modules():
+    """Modules loaded while building the CLI help text"""
+    code = (
+        "import sys; sys.argv = ['ragpsy.py', '--help']; import ragpsy\n"
+        "try:\n    ragpsy.main()\nexcept SystemExit:\n    pass\n"
+        f"{REPORT_MODULES}"
+    )
+    result = subprocess.run([sys.executable, '-c', code], cwd=parent_dir, capture_output=True, text=True)
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+def measure(runs):
+    """Median wall time above interpreter startup for each entry point"""
+    baseline = statistics.median(_run("pass")[0] for _ in range(runs))
+    results = {}
+    for name, code in ENTRY_POINTS.items():
+        samples = []
+        modules = []
+        for _ in range(runs):
+            elapsed, modules = _run(code)
+            samples.append(elapsed)
+        if code is None:
+            modules = _cli_help_modules()
+        results[name] = {
+            "median_ms": round(statistics.median(samples) - baseline, 1),
+            "modules": modules
+        }
+    return baseline, results
+
+def main():
+    parser = argparse.ArgumentParser(description="Check ragpsy import-time budgets")
+    parser.add_argument('--runs', type=int, default=5, help="Fresh interpreters per entry point")
+    parser.add_argument('--output', help="Write JSON results here")
+    args = parser.parse_args()
+
+    with open(BUDGET_FILE) as f:
+        budget = json.load(f)
+    forbidden = set(budget["forbidden_modules"])
+
+    baseline, results = measure(args.runs)
+    failures = []
+    print(f"Interpreter startup baseline: {baseline:.1f} ms")
+    for name, result in results.items():
+        limit = budget["budget_ms"][name]
+        heavy = sorted(forbidden.intersection(result.pop("modules")))
+        result.update({"budget_ms": limit, "heavy_modules": heavy})
+        status = "OK"
+        if result["median_ms"] > limit:
+            status = "OVER BUDGET"
+            failures.append(name)
+        if heavy:
+            status = f"LOADS {', '.join(heavy)}"
+            failures.append(name)
+        print(f"- {name}: {result['median_ms']:.1f} ms (budget {limit} ms) {status}")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({"baseline_ms": round(baseline, 1), "entry_points": results}, f, indent=2)
+            f.write("\n")
+
+    return 1 if failures else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,249 @@
+"""
+Soak Test for the Psychology Course RAG System
+
+Builds the system with setup_rag over a synthetic dataset, using the offline
+hashing embedder and a fake chat model, and drives query_rag from many threads
+for a fixed duration. Each thread keeps its own EnhancedConversationMemory like
+an interactive session, and part of the questions are unique so per-prompt
+caches keep seeing new keys.
+
+Every sample interval the harness records process RSS, traced Python heap,
+query latency percentiles and the size of the question-embedding and LLM
+caches. The caches are shrunk (--cache-entries) so they fill during the
+warm-up period. After it, the harness fails if RSS or heap growth, the RSS
+growth rate, p95 latency drift or the error rate exceed the limits in
+soak_thresholds.json.
+
+Usage:
+    python benchmarks/soak.py --duration 3600 --threads 16
+    python benchmarks/soak.py --duration 180 --warmup 60 --output soak.json
+"""
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+current_dir = os.path.dirname(os.path.abspath(__file__))  # /benchmarks
+parent_dir = os.path.dirname(current_dir)  # Project root
+sys.path.append(parent_dir)
+sys.path.append(current_dir)
+THRESHOLDS_FILE = os.path.join(current_dir, 'soak_thresholds.json')
+
+import numpy as np
+import ragpsy
+from fakes import HashingEmbeddings, make_fake_llm
+from synthetic_data import generate_dataset
+
+QUESTION_TEMPLATES = [
+    ("How do students who study more than {n} hours per week do on the final?", None),
+    ("What do students with attendance below {n}% say about the course?", None),
+    ("How do international students perform in exams?", {"international_student": "Yes"}),
+    ("What challenges do first-generation students mention?", {"first_gen_student": "Yes"}),
+    ("Compare male and female student performance", None),
+    ("What common themes appear in course reviews?", None),
+    ("What do students say about office hours and {n} weeks of exams?", {"gender": "Female"}),
+]
+
+ERROR_RESPONSE = "An error occurred. Please try again."
+MB = 1024 * 1024
+
+def rss_bytes():
+    """Resident set size of this process"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        pass
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss
+    except ImportError:
+        import resource
+        # Peak rather than current RSS, but growth still shows
+        scale = 1 if sys.platform == "darwin" else 1024
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+
+def llm_cache_entries():
+    """Responses held by the global LangChain LLM cache"""
+    from langchain_core.globals import get_llm_cache
+
+    cache = get_llm_cache()
+    return len(getattr(cache, "_cache", {})) if cache is not None else 0
+
+class QueryLoad:
+    """Worker threads calling query_rag until stopped, collecting latencies per sample window"""
+    def __init__(self, vectorstore, llm, threads, unique_fraction, seed):
+        self.vectorstore = vectorstore
+        self.llm = llm
+        self.threads = threads
+        self.unique_fraction = unique_fraction
+        self.seed = seed
+        self.stop = threading.Event()
+        self._lock = threading.Lock()
+        self._latencies = []
+        self._errors = 0
+        self._counter = 0
+
+    def _next_id(self):
+        with self._lock:
+            self._counter += 1
+            return self._counter
+
+    def _worker(self, number):
+        rng = np.random.default_rng(self.seed + number)
+        memory = ragpsy.EnhancedConversationMemory()
+        while not self.stop.is_set():
+            template, filter_metadata = QUESTION_TEMPLATES[rng.integers(len(QUESTION_TEMPLATES))]
+            question = template.format(n=int(rng.integers(2, 20)) if "{n}" in template else 0)
+            if rng.random() < self.unique_fraction:
+                # Never-repeated questions keep adding keys to every per-question cache
+                question = f"{question} (case {self._next_id()})"
+
+            t0 = time.perf_counter()
+            response = ragpsy.query_rag(self.vectorstore, self.llm, question, filter_metadata)
+            latency = (time.perf_counter() - t0) * 1000
+            memory.add_interaction(question, response, {"filter": filter_metadata})
+            with self._lock:
+                self._latencies.append(latency)
+                self._errors += response == ERROR_RESPONSE
+
+    def start(self):
+        self._pool = [threading.Thread(target=self._worker, args=(i,), daemon=True) for i in range(self.threads)]
+        for thread in self._pool:
+            thread.start()
+
+    def join(self):
+        self.stop.set()
+        for thread in self._pool:
+            thread.join()
+
+    def drain(self):
+        """Latencies and error count since the previous call"""
+        with self._lock:
+            latencies, errors = self._latencies, self._errors
+            self._latencies, self._errors = [], 0
+        return latencies, errors
+
+def sample(load, started, trace_heap):
+    latencies, errors = load.drain()
+    ordered = sorted(latencies)
+    return {
+        "t_s": round(time.perf_counter() - started, 1),
+        "rss_mb": round(rss_bytes() / MB, 2),
+        "heap_mb": round(tracemalloc.get_traced_memory()[0] / MB, 2) if trace_heap else None,
+        "queries": len(ordered),
+        "errors": errors,
+        "p50_ms": ragpsy._percentile(ordered, 50),
+        "p95_ms": ragpsy._percentile(ordered, 95),
+        "question_embeddings": len(ragpsy.QUESTION_EMBEDDINGS),
+        "llm_cache_entries": llm_cache_entries()
+    }
+
+def evaluate(samples, warmup_s, thresholds):
+    """Compare steady-state samples (after warm-up) with the thresholds; returns (summary, failures)"""
+    steady = [s for s in samples if s["t_s"] >= warmup_s and s["queries"]]
+    if len(steady) < 3:
+        return {"steady_samples": len(steady)}, ["not enough samples after warm-up; run longer"]
+
+    hours = np.array([s["t_s"] for s in steady]) / 3600.0
+    rss = np.array([s["rss_mb"] for s in steady])
+    third = max(1, len(steady) // 3)
+    early_p95 = float(np.median([s["p95_ms"] for s in steady[:third]]))
+    late_p95 = float(np.median([s["p95_ms"] for s in steady[-third:]]))
+    queries = sum(s["queries"] for s in steady)
+
+    summary = {
+        "steady_samples": len(steady),
+        "queries": queries,
+        "rss_growth_mb": round(float(rss[-1] - rss[0]), 2),
+        "rss_growth_mb_per_hour": round(float(np.polyfit(hours, rss, 1)[0]), 2) if hours[-1] > hours[0] else 0.0,
+        "p95_latency_drift": round(late_p95 / early_p95, 3) if early_p95 else 1.0,
+        "error_rate": round(sum(s["errors"] for s in steady) / queries, 5)
+    }
+    if steady[0]["heap_mb"] is not None:
+        summary["heap_growth_mb"] = round(steady[-1]["heap_mb"] - steady[0]["heap_mb"], 2)
+
+    failures = []
+    for metric, limit in (("rss_growth_mb", "max_rss_growth_mb"),
+                          ("rss_growth_mb_per_hour", "max_rss_growth_mb_per_hour"),
+                          ("heap_growth_mb", "max_heap_growth_mb"),
+                          ("p95_latency_drift", "max_p95_latency_drift"),
+                          ("error_rate", "max_error_rate")):
+        if metric in summary and summary[metric] > thresholds[limit]:
+            failures.append(f"{metric} {summary[metric]} > {thresholds[limit]}")
+    return summary, failures
+
+def main():
+    parser = argparse.ArgumentParser(description="Soak-test query_rag for memory growth and latency drift")
+    parser.add_argument('--duration', type=float, default=600, help="Seconds of load")
+    parser.add_argument('--warmup', type=float, default=120, help="Seconds ignored while caches fill")
+    parser.add_argument('--sample-interval', type=float, default=10)
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--students', type=int, default=5_000)
+    parser.add_argument('--unique-fraction', type=float, default=0.5, help="Share of never-repeated questions")
+    parser.add_argument('--llm-latency-ms', type=float, default=5)
+    parser.add_argument('--cache-entries', type=int, default=1000,
+                        help="Size of the question-embedding and LLM caches, small so they fill during warm-up")
+    parser.add_argument('--no-stream', action='store_true',
+                        help="Call the LLM without streaming (no time-to-first-token measurement)")
+    parser.add_argument('--no-tracemalloc', action='store_true', help="Skip heap tracing (lower overhead)")
+    parser.add_argument('--thresholds', default=THRESHOLDS_FILE)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--output', help="Write samples and the verdict as JSON here")
+    args = parser.parse_args()
+
+    with open(args.thresholds) as f:
+        thresholds = json.load(f)
+
+    # Bounded caches must be full before the steady-state window starts
+    ragpsy.EMBEDDING_CACHE_SETTINGS["max_entries"] = args.cache_entries
+    ragpsy.LLM_CACHE_SETTINGS["max_entries"] = args.cache_entries
+    if args.no_stream:
+        ragpsy.LLM_CALL_SETTINGS["stream"] = False
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        generate_dataset(tmp_dir, args.students, seed=args.seed)
+        # The embedder's token cache is kept small too, so unique questions do not grow it
+        vectorstore, llm, _ = ragpsy.setup_rag(
+            tmp_dir, embeddings=HashingEmbeddings(max_cached_tokens=args.cache_entries),
+            llm=make_fake_llm(latency_ms=args.llm_latency_ms)
+        )
+    if vectorstore is None:
+        print("setup_rag failed", file=sys.stderr)
+        return 1
+
+    trace_heap = not args.no_tracemalloc
+    if trace_heap:
+        tracemalloc.start()
+    load = QueryLoad(vectorstore, llm, args.threads, args.unique_fraction, args.seed)
+    samples = []
+    started = time.perf_counter()
+    load.start()
+    try:
+        while time.perf_counter() - started < args.duration:
+            time.sleep(min(args.sample_interval, max(0.0, args.duration - (time.perf_counter() - started))))
+            samples.append(sample(load, started, trace_heap))
+            last = samples[-1]
+            print(f"[{last['t_s']:>7.1f}s] rss {last['rss_mb']:.1f} MB, {last['queries']} queries, "
+                  f"p95 {last['p95_ms']:.1f} ms, caches {last['question_embeddings']}/{last['llm_cache_entries']}",
+                  file=sys.stderr)
+    finally:
+        load.join()
+
+    summary, failures = evaluate(samples, args.warmup, thresholds)
+    report = {"config": vars(args), "thresholds": thresholds, "summary": summary,
+              "failures": failures, "samples": samples}
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+            f.write("\n")
+    print(json.dumps({"summary": summary, "failures": failures}, indent=2))
+    return 1 if failures else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,151 @@
+"""
+Synthetic Data Generator for Psychology Course RAG Benchmarks
+
+Scales the psych101-quantitative.csv / psych101-qualitative.csv schemas to
+any number of students (10k-10M) so ingest and query performance can be
+measured at realistic sizes. Reviews are assembled from sentences found in
+the sample data, so text length and vocabulary match the real files.
+
+Usage:
+    python benchmarks/synthetic_data.py --students 100000 --output-dir /tmp/psych-100k
+"""
+
+import argparse
+import os
+import re
+import sys
+
+import numpy as np
+import pandas as pd
+
+current_dir = os.path.dirname(os.path.abspath(__file__))  # /benchmarks
+parent_dir = os.path.dirname(current_dir)  # Project root
+SAMPLE_DATA_DIR = os.path.join(parent_dir, 'data')
+
+QUANT_FILE = 'psych101-quantitative.csv'
+QUAL_FILE = 'psych101-qualitative.csv'
+
+GENDERS = (['Female', 'Male', 'Non-binary'], [0.52, 0.44, 0.04])
+ETHNICITIES = (['White', 'Asian', 'Hispanic', 'Black', 'Mixed', 'Other'], [0.4, 0.2, 0.18, 0.12, 0.07, 0.03])
+YEARS = (['Freshman', 'Sophomore', 'Junior', 'Senior'], [0.45, 0.3, 0.15, 0.1])
+MAJORS = (['Psychology', 'Biology', 'Business', 'Undeclared', 'Nursing', 'Computer Science', 'English'],
+          [0.25, 0.15, 0.15, 0.2, 0.1, 0.1, 0.05])
+LEVELS = (['Low', 'Medium', 'High', 'Very High'], [0.1, 0.35, 0.4, 0.15])
+LEARNING_STYLES = (['Visual', 'Auditory', 'Kinesthetic', 'Reading/Writing'], [0.35, 0.2, 0.25, 0.2])
+PARTICIPATION = (['Passive', 'Moderate', 'Active', 'Very Active'], [0.15, 0.35, 0.35, 0.15])
+
+FALLBACK_SENTENCES = [
+    "The lectures were clear and well organized.",
+    "I struggled with the neuroscience unit.",
+    "Office hours helped me improve my test-taking strategies.",
+    "The group discussions really helped me grasp the material.",
+    "Some video lectures were too long.",
+    "Balancing this course with work was difficult.",
+]
+
+def load_sentence_pools(sample_dir=SAMPLE_DATA_DIR):
+    """Collect review and assessment sentences from the sample data"""
+    pools = {}
+    qual_path = os.path.join(sample_dir, QUAL_FILE)
+    if os.path.exists(qual_path):
+        qual_df = pd.read_csv(qual_path)
+    else:
+        qual_df = None
+
+    for col in ['course_review', 'learning_outcomes_assessment']:
+        sentences = []
+        if qual_df is not None:
+            for text in qual_df[col].dropna():
+                sentences.extend(s.strip() for s in re.split(r'(?<=[.!?])\s+', text) if s.strip())
+        pools[col] = np.array(sentences or FALLBACK_SENTENCES, dtype=object)
+
+    return pools
+
+def _choice(rng, options, size):
+    """Draw categorical values with the given probabilities"""
+    values, weights = options
+    return np.array(values, dtype=object)[rng.choice(len(values), size=size, p=weights)]
+
+def _compose_text(rng, pool, size, min_sentences, max_sentences):
+    """Join randomly drawn sentences into one text per row"""
+    counts = rng.integers(min_sentences, max_sentences + 1, size=size)
+    picks = rng.integers(0, len(pool), size=int(counts.sum()))
+    sentences = pool[picks]
+    offsets = np.concatenate([[0], np.cumsum(counts)])
+    return [" ".join(sentences[offsets[i]:offsets[i + 1]]) for i in range(size)]
+
+def generate_batch(rng, start, size, pools, prefix='PSY101_SYN'):
+    """Generate one batch of quantitative and qualitative rows"""
+    ids = np.char.add(f"{prefix}_", np.char.zfill(np.arange(start, start + size).astype(str), 8))
+
+    study_hours = np.clip(rng.gamma(4.0, 2.0, size), 1, 25).round().astype(int)
+    attendance = np.clip(rng.normal(88, 9, size), 50, 100).round().astype(int)
+    # A slice of students has perfect attendance, as in the sample data
+    attendance[rng.random(size) < 0.12] = 100
+    ability = rng.normal(0, 1, size)
+    midterm = np.clip(75 + 8 * ability + 0.4 * study_hours + rng.normal(0, 5, size), 35, 100).round().astype(int)
+    final = np.clip(midterm + 0.6 * (study_hours - 8) + 0.1 * (attendance - 88) + rng.normal(2, 5, size),
+                    35, 100).round().astype(int)
+
+    quant_df = pd.DataFrame({
+        'student_id': ids,
+        'age': rng.integers(17, 26, size),
+        'gender': _choice(rng, GENDERS, size),
+        'ethnicity': _choice(rng, ETHNICITIES, size),
+        'first_gen_student': np.where(rng.random(size) < 0.3, 'Yes', 'No'),
+        'international_student': np.where(rng.random(size) < 0.15, 'Yes', 'No'),
+        'midterm_grade': midterm,
+        'final_exam': final,
+        'assignment_avg': np.clip(rng.normal(85, 7, size), 40, 100).round().astype(int),
+        'participation_score': np.clip(rng.normal(85, 8, size), 40, 100).round().astype(int),
+        'attendance_rate': attendance,
+        'study_hours_per_week': study_hours,
+        'group_work_score': np.clip(rng.normal(87, 6, size), 40, 100).round().astype(int),
+        'office_hours_attended': rng.poisson(3, size)
+    })
+
+    qual_df = pd.DataFrame({
+        'student_id': ids,
+        'year': _choice(rng, YEARS, size),
+        'major': _choice(rng, MAJORS, size),
+        'course_review': _compose_text(rng, pools['course_review'], size, 3, 5),
+        'learning_outcomes_assessment': _compose_text(rng, pools['learning_outcomes_assessment'], size, 2, 3),
+        'engagement_level': _choice(rng, LEVELS, size),
+        'preferred_learning_style': _choice(rng, LEARNING_STYLES, size),
+        'online_participation': _choice(rng, PARTICIPATION, size)
+    })
+
+    return quant_df, qual_df
+
+def generate_dataset(output_dir, students, seed=42, batch_size=100_000, prefix='PSY101_SYN'):
+    """Write synthetic quantitative and qualitative CSVs for the given number of students"""
+    os.makedirs(output_dir, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    pools = load_sentence_pools()
+
+    quant_path = os.path.join(output_dir, QUANT_FILE)
+    qual_path = os.path.join(output_dir, QUAL_FILE)
+
+    # Batches are appended so tens of millions of rows never sit in memory at once
+    for start in range(0, students, batch_size):
+        size = min(batch_size, students - start)
+        quant_df, qual_df = generate_batch(rng, start, size, pools, prefix=prefix)
+        first = start == 0
+        quant_df.to_csv(quant_path, mode='w' if first else 'a', header=first, index=False)
+        qual_df.to_csv(qual_path, mode='w' if first else 'a', header=first, index=False)
+
+    return output_dir
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate synthetic psych101 data at scale")
+    parser.add_argument('--students', type=int, default=10_000, help="Number of students to generate")
+    parser.add_argument('--output-dir', required=True, help="Directory to write the two CSV files to")
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--batch-size', type=int, default=100_000)
+    args = parser.parse_args()
+
+    generate_dataset(args.output_dir, args.students, seed=args.seed, batch_size=args.batch_size)
+    print(f"Wrote {args.students} synthetic students to {args.output_dir}")
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -18,13 +18,17 @@ parent_dir = os.path.dirname(os.path.dirname(current_dir))  # Project root
 sys.path.append(parent_dir)
 
 try:
-    from ragpsy import setup_rag, query_rag
+    from ragpsy import setup_rag, query_rag, EMBEDDING_CACHE_SETTINGS, DEFAULT_EMBEDDING_CACHE_PATH
 except ModuleNotFoundError:
     print("Error: Cannot find ragpsy module.")
     print(f"Looking in: {parent_dir}")
     print("Make sure ragpsy.py is in the project root directory")
     sys.exit(1)
 
+# Reuse the embeddings of this script's fixed questions from earlier runs
+if not EMBEDDING_CACHE_SETTINGS["path"]:
+    EMBEDDING_CACHE_SETTINGS["path"] = os.path.join(parent_dir, DEFAULT_EMBEDDING_CACHE_PATH)
+
 def run_advanced_analysis():
     """Run advanced analysis examples demonstrating complex queries."""
     # Initialize the system
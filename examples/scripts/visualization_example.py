@@ -1,17 +1,19 @@
 """
 Visualization Examples for Psychology Course RAG System
 
-This script demonstrates how to create visualizations of the RAG analysis results.
-Note: This script requires matplotlib and seaborn packages.
+This script demonstrates how to create visualizations of the course data.
+Note: This script requires matplotlib.
 
+The plots are drawn from binned aggregates (histograms, 2D histograms and box
+statistics) computed by ragpsy.load_plot_aggregates and cached per data
+version, so redrawing them takes the same time for 25 or a million students.
 
 Requirements:
     - matplotlib
-    - seaborn
     - pandas
 
 Note: These are additional requirements beyond the core RAG system.
-Install using: pip install matplotlib seaborn pandas
+Install using: pip install matplotlib pandas
 """
 
 import sys
@@ -23,7 +25,7 @@ parent_dir = os.path.dirname(os.path.dirname(current_dir))
 sys.path.append(parent_dir)
 
 try:
-    from ragpsy import setup_rag, query_rag
+    from ragpsy import load_plot_aggregates
 except ModuleNotFoundError:
     print("Error: Cannot find ragpsy module.")
     print(f"Looking in: {parent_dir}")
@@ -31,105 +33,127 @@ except ModuleNotFoundError:
     sys.exit(1)
 
 try:
+    import matplotlib
+    matplotlib.use("Agg")
     import matplotlib.pyplot as plt
-    import seaborn as sns
+    import numpy as np
 except ImportError:
-    print("Error: This script requires matplotlib and seaborn.")
-    print("Install them using: pip install matplotlib seaborn")
+    print("Error: This script requires matplotlib.")
+    print("Install it using: pip install matplotlib")
     sys.exit(1)
 
+def box_stats(stats, labels):
+    """Box statistics in the form Axes.bxp draws, skipping empty groups"""
+    return [
+        {"label": label, "med": stats["med"][i], "q1": stats["q1"][i], "q3": stats["q3"][i],
+         "whislo": stats["whislo"][i], "whishi": stats["whishi"][i]}
+        for i, label in enumerate(labels) if stats["count"][i]
+    ]
+
+def plot_grade_distribution(aggregates, path):
+    """Stacked final exam histogram per gender"""
+    grades = aggregates["grade_distribution"]
+    edges = grades["edges"]
+    fig, ax = plt.subplots(figsize=(10, 6))
+    bottom = np.zeros(len(edges) - 1)
+    for label, counts in zip(grades["groups"], grades["counts"]):
+        ax.bar(edges[:-1], counts, width=np.diff(edges), bottom=bottom, align="edge", label=label)
+        bottom += counts
+    ax.set_title('Final Exam Score Distribution by Gender')
+    ax.set_xlabel('Final Exam Score')
+    ax.set_ylabel('Count')
+    ax.legend(title='gender')
+    fig.savefig(path)
+    plt.close(fig)
+
+def plot_study_hours(aggregates, path):
+    """Study hours vs final exam density, one panel per gender and student type"""
+    study = aggregates["study_hours"]
+    groups = len(study["groups"])
+    cols = min(groups, 2)
+    rows = (groups + cols - 1) // cols
+    fig, axes = plt.subplots(rows, cols, figsize=(10, 3 * rows + 1), sharex=True, sharey=True, squeeze=False)
+    # One color scale across panels so densities are comparable
+    vmax = max(int(study["counts"].max()), 1)
+    for ax, label, counts in zip(axes.flat, study["groups"], study["counts"]):
+        mesh = ax.pcolormesh(study["x_edges"], study["y_edges"], np.ma.masked_equal(counts.T, 0),
+                             cmap="viridis", vmin=0, vmax=vmax)
+        gender, international = label.split(" / ")
+        ax.set_title(f"{gender}, {'international' if international == 'Yes' else 'domestic'}", fontsize=10)
+    for ax in axes.flat[groups:]:
+        ax.set_visible(False)
+    for ax in axes[-1]:
+        ax.set_xlabel('Study Hours per Week')
+    for ax in axes[:, 0]:
+        ax.set_ylabel('Final Exam Score')
+    fig.suptitle('Study Hours vs Final Exam Performance')
+    fig.colorbar(mesh, ax=axes, label='Students')
+    fig.savefig(path)
+    plt.close(fig)
+
+def plot_attendance(aggregates, path):
+    """Final exam spread per attendance band and attendance spread per student type"""
+    attendance = aggregates["attendance_exam"]
+    edges = attendance["edges"]
+    bands = [f"{low:g}-{high:g}" for low, high in zip(edges[:-1], edges[1:])]
+    by_type = aggregates["attendance_by_type"]
+
+    fig, (left, right) = plt.subplots(1, 2, figsize=(12, 5))
+    left.bxp(box_stats(attendance, bands), showfliers=False)
+    left.set_title('Attendance Impact on Final Exam')
+    left.set_xlabel('attendance_rate')
+    left.set_ylabel('final_exam')
+    left.tick_params(axis='x', labelrotation=45)
+    right.bxp(box_stats(by_type, by_type["groups"]), showfliers=False)
+    right.set_title('Attendance Rates by Student Type')
+    right.set_xlabel('international_student')
+    right.set_ylabel('attendance_rate')
+    fig.tight_layout()
+    fig.savefig(path)
+    plt.close(fig)
+
 def create_visualizations():
     """Create various visualizations of the course data."""
-    # Initialize the system
+    # Plots need the binned dataset only, not the vectorstore or the LLM
     data_path = os.path.join(parent_dir, 'data')
-    print("Initializing RAG system and loading data...")
+    vis_dir = os.path.join(parent_dir, 'examples', 'visualizations')
+    print("Loading data...")
     print(f"Using data path: {data_path}")
-    
+
     try:
-        vectorstore, llm, df = setup_rag(data_path)
-        if df is None:
-            print("Error: No DataFrame available for visualization")
+        aggregates = load_plot_aggregates(data_path)
+        if aggregates is None:
+            print("Error: No data available for visualization")
             return
     except Exception as e:
         print(f"Error loading data: {str(e)}")
         return
+    print(f"Aggregated {aggregates['students']} students")
 
-    # Example 1: Grade Distribution
-    try:
-        plt.figure(figsize=(10, 6))
-        print("\nCreating grade distribution plot...")
-        
-        # Convert final_exam to numeric if it's not already
-        df['final_exam'] = pd.to_numeric(df['final_exam'], errors='coerce')
-        
-        sns.histplot(data=df, x='final_exam', hue='gender', multiple="stack")
-        plt.title('Final Exam Score Distribution by Gender')
-        plt.xlabel('Final Exam Score')
-        plt.ylabel('Count')
-        plt.savefig(os.path.join(parent_dir, 'examples', 'visualizations', 'grade_distribution.png'))
-        plt.close()
-        print("Grade distribution plot saved")
-    except Exception as e:
-        print(f"Error creating grade distribution plot: {str(e)}")
-
-    # Example 2: Study Hours vs Performance
-    try:
-        plt.figure(figsize=(10, 6))
-        print("\nCreating study hours vs performance plot...")
-        
-        # Convert study_hours to numeric
-        df['study_hours_per_week'] = pd.to_numeric(df['study_hours_per_week'], errors='coerce')
-        
-        sns.scatterplot(
-            data=df,
-            x='study_hours_per_week',
-            y='final_exam',
-            hue='gender',
-            style='international_student'
-        )
-        plt.title('Study Hours vs Final Exam Performance')
-        plt.xlabel('Study Hours per Week')
-        plt.ylabel('Final Exam Score')
-        plt.savefig(os.path.join(parent_dir, 'examples', 'visualizations', 'study_hours.png'))
-        plt.close()
-        print("Study hours plot saved")
-    except Exception as e:
-        print(f"Error creating study hours plot: {str(e)}")
-
-    # Example 3: Attendance Impact
-    try:
-        plt.figure(figsize=(12, 5))
-        print("\nCreating attendance analysis plots...")
-        
-        # Convert attendance_rate to numeric
-        df['attendance_rate'] = pd.to_numeric(df['attendance_rate'], errors='coerce')
-        
-        plt.subplot(1, 2, 1)
-        sns.boxplot(data=df, x='attendance_rate', y='final_exam')
-        plt.title('Attendance Impact on Final Exam')
-        
-        plt.subplot(1, 2, 2)
-        sns.boxplot(data=df, x='international_student', y='attendance_rate')
-        plt.title('Attendance Rates by Student Type')
-        
-        plt.tight_layout()
-        plt.savefig(os.path.join(parent_dir, 'examples', 'visualizations', 'attendance_analysis.png'))
-        plt.close()
-        print("Attendance analysis plots saved")
-    except Exception as e:
-        print(f"Error creating attendance analysis plots: {str(e)}")
+    plots = [
+        ("grade distribution", plot_grade_distribution, 'grade_distribution.png'),
+        ("study hours vs performance", plot_study_hours, 'study_hours.png'),
+        ("attendance analysis", plot_attendance, 'attendance_analysis.png')
+    ]
+    for name, plot, filename in plots:
+        try:
+            print(f"\nCreating {name} plot...")
+            plot(aggregates, os.path.join(vis_dir, filename))
+            print(f"{name.capitalize()} plot saved")
+        except Exception as e:
+            print(f"Error creating {name} plot: {str(e)}")
 
 if __name__ == "__main__":
     # Create visualizations directory if it doesn't exist
     vis_dir = os.path.join(parent_dir, 'examples', 'visualizations')
     os.makedirs(vis_dir, exist_ok=True)
-    
-    # Import pandas here to avoid potential import issues
+
+    # The aggregates are computed from a pandas DataFrame on a cache miss
     try:
-        import pandas as pd
+        import pandas  # noqa: F401
     except ImportError:
         print("Error: This script requires pandas.")
         print("Install it using: pip install pandas")
         sys.exit(1)
-    
-    create_visualizations()
\ No newline at end of file
+
+    create_visualizations()
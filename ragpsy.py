@@ -1,44 +1,725 @@
-import pandas as pd
-from langchain_community.vectorstores import FAISS
-from langchain_huggingface import HuggingFaceEmbeddings
-from langchain_text_splitters import RecursiveCharacterTextSplitter
-from langchain_core.prompts import PromptTemplate
-from langchain_openai import ChatOpenAI
 import os
 os.environ["TOKENIZERS_PARALLELISM"] = "false"
-from dotenv import load_dotenv
-from langchain.cache import InMemoryCache
-from langchain.memory import ConversationBufferMemory 
-from langchain_core.prompts import PromptTemplate, ChatPromptTemplate, MessagesPlaceholder
-from langchain_community.cache import InMemoryCache  # Instead of from langchain.cache
-from pydantic import BaseModel  # Instead of from langchain_core.pydantic_v1
-import langchain
-
-def load_data(data_path):
-    """Load and merge relevant data from CSV files"""
+# Heavy dependencies (pandas, numpy, FAISS, LangChain, sentence-transformers, OpenAI)
+# are imported inside the functions that need them, so importing ragpsy stays fast
+import re
+import operator
+import threading
+import time
+import random
+import math
+import json
+import logging
+import sys
+import string
+import functools
+import weakref
+import atexit
+import cProfile
+import tracemalloc
+from collections import Counter, OrderedDict
+from collections import deque
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+
+logger = logging.getLogger("ragpsy")
+trace_logger = logging.getLogger("ragpsy.trace")
+
+# Settings for how rendered prompts are dispatched to the LLM
+LLM_CALL_SETTINGS = {
+    "coalesce": True,          # Share one call between identical in-flight prompts
+    "batch_window_ms": 10,     # How long a micro-batch waits for more prompts
+    "max_batch_size": 16,      # Flush a micro-batch early once it is this large
+    "timeout_s": 30,           # Per-attempt limit on a single LLM call
+    "max_retries": 3,          # Extra attempts after a retryable failure
+    "backoff_base_s": 0.5,     # First backoff delay, doubled on every retry
+    "backoff_max_s": 8.0,      # Upper bound for a single backoff delay
+    "breaker_failure_threshold": 5,  # Consecutive failures before the breaker opens
+    "breaker_reset_s": 30,     # How long the breaker stays open before a trial call
+    "max_abandoned_calls": 16, # Timed-out calls allowed to keep running before new calls fail fast
+    "stream": True,            # Stream chat completions so time to first token can be measured
+    "batching": False          # Micro-batch concurrent prompts on backends with batch completion
+}
+
+# Errors worth retrying: timeouts, rate limits and transient provider/network failures
+RETRYABLE_LLM_ERRORS = {
+    "TimeoutError", "APITimeoutError", "RateLimitError",
+    "APIConnectionError", "InternalServerError", "ServiceUnavailableError"
+}
+
+# Summary statistics of the loaded dataset, used when the LLM is unavailable
+_dataset_statistics = None
+
+class JsonLogFormatter(logging.Formatter):
+    """Format log records as single-line JSON, including any attached trace"""
+    def format(self, record):
+        payload = {
+            "ts": round(record.created, 3),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage()
+        }
+        trace = getattr(record, "trace", None)
+        if trace is not None:
+            payload["trace"] = trace
+        if record.exc_info:
+            payload["exception"] = self.formatException(record.exc_info)
+        return json.dumps(payload, default=str)
+
+def configure_logging(level=None, json_logs=None):
+    """Configure ragpsy logging from arguments or the RAGPSY_LOG_LEVEL/RAGPSY_LOG_FORMAT variables"""
+    level = level or os.getenv("RAGPSY_LOG_LEVEL", "INFO")
+    if json_logs is None:
+        json_logs = os.getenv("RAGPSY_LOG_FORMAT", "").lower() == "json"
+
+    handler = logging.StreamHandler()
+    if json_logs:
+        handler.setFormatter(JsonLogFormatter())
+    else:
+        handler.setFormatter(logging.Formatter("%(levelname)s %(name)s: %(message)s"))
+
+    logger.handlers = [handler]
+    logger.setLevel(level.upper() if isinstance(level, str) else level)
+    logger.propagate = False
+    return logger
+
+class MetricsRegistry:
+    """In-process counters and latency histograms with percentile summaries"""
+    def __init__(self, reservoir_size=2048):
+        self.reservoir_size = reservoir_size
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+
+    def incr(self, name, value=1):
+        """Increase a counter"""
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def observe(self, name, value):
+        """Record a sample in a histogram, keeping the most recent reservoir_size samples"""
+        with self._lock:
+            histogram = self._histograms.get(name)
+            if histogram is None:
+                histogram = {"count": 0, "total": 0.0, "samples": deque(maxlen=self.reservoir_size)}
+                self._histograms[name] = histogram
+            histogram["count"] += 1
+            histogram["total"] += value
+            histogram["samples"].append(value)
+
+    def snapshot(self):
+        """Return counters and p50/p95/p99 summaries of every histogram"""
+        with self._lock:
+            counters = dict(self._counters)
+            histograms = {
+                name: (h["count"], h["total"], sorted(h["samples"]))
+                for name, h in self._histograms.items()
+            }
+
+        summaries = {}
+        for name, (count, total, samples) in histograms.items():
+            summaries[name] = {
+                "count": count,
+                "mean": round(total / count, 3) if count else 0.0,
+                "p50": _percentile(samples, 50),
+                "p95": _percentile(samples, 95),
+                "p99": _percentile(samples, 99)
+            }
+        return {"counters": counters, "histograms": summaries}
+
+    def reset(self):
+        """Drop all recorded metrics"""
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+
+def _percentile(sorted_samples, pct):
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_samples:
+        return 0.0
+    rank = max(0, min(len(sorted_samples) - 1, math.ceil(pct / 100.0 * len(sorted_samples)) - 1))
+    return round(sorted_samples[rank], 3)
+
+METRICS = MetricsRegistry()
+_otel_tracer = None
+
+def enable_opentelemetry(tracer_name="ragpsy"):
+    """Export query traces as OpenTelemetry spans if the opentelemetry API is installed"""
+    global _otel_tracer
     try:
-        # Load datasets with specific columns
-        quant_df = pd.read_csv(os.path.join(data_path, 'psych101-quantitative.csv'))
-        qual_df = pd.read_csv(os.path.join(data_path, 'psych101-qualitative.csv'))
-        
-        # Select only the columns we need
-        quant_cols = ['student_id', 'gender', 'first_gen_student', 'international_student',
-                     'midterm_grade', 'final_exam', 'study_hours_per_week', 'attendance_rate']
-        qual_cols = ['student_id', 'course_review', 'learning_outcomes_assessment']
-        
-        quant_df = quant_df[quant_cols]
-        qual_df = qual_df[qual_cols]
+        from opentelemetry import trace as otel_trace
+    except ImportError:
+        logger.warning("opentelemetry is not installed; traces stay in-process")
+        return False
+    _otel_tracer = otel_trace.get_tracer(tracer_name)
+    return True
+
+class QueryTrace:
+    """Timing spans and counters for one pass through the query pipeline"""
+    def __init__(self, name="query_rag"):
+        self.name = name
+        self.start_ns = time.time_ns()
+        self._t0 = time.perf_counter()
+        self.spans = []
+        self.counters = {}
+        self.attributes = {}
+        self.total_ms = None
+
+    @contextmanager
+    def span(self, stage):
+        """Time a pipeline stage"""
+        start_ns = time.time_ns()
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_span(stage, (time.perf_counter() - t0) * 1000, start_ns)
+
+    def add_span(self, stage, duration_ms, start_ns=None):
+        """Record an already measured stage"""
+        self.spans.append({
+            "stage": stage,
+            "ms": round(duration_ms, 3),
+            "start_ns": start_ns if start_ns is not None else time.time_ns() - int(duration_ms * 1e6)
+        })
+
+    def count(self, name, value=1):
+        """Increase a per-query counter such as token usage or cache hits"""
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def timings(self):
+        """Stage durations in milliseconds"""
+        timings = {}
+        for span in self.spans:
+            timings[span["stage"]] = timings.get(span["stage"], 0.0) + span["ms"]
+        return timings
+
+    def to_dict(self):
+        """Serializable view of the trace"""
+        return {
+            "name": self.name,
+            "total_ms": self.total_ms,
+            "timings_ms": self.timings(),
+            "counters": dict(self.counters),
+            "attributes": dict(self.attributes)
+        }
+
+    def finish(self):
+        """Close the trace and export it to the metrics registry, JSON logs and OpenTelemetry"""
+        if self.total_ms is not None:
+            return self
+        self.total_ms = round((time.perf_counter() - self._t0) * 1000, 3)
+
+        METRICS.observe(f"{self.name}.total_ms", self.total_ms)
+        for stage, ms in self.timings().items():
+            METRICS.observe(f"{self.name}.{stage}_ms", ms)
+        for name, value in self.counters.items():
+            METRICS.incr(f"{self.name}.{name}", value)
+
+        if trace_logger.isEnabledFor(logging.INFO):
+            trace_logger.info(self.name, extra={"trace": self.to_dict()})
+        if _otel_tracer is not None:
+            self._export_otel()
+        return self
+
+    def _export_otel(self):
+        """Replay the recorded spans as OpenTelemetry spans under one root span"""
+        from opentelemetry import trace as otel_trace
+
+        end_ns = self.start_ns + int(self.total_ms * 1e6)
+        root = _otel_tracer.start_span(self.name, start_time=self.start_ns)
+        for key, value in {**self.attributes, **self.counters}.items():
+            root.set_attribute(f"ragpsy.{key}", value if isinstance(value, (int, float, bool)) else str(value))
+        context = otel_trace.set_span_in_context(root)
+        for span in self.spans:
+            child = _otel_tracer.start_span(span["stage"], context=context, start_time=span["start_ns"])
+            child.end(end_time=span["start_ns"] + int(span["ms"] * 1e6))
+        root.end(end_time=end_ns)
+
+# Opt-in profiling, enabled with RAGPSY_PROFILE=1 or the --profile flag
+PROFILE_SETTINGS = {
+    "enabled": os.getenv("RAGPSY_PROFILE", "").lower() in ("1", "true", "yes"),
+    "output_dir": os.getenv("RAGPSY_PROFILE_DIR", "profiles"),
+    "sample_interval_ms": 5,   # Sampling period for the flame-graph stack sampler
+    "top_allocations": 25      # Allocation sites listed per stage
+}
+
+_profile_state = threading.local()
+_cprofile_lock = threading.Lock()
+
+class StackSampler:
+    """Periodically sample all thread stacks into collapsed (flame-graph) format"""
+    def __init__(self, interval_ms=5):
+        self.interval = interval_ms / 1000.0
+        self.stacks = Counter()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="ragpsy-sampler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self):
+        own_id = threading.get_ident()
+        names = {}
+        while not self._stop.wait(self.interval):
+            if len(names) != threading.active_count():
+                names = {t.ident: t.name for t in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                frames = []
+                while frame is not None:
+                    code = frame.f_code
+                    frames.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                    frame = frame.f_back
+                frames.append(names.get(thread_id, str(thread_id)))
+                self.stacks[";".join(reversed(frames))] += 1
+
+    def write_folded(self, path):
+        """Write stacks as 'frame;frame;frame count' lines for flamegraph.pl or speedscope"""
+        with open(path, "w") as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+
+def _write_allocation_report(path, stage, before, after, limit):
+    """Write the top allocation sites that grew between two tracemalloc snapshots"""
+    # Leave out the profilers' own bookkeeping
+    ignore = [tracemalloc.Filter(False, cProfile.__file__), tracemalloc.Filter(False, tracemalloc.__file__)]
+    stats = after.filter_traces(ignore).compare_to(before.filter_traces(ignore), "lineno")
+    total = sum(stat.size_diff for stat in stats)
+    with open(path, "w") as f:
+        f.write(f"Top allocation sites for {stage} (net {total / 1024:.1f} KiB)\n")
+        for stat in stats[:limit]:
+            f.write(f"{stat}\n")
+    return total
+
+@contextmanager
+def profile_stage(stage):
+    """Capture CPU profile, sampled stacks and allocation sites for one pipeline stage"""
+    if not PROFILE_SETTINGS["enabled"]:
+        yield
+        return
+
+    output_dir = PROFILE_SETTINGS["output_dir"]
+    os.makedirs(output_dir, exist_ok=True)
+    base = os.path.join(output_dir, f"{stage}-{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}-{threading.get_ident()}")
+
+    if not tracemalloc.is_tracing():
+        tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    t0 = time.perf_counter()
+
+    # Nested stages only add an allocation report; the outer stage owns the CPU profilers
+    outer = not getattr(_profile_state, "active", False)
+    profiler = sampler = None
+    if outer and _cprofile_lock.acquire(blocking=False):
+        _profile_state.active = True
+        profiler = cProfile.Profile()
+        sampler = StackSampler(PROFILE_SETTINGS["sample_interval_ms"])
+        sampler.start()
+        profiler.enable()
+
+    try:
+        yield
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            sampler.stop()
+        after = tracemalloc.take_snapshot()
+
+        if profiler is not None:
+            _profile_state.active = False
+            _cprofile_lock.release()
+            profiler.dump_stats(f"{base}.prof")
+            sampler.write_folded(f"{base}.folded")
+
+        net = _write_allocation_report(f"{base}.alloc.txt", stage, before, after, PROFILE_SETTINGS["top_allocations"])
+        logger.info(
+            f"Profiled {stage}: {time.perf_counter() - t0:.3f}s, net allocations {net / 1024:.1f} KiB, "
+            f"reports at {base}.*"
+        )
+
+def profiled(stage):
+    """Decorator that profiles the wrapped function when profiling is enabled"""
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not PROFILE_SETTINGS["enabled"]:
+                return fn(*args, **kwargs)
+            with profile_stage(stage):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+QUANT_COLUMNS = ['student_id', 'gender', 'first_gen_student', 'international_student',
+                 'midterm_grade', 'final_exam', 'study_hours_per_week', 'attendance_rate']
+QUAL_COLUMNS = ['student_id', 'course_review', 'learning_outcomes_assessment']
+
+# Low-cardinality demographic columns are stored as categories
+CATEGORICAL_COLUMNS = ['gender', 'first_gen_student', 'international_student']
+NUMERIC_COLUMNS = ['midterm_grade', 'final_exam', 'study_hours_per_week', 'attendance_rate']
+
+# The merged, typed dataset is cached as Parquet next to the CSVs (or in RAGPSY_DATASET_CACHE_DIR)
+DATASET_CACHE_SETTINGS = {
+    "enabled": os.getenv("RAGPSY_DATASET_CACHE", "1") != "0",
+    "dir": os.getenv("RAGPSY_DATASET_CACHE_DIR")
+}
+
+DATASET_CACHE_VERSION = 1
+
+def _dataset_cache_path(data_path, name="students", ext="parquet"):
+    """Cache file derived from one data directory, the merged dataset by default"""
+    if DATASET_CACHE_SETTINGS["dir"]:
+        import hashlib
+
+        digest = hashlib.sha1(os.path.abspath(data_path).encode("utf-8")).hexdigest()[:16]
+        return os.path.join(DATASET_CACHE_SETTINGS["dir"], f"{name}-{digest}.{ext}")
+    return os.path.join(data_path, ".ragpsy_cache", f"{name}.{ext}")
+
+def _type_student_frame(df):
+    """Categories for demographics and the smallest numeric type that holds each score column"""
+    import pandas as pd
+
+    for col in CATEGORICAL_COLUMNS:
+        df[col] = df[col].astype("category")
+    for col in NUMERIC_COLUMNS:
+        values = pd.to_numeric(df[col], errors='coerce')
+        if values.notna().all() and (values % 1 == 0).all():
+            df[col] = pd.to_numeric(values, downcast='integer')
+        else:
+            df[col] = values.astype('float32')
+    return df
+
+def _read_dataset_cache(path, fingerprint, columns):
+    """Read the cached dataset if it was built from the current CSVs, else None"""
+    import pyarrow.parquet as pq
+
+    if not os.path.exists(path):
+        return None
+    try:
+        metadata = pq.read_schema(path).metadata or {}
+        cached = json.loads(metadata.get(b"ragpsy.source", b"null"))
+        if cached != {"version": DATASET_CACHE_VERSION, "source": fingerprint}:
+            return None
+        return pq.read_table(path, columns=columns).to_pandas()
+    except Exception as e:
+        logger.warning(f"Ignoring unreadable dataset cache {path}: {str(e)}")
+        return None
+
+def _write_dataset_cache(path, df, fingerprint):
+    """Write the merged dataset as Parquet, replacing any older cache atomically"""
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    source = json.dumps({"version": DATASET_CACHE_VERSION, "source": fingerprint})
+    table = table.replace_schema_metadata({**(table.schema.metadata or {}), b"ragpsy.source": source.encode()})
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.tmp-{os.getpid()}"
+        pq.write_table(table, tmp_path)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        # A read-only data directory only costs the cache
+        logger.warning(f"Could not write dataset cache {path}: {str(e)}")
+
+@profiled("load_data")
+def load_data(data_path, columns=None):
+    """Load and merge relevant data from CSV files
+
+    The merged, typed dataset is cached as Parquet and reused while the CSV
+    files are unchanged (requires pyarrow). columns limits the result, and the
+    cached read, to the named columns.
+    """
+    import pandas as pd
+
+    try:
+        cache_path = None
+        if DATASET_CACHE_SETTINGS["enabled"]:
+            try:
+                import pyarrow  # noqa: F401
+                fingerprint = _source_fingerprint(data_path)
+                cache_path = _dataset_cache_path(data_path)
+            except ImportError:
+                logger.debug("pyarrow is not installed, reading the CSV files")
+            except OSError:
+                # Let read_csv report missing files
+                pass
+        if cache_path is not None:
+            df = _read_dataset_cache(cache_path, fingerprint, columns)
+            if df is not None:
+                logger.info(f"Loaded {len(df)} student records from {cache_path}")
+                return df
+
+        # Load datasets with only the columns we need
+        quant_df = pd.read_csv(os.path.join(data_path, 'psych101-quantitative.csv'), usecols=QUANT_COLUMNS)
+        qual_df = pd.read_csv(os.path.join(data_path, 'psych101-qualitative.csv'), usecols=QUAL_COLUMNS)
         
         # Merge datasets
-        merged_df = pd.merge(quant_df, qual_df, on='student_id')
-        print(f"Loaded {len(merged_df)} student records")
+        merged_df = _type_student_frame(pd.merge(quant_df[QUANT_COLUMNS], qual_df[QUAL_COLUMNS], on='student_id'))
+        logger.info(f"Loaded {len(merged_df)} student records")
+
+        if cache_path is not None:
+            _write_dataset_cache(cache_path, merged_df, fingerprint)
         
-        return merged_df
+        return merged_df[columns] if columns is not None else merged_df
         
     except Exception as e:
-        print(f"Error loading data: {str(e)}")
+        logger.error(f"Error loading data: {str(e)}")
+        return None
+
+# Plots are drawn from binned aggregates, so rendering cost depends on the bin count, not the cohort size
+PLOT_COLUMNS = ['gender', 'international_student', 'final_exam', 'study_hours_per_week', 'attendance_rate']
+PLOT_SETTINGS = {"bins": 40, "box_bins": 10}
+PLOT_CACHE_VERSION = 1
+
+def _plot_edges(values, bins):
+    """Bin edges covering values: one bin per integer when that fits, else bins equal-width bins"""
+    import numpy as np
+
+    low, high = (float(values.min()), float(values.max())) if len(values) else (0.0, 1.0)
+    if np.all(values % 1 == 0) and high - low < bins:
+        return np.arange(low - 0.5, high + 1.0, 1.0)
+    if high == low:
+        high = low + 1.0
+    return np.linspace(low, high, bins + 1)
+
+def _bin_index(values, edges):
+    """Bin number of each value; the last bin includes the upper edge"""
+    import numpy as np
+
+    return np.clip(np.searchsorted(edges, values, side="right") - 1, 0, len(edges) - 2)
+
+def _group_codes(df, columns):
+    """Integer code of each row's combination of categorical columns (-1 if any is missing) and the labels"""
+    import numpy as np
+    import pandas as pd
+
+    codes = np.zeros(len(df), dtype=np.int64)
+    labels = [""]
+    for col in columns:
+        values = pd.Categorical(df[col])
+        col_codes = np.asarray(values.codes, dtype=np.int64)
+        codes = np.where((codes < 0) | (col_codes < 0), -1, codes * len(values.categories) + col_codes)
+        labels = [f"{label} / {category}" if label else str(category)
+                  for label in labels for category in values.categories]
+    return codes, labels
+
+def _grouped_box_stats(codes, values, groups):
+    """Quartiles and 1.5 IQR whiskers of values per group code, from one sort"""
+    import numpy as np
+
+    order = np.lexsort((values, codes))
+    codes, values = codes[order], values[order]
+    counts = np.bincount(codes, minlength=groups)
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    present = counts > 0
+    last = np.maximum(len(values) - 1, 0)
+    if not len(values):
+        values = np.zeros(1)
+
+    def quantile(q):
+        # Linear interpolation between order statistics, as numpy.quantile does
+        position = starts + q * np.maximum(counts - 1, 0)
+        below = np.minimum(np.floor(position).astype(np.int64), last)
+        above = np.minimum(np.minimum(below + 1, starts + counts - 1), last)
+        fraction = position - np.floor(position)
+        return np.where(present, values[below] * (1 - fraction) + values[above] * fraction, np.nan)
+
+    q1, median, q3 = quantile(0.25), quantile(0.5), quantile(0.75)
+    iqr = q3 - q1
+    # Whiskers end at the most extreme values inside the fences
+    inside_low = np.where(values >= (q1 - 1.5 * iqr)[codes], values, np.inf)
+    inside_high = np.where(values <= (q3 + 1.5 * iqr)[codes], values, -np.inf)
+    whislo, whishi = np.full(groups, np.nan), np.full(groups, np.nan)
+    if present.any():
+        whislo[present] = np.minimum.reduceat(inside_low, starts[present])
+        whishi[present] = np.maximum.reduceat(inside_high, starts[present])
+    return {"count": counts, "q1": q1, "med": median, "q3": q3, "whislo": whislo, "whishi": whishi}
+
+def compute_plot_aggregates(df, bins=None, box_bins=None):
+    """Binned counts and box statistics behind the visualization example
+
+    - grade_distribution: final exam histogram per gender
+    - study_hours: study hours x final exam 2D histogram per gender and student type
+    - attendance_exam: final exam box statistics per attendance bin
+    - attendance_by_type: attendance box statistics per student type
+    Every array is sized by the bins and groups, whatever the number of rows.
+    """
+    import numpy as np
+
+    bins = bins or PLOT_SETTINGS["bins"]
+    box_bins = box_bins or PLOT_SETTINGS["box_bins"]
+    exam = df['final_exam'].to_numpy(dtype=np.float64, na_value=np.nan)
+    hours = df['study_hours_per_week'].to_numpy(dtype=np.float64, na_value=np.nan)
+    attendance = df['attendance_rate'].to_numpy(dtype=np.float64, na_value=np.nan)
+
+    gender, gender_labels = _group_codes(df, ['gender'])
+    keep = (gender >= 0) & ~np.isnan(exam)
+    exam_edges = _plot_edges(exam[keep], bins)
+    cells = gender[keep] * (len(exam_edges) - 1) + _bin_index(exam[keep], exam_edges)
+    grade_distribution = {
+        "edges": exam_edges,
+        "groups": np.array(gender_labels),
+        "counts": np.bincount(cells, minlength=len(gender_labels) * (len(exam_edges) - 1))
+        .reshape(len(gender_labels), -1)
+    }
+
+    student_type, type_labels = _group_codes(df, ['gender', 'international_student'])
+    keep = (student_type >= 0) & ~np.isnan(exam) & ~np.isnan(hours)
+    hour_edges = _plot_edges(hours[keep], bins)
+    exam_edges = _plot_edges(exam[keep], bins)
+    shape = (len(type_labels), len(hour_edges) - 1, len(exam_edges) - 1)
+    cells = np.ravel_multi_index(
+        (student_type[keep], _bin_index(hours[keep], hour_edges), _bin_index(exam[keep], exam_edges)), shape
+    )
+    study_hours = {
+        "x_edges": hour_edges,
+        "y_edges": exam_edges,
+        "groups": np.array(type_labels),
+        "counts": np.bincount(cells, minlength=int(np.prod(shape))).reshape(shape)
+    }
+
+    keep = ~np.isnan(exam) & ~np.isnan(attendance)
+    attendance_edges = _plot_edges(attendance[keep], box_bins)
+    attendance_exam = {
+        "edges": attendance_edges,
+        **_grouped_box_stats(_bin_index(attendance[keep], attendance_edges), exam[keep], len(attendance_edges) - 1)
+    }
+
+    international, international_labels = _group_codes(df, ['international_student'])
+    keep = (international >= 0) & ~np.isnan(attendance)
+    attendance_by_type = {
+        "groups": np.array(international_labels),
+        **_grouped_box_stats(international[keep], attendance[keep], len(international_labels))
+    }
+
+    return {
+        "students": len(df),
+        "grade_distribution": grade_distribution,
+        "study_hours": study_hours,
+        "attendance_exam": attendance_exam,
+        "attendance_by_type": attendance_by_type
+    }
+
+def _read_plot_cache(path, source):
+    """Aggregates saved for the same data and settings, else None"""
+    import numpy as np
+
+    if not os.path.exists(path):
+        return None
+    try:
+        with np.load(path, allow_pickle=False) as saved:
+            if json.loads(str(saved["source"])) != source:
+                return None
+            aggregates = {"students": int(saved["students"])}
+            for key in saved.files:
+                if "." in key:
+                    plot, field = key.split(".", 1)
+                    aggregates.setdefault(plot, {})[field] = saved[key]
+            return aggregates
+    except Exception as e:
+        logger.warning(f"Ignoring unreadable plot cache {path}: {str(e)}")
         return None
 
+def _write_plot_cache(path, aggregates, source):
+    """Save aggregates as one .npz file, replacing any older cache atomically"""
+    import numpy as np
+
+    arrays = {f"{plot}.{field}": value for plot, fields in aggregates.items() if isinstance(fields, dict)
+              for field, value in fields.items()}
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.tmp-{os.getpid()}.npz"
+        np.savez(tmp_path, source=np.array(json.dumps(source)), students=np.array(aggregates["students"]), **arrays)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        logger.warning(f"Could not write plot cache {path}: {str(e)}")
+
+def load_plot_aggregates(data_path, bins=None, box_bins=None):
+    """Plot aggregates for a data directory, cached next to the dataset cache while the CSVs are unchanged
+
+    Only PLOT_COLUMNS are loaded, so no embeddings, index or LLM are needed.
+    Returns None if the data cannot be loaded.
+    """
+    bins = bins or PLOT_SETTINGS["bins"]
+    box_bins = box_bins or PLOT_SETTINGS["box_bins"]
+    path = source = None
+    if DATASET_CACHE_SETTINGS["enabled"]:
+        try:
+            source = {"version": PLOT_CACHE_VERSION, "source": _source_fingerprint(data_path),
+                      "bins": bins, "box_bins": box_bins}
+            path = _dataset_cache_path(data_path, "plot_aggregates", "npz")
+        except OSError:
+            pass
+    if path is not None:
+        aggregates = _read_plot_cache(path, source)
+        if aggregates is not None:
+            METRICS.incr("plot_cache.hit")
+            return aggregates
+        METRICS.incr("plot_cache.miss")
+
+    df = load_data(data_path, columns=PLOT_COLUMNS)
+    if df is None:
+        return None
+    aggregates = compute_plot_aggregates(df, bins, box_bins)
+    if path is not None:
+        _write_plot_cache(path, aggregates, source)
+    return aggregates
+
+def compute_dataset_statistics(df):
+    """Precompute summary statistics used to answer questions without the LLM"""
+    import pandas as pd
+
+    numeric_cols = ['midterm_grade', 'final_exam', 'study_hours_per_week', 'attendance_rate']
+    group_cols = ['gender', 'international_student', 'first_gen_student']
+
+    stats = {"student_count": len(df), "overall": {}, "groups": {}}
+    for col in numeric_cols:
+        values = pd.to_numeric(df[col], errors='coerce')
+        stats["overall"][col] = {
+            "mean": round(float(values.mean()), 1),
+            "min": round(float(values.min()), 1),
+            "max": round(float(values.max()), 1)
+        }
+
+    for col in group_cols:
+        grouped = df.groupby(col)[['final_exam', 'study_hours_per_week']].mean()
+        counts = df[col].value_counts()
+        stats["groups"][col] = {
+            str(group): {
+                "count": int(counts[group]),
+                "final_exam_mean": round(float(row['final_exam']), 1),
+                "study_hours_mean": round(float(row['study_hours_per_week']), 1)
+            }
+            for group, row in grouped.iterrows()
+        }
+
+    return stats
+
+def format_dataset_statistics(stats):
+    """Render precomputed dataset statistics as plain text"""
+    if not stats:
+        return "Dataset statistics are not available."
+
+    lines = [f"Students in dataset: {stats['student_count']}"]
+    for col, values in stats["overall"].items():
+        lines.append(f"- {col}: mean {values['mean']}, range {values['min']}-{values['max']}")
+    for col, groups in stats["groups"].items():
+        lines.append(f"By {col}:")
+        for group, values in groups.items():
+            lines.append(
+                f"- {group} (n={values['count']}): final exam mean {values['final_exam_mean']}, "
+                f"study hours mean {values['study_hours_mean']}"
+            )
+    return "\n".join(lines)
+
 def create_student_documents(df):
     """Create text documents for each student"""
     documents = []
@@ -51,255 +732,3702 @@ def create_student_documents(df):
         - First Generation Student: {row['first_gen_student']}
         - International Student: {row['international_student']}
 
-        Academic Performance:
-        - Midterm Grade: {row['midterm_grade']}
-        - Final Exam: {row['final_exam']}
-        - Study Hours per Week: {row['study_hours_per_week']}
-        - Attendance Rate: {row['attendance_rate']}
+        Academic Performance:
+        - Midterm Grade: {row['midterm_grade']}
+        - Final Exam: {row['final_exam']}
+        - Study Hours per Week: {row['study_hours_per_week']}
+        - Attendance Rate: {row['attendance_rate']}
+
+        Student Feedback:
+        {row['course_review']}
+
+        Learning Assessment:
+        {row['learning_outcomes_assessment']}
+        """
+        
+        # Create focused metadata
+        metadata = {
+            'student_id': row['student_id'],
+            'international_student': row['international_student'],
+            'first_gen_student': row['first_gen_student'],
+            'final_exam': float(row['final_exam'])
+        }
+        
+        documents.append({"content": doc_text.strip(), "metadata": metadata})
+    
+    return documents
+
+# Chunking, retrieval depth and index type; tune_retrieval writes measured values to the retrieval config
+RETRIEVAL_SETTINGS = {
+    "chunk_size": 500,
+    "chunk_overlap": 50,
+    "k": 3,               # chunks retrieved for a question
+    "comparative_k": 6,   # comparisons need records from every group
+    "index": "flat",      # "flat" (exact) or "hnsw" (approximate graph search)
+    "hnsw_m": 32,
+    "hnsw_ef_search": 64,
+    "diversify": True,    # one chunk per student, chosen by maximal marginal relevance
+    "mmr_fetch_factor": 4,  # candidates fetched per returned chunk before diversifying
+    "mmr_lambda": 0.7     # 1.0 ranks by relevance only, lower values favor varied students
+}
+INDEX_TYPES = ("flat", "hnsw")
+RETRIEVAL_CONFIG_SETTINGS = {
+    "path": os.getenv("RAGPSY_RETRIEVAL_CONFIG", "ragpsy_retrieval.json")
+}
+
+def load_retrieval_config(path=None):
+    """Apply the settings of a config written by tune_retrieval; returns whether one was applied"""
+    path = path or RETRIEVAL_CONFIG_SETTINGS["path"]
+    if not os.path.exists(path):
+        return False
+    try:
+        with open(path) as f:
+            settings = json.load(f)["settings"]
+        if settings.get("index", "flat") not in INDEX_TYPES:
+            raise ValueError(f"unknown index type {settings['index']!r}")
+    except (OSError, ValueError, KeyError, TypeError) as e:
+        logger.warning(f"Ignoring retrieval config {path}: {str(e)}")
+        return False
+    RETRIEVAL_SETTINGS.update({key: value for key, value in settings.items() if key in RETRIEVAL_SETTINGS})
+    logger.info(f"Loaded retrieval settings from {path}")
+    return True
+
+@profiled("split_student_documents")
+def split_student_documents(documents, chunk_size=None, chunk_overlap=None):
+    """Split student documents into chunks, repeating each student's metadata per chunk"""
+    from langchain_text_splitters import RecursiveCharacterTextSplitter
+
+    chunk_size = chunk_size or RETRIEVAL_SETTINGS["chunk_size"]
+    if chunk_overlap is None:
+        chunk_overlap = RETRIEVAL_SETTINGS["chunk_overlap"]
+
+    # Set up text splitter with optimized settings
+    text_splitter = RecursiveCharacterTextSplitter(
+        chunk_size=chunk_size,        # Smaller chunks for more focused retrieval
+        chunk_overlap=chunk_overlap,  # Reduced overlap
+        separators=["\n\n", "\n", ". ", " ", ""],  # More granular splitting
+        length_function=len
+    )
+    
+    # Split documents
+    texts = []
+    metadatas = []
+    for doc in documents:
+        chunks = text_splitter.split_text(doc["content"])
+        texts.extend(chunks)
+        metadatas.extend([doc["metadata"]] * len(chunks))
+
+    return texts, metadatas
+
+# Offline clustering of course reviews used to answer "common themes" questions
+THEME_SETTINGS = {
+    "enabled": True,
+    "clusters": 8,
+    "iterations": 20,
+    "snippets": 3,
+    "keywords": 8,
+    "keyword_sample": 2000,  # Reviews per cluster scanned for keywords
+    "seed": 42
+}
+
+THEME_GROUP_FIELDS = ['gender', 'international_student', 'first_gen_student']
+
+THEME_STOPWORDS = set("""
+a about after all also am an and any are as at be been before being but by can could course did do
+does during each even for from had has have having he her how i if in into is it its just made make
+me more most much my no not of on one only or other our out over really she so some such than that
+the their them then there these they this those through to too up very was we well were what when
+which while who will with would you your class psychology
+""".split())
+
+_THEME_PATTERN = re.compile(
+    r"\b(themes?|topics|recurring|mention(?:s|ed)?|"
+    r"(?:common|frequent|main|typical|shared)\s+(?:\w+\s+)?"
+    r"(?:challenges|complaints|issues|concerns|problems|praise|feedback|experiences))\b"
+)
+
+_THEME_GROUP_PATTERNS = [
+    (re.compile(r"\binternational\b"), 'international_student', 'Yes'),
+    (re.compile(r"\bdomestic\b"), 'international_student', 'No'),
+    (re.compile(r"\bfirst[- ]gen(?:eration)?\b"), 'first_gen_student', 'Yes'),
+    (re.compile(r"\b(?:female|women)\b"), 'gender', 'Female'),
+    (re.compile(r"\b(?:male|men)\b"), 'gender', 'Male'),
+    (re.compile(r"\bnon-?binary\b"), 'gender', 'Non-binary'),
+]
+
+_THEME_WORD_PATTERN = re.compile(r"[a-z][a-z'-]{2,}")
+
+def _theme_keywords(cluster_texts, document_frequency, documents, limit):
+    """Words over-represented in a cluster compared with all reviews"""
+    counts = Counter()
+    for text in cluster_texts:
+        counts.update(
+            word for word in set(_THEME_WORD_PATTERN.findall(text.lower()))
+            if word not in THEME_STOPWORDS
+        )
+    total = max(len(cluster_texts), 1)
+    scores = {
+        word: (count / total) * math.log(documents / (1 + document_frequency[word]))
+        for word, count in counts.items() if count > 1
+    }
+    return [word for word, _ in sorted(scores.items(), key=lambda item: -item[1])[:limit]]
+
+def _snippet(text, limit=300):
+    """Shorten a review at a word boundary"""
+    if len(text) <= limit:
+        return text
+    return text[:limit].rsplit(" ", 1)[0] + "..."
+
+@profiled("compute_theme_clusters")
+def compute_theme_clusters(texts, vectors, groups=None, settings=None):
+    """Cluster review embeddings with k-means and summarize each cluster
+
+    groups maps a demographic field to one value per text; cluster sizes are
+    counted per value so theme questions about a group need no retrieval.
+    """
+    import numpy as np
+    import faiss
+
+    settings = {**THEME_SETTINGS, **(settings or {})}
+    vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+    # Small cohorts get fewer clusters so each theme has several reviews
+    clusters = min(settings["clusters"], len(texts) // 3)
+    if clusters < 1:
+        return None
+
+    kmeans = faiss.Kmeans(vectors.shape[1], clusters, niter=settings["iterations"],
+                          seed=settings["seed"], verbose=False)
+    kmeans.train(vectors)
+    distances, assignments = kmeans.index.search(vectors, 1)
+    distances, assignments = distances[:, 0], assignments[:, 0]
+
+    # Document frequencies over a sample of all reviews weight the cluster keywords
+    rng = np.random.default_rng(settings["seed"])
+    document_frequency = Counter()
+    sample = rng.choice(len(texts), size=min(len(texts), settings["keyword_sample"] * clusters), replace=False)
+    for i in sample:
+        document_frequency.update(set(_THEME_WORD_PATTERN.findall(texts[i].lower())))
+
+    groups = groups or {}
+    summaries = []
+    for cluster in range(clusters):
+        members = np.flatnonzero(assignments == cluster)
+        if len(members) == 0:
+            continue
+        # Reviews closest to the centroid represent the cluster
+        closest = members[np.argsort(distances[members])]
+        snippets = []
+        for i in closest:
+            if texts[i] not in snippets:
+                snippets.append(texts[i])
+            if len(snippets) == settings["snippets"]:
+                break
+        keyword_members = members if len(members) <= settings["keyword_sample"] else rng.choice(
+            members, size=settings["keyword_sample"], replace=False)
+
+        summaries.append({
+            "size": int(len(members)),
+            "keywords": _theme_keywords([texts[i] for i in keyword_members], document_frequency,
+                                        len(sample), settings["keywords"]),
+            "snippets": [_snippet(snippet) for snippet in snippets],
+            "groups": {
+                field: {str(value): int(count) for value, count in
+                        Counter(values[i] for i in members).most_common()}
+                for field, values in groups.items()
+            }
+        })
+
+    summaries.sort(key=lambda summary: -summary["size"])
+    return {
+        "review_count": len(texts),
+        "clusters": summaries,
+        "groups": {field: {str(value): int(count) for value, count in Counter(values).most_common()}
+                   for field, values in groups.items()}
+    }
+
+def format_theme_clusters(themes, group=None):
+    """Render theme clusters as prompt context, optionally focused on one demographic group"""
+    if group:
+        field, value = group
+        group_total = themes["groups"].get(field, {}).get(value, 0)
+        lines = [f"Reviews from students with {field} = {value}: {group_total} "
+                 f"of {themes['review_count']} in the cohort"]
+    else:
+        lines = [f"Reviews in the cohort: {themes['review_count']}"]
+
+    for number, cluster in enumerate(themes["clusters"], 1):
+        if group:
+            count = cluster["groups"].get(field, {}).get(value, 0)
+            if not count:
+                continue
+            share = f"{count} of {group_total} group reviews ({100 * count / max(group_total, 1):.0f}%)"
+        else:
+            share = f"{cluster['size']} reviews ({100 * cluster['size'] / themes['review_count']:.0f}%)"
+        lines.append(f"\nTheme {number}: {share}")
+        lines.append(f"Keywords: {', '.join(cluster['keywords'])}")
+        for snippet in cluster["snippets"]:
+            lines.append(f"- \"{snippet}\"")
+    return "\n".join(lines)
+
+def is_theme_question(question):
+    """Detect questions about common themes across student feedback"""
+    return bool(_THEME_PATTERN.search(question.lower()))
+
+def theme_question_group(question, filter_metadata=None):
+    """Demographic group a theme question is about, or False if the clusters cannot answer it
+
+    Returns None for the whole cohort, a (field, value) pair for one group, and
+    False when the filter goes beyond a single precomputed group.
+    """
+    groups = []
+    for field, condition in (filter_metadata or {}).items():
+        if field not in THEME_GROUP_FIELDS or isinstance(condition, (dict, list, tuple, set)):
+            return False
+        groups.append((field, str(condition)))
+
+    question_lower = question.lower()
+    for pattern, field, value in _THEME_GROUP_PATTERNS:
+        if pattern.search(question_lower) and (field, value) not in groups:
+            groups.append((field, value))
+
+    if len(groups) > 1:
+        return False
+    return groups[0] if groups else None
+
+def embed_reviews(df, embeddings, batch_size=4096):
+    """Embed every non-empty course review; returns the review rows, texts and vectors"""
+    import numpy as np
+
+    reviews = df['course_review']
+    rows = np.flatnonzero(reviews.notna().to_numpy())
+    texts = [str(text) for text in reviews.iloc[rows]]
+    vectors = np.concatenate([
+        np.asarray(embeddings.embed_documents(texts[start:start + batch_size]), dtype=np.float32)
+        for start in range(0, len(texts), batch_size)
+    ]) if texts else np.empty((0, 1), dtype=np.float32)
+    return rows, texts, vectors
+
+def build_theme_clusters(vectorstore, df, embeddings, review_vectors=None):
+    """Cluster every student's course review, reusing the index vectors when reviews have their own
+
+    review_vectors can hold embeddings computed elsewhere (e.g. by ingest workers)
+    for the non-empty reviews of df, in row order.
+    """
+    import numpy as np
+
+    docstore = vectorstore.docstore
+    columns = getattr(vectorstore, "metadata_columns", None)
+    if (getattr(vectorstore, "indexing_mode", "chunks") == "fields"
+            and columns is not None and columns.num_rows == len(df)):
+        # Review vectors are already in the index, one per student row
+        code = docstore.section_names.index('course_review')
+        positions = np.flatnonzero(docstore.section_codes == code)
+        vectors = vectorstore.index.reconstruct_batch(positions)
+        texts = [docstore.texts[i] for i in positions]
+        rows = columns.row_index[positions]
+    elif review_vectors is not None:
+        rows = np.flatnonzero(df['course_review'].notna().to_numpy())
+        texts = [str(text) for text in df['course_review'].iloc[rows]]
+        vectors = review_vectors
+    else:
+        rows, texts, vectors = embed_reviews(df, embeddings)
+
+    groups = {field: df[field].astype(str).to_numpy()[rows] for field in THEME_GROUP_FIELDS}
+    return compute_theme_clusters(texts, vectors, groups)
+
+INDEXING_MODES = ("chunks", "fields")
+
+# Free-text fields embedded as their own vectors in "fields" indexing mode
+INDEX_FIELDS = ['course_review', 'learning_outcomes_assessment']
+
+@profiled("create_field_documents")
+def create_field_documents(df):
+    """Create one text per free-text field of each student, with structured fields as metadata"""
+    texts, metadatas, sections = [], [], []
+    columns = ['student_id', 'gender', 'international_student', 'first_gen_student',
+               'study_hours_per_week', 'attendance_rate', 'midterm_grade', 'final_exam']
+
+    for record in df[columns + INDEX_FIELDS].to_dict("records"):
+        metadata = {
+            'student_id': record['student_id'],
+            'gender': record['gender'],
+            'international_student': record['international_student'],
+            'first_gen_student': record['first_gen_student'],
+            'study_hours_per_week': float(record['study_hours_per_week']),
+            'attendance_rate': float(record['attendance_rate']),
+            'midterm_grade': float(record['midterm_grade']),
+            'final_exam': float(record['final_exam'])
+        }
+        for field in INDEX_FIELDS:
+            text = record[field]
+            if isinstance(text, str) and text.strip():
+                texts.append(text.strip())
+                metadatas.append(metadata)
+                sections.append(field)
+
+    return texts, metadatas, sections
+
+def format_student_document(metadata, fields):
+    """Render a student's structured metadata and free-text fields like create_student_documents"""
+    def number(value):
+        return f"{value:g}" if isinstance(value, float) else value
+
+    return f"""Student Demographics:
+        - Gender: {metadata.get('gender')}
+        - First Generation Student: {metadata.get('first_gen_student')}
+        - International Student: {metadata.get('international_student')}
+
+        Academic Performance:
+        - Midterm Grade: {number(metadata.get('midterm_grade'))}
+        - Final Exam: {number(metadata.get('final_exam'))}
+        - Study Hours per Week: {number(metadata.get('study_hours_per_week'))}
+        - Attendance Rate: {number(metadata.get('attendance_rate'))}
+
+        Student Feedback:
+        {fields.get('course_review', '')}
+
+        Learning Assessment:
+        {fields.get('learning_outcomes_assessment', '')}"""
+
+EMBEDDING_MODEL = "sentence-transformers/all-MiniLM-L6-v2"
+EMBEDDING_BACKENDS = ("torch", "onnx")
+
+# "onnx" runs an exported (optionally int8-quantized) copy of EMBEDDING_MODEL with onnxruntime
+EMBEDDING_SETTINGS = {
+    "backend": os.getenv("RAGPSY_EMBEDDING_BACKEND", "torch"),
+    "onnx_model_dir": os.getenv("RAGPSY_ONNX_MODEL_DIR"),
+    "quantized": os.getenv("RAGPSY_ONNX_QUANTIZED", "1") != "0",
+    "batch_size": 64,
+    "max_length": 256,  # the model's max_seq_length
+    "threads": int(os.getenv("RAGPSY_ONNX_THREADS", "0"))  # 0 lets onnxruntime decide
+}
+
+def create_embeddings(backend=None):
+    """Create the sentence-transformer embedding model used for indexing and queries"""
+    backend = backend or EMBEDDING_SETTINGS["backend"]
+    if backend == "onnx":
+        if not EMBEDDING_SETTINGS["onnx_model_dir"]:
+            raise ValueError("The onnx embedding backend needs RAGPSY_ONNX_MODEL_DIR; create one with --export-onnx")
+        return OnnxEmbeddings(
+            EMBEDDING_SETTINGS["onnx_model_dir"],
+            quantized=EMBEDDING_SETTINGS["quantized"],
+            batch_size=EMBEDDING_SETTINGS["batch_size"],
+            max_length=EMBEDDING_SETTINGS["max_length"],
+            threads=EMBEDDING_SETTINGS["threads"]
+        )
+    if backend != "torch":
+        raise ValueError(f"Unknown embedding backend {backend!r}, expected one of {', '.join(EMBEDDING_BACKENDS)}")
+
+    from langchain_huggingface import HuggingFaceEmbeddings
+
+    return HuggingFaceEmbeddings(
+        model_name=EMBEDDING_MODEL
+    )
+
+def export_onnx_model(output_dir, model_name=EMBEDDING_MODEL, quantize=True):
+    """Export the embedding model and its tokenizer to ONNX, plus an int8 copy when quantize is set
+
+    Needs torch and transformers (and onnxruntime to quantize); the exported
+    directory is then usable with only onnxruntime and tokenizers installed.
+    """
+    import torch
+    from transformers import AutoModel, AutoTokenizer
+
+    os.makedirs(output_dir, exist_ok=True)
+    tokenizer = AutoTokenizer.from_pretrained(model_name)
+    tokenizer.save_pretrained(output_dir)
+    model = AutoModel.from_pretrained(model_name).eval()
+
+    sample = tokenizer(["An example course review."], return_tensors="pt")
+    input_names = [name for name in ("input_ids", "attention_mask", "token_type_ids") if name in sample]
+    model_path = os.path.join(output_dir, "model.onnx")
+    with torch.no_grad():
+        torch.onnx.export(
+            model, tuple(sample[name] for name in input_names), model_path,
+            input_names=input_names, output_names=["last_hidden_state"],
+            dynamic_axes={name: {0: "batch", 1: "sequence"} for name in input_names + ["last_hidden_state"]},
+            opset_version=14
+        )
+    logger.info(f"Exported {model_name} to {model_path}")
+
+    if quantize:
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+
+        quantized_path = os.path.join(output_dir, "model.int8.onnx")
+        quantize_dynamic(model_path, quantized_path, weight_type=QuantType.QInt8)
+        logger.info(f"Wrote int8-quantized model to {quantized_path}")
+    return output_dir
+
+def _mean_pool(hidden, attention_mask):
+    """Attention-masked mean of token embeddings, L2-normalized like the sentence-transformers model"""
+    import numpy as np
+
+    mask = attention_mask[:, :, None].astype(np.float32)
+    pooled = (hidden * mask).sum(axis=1) / np.maximum(mask.sum(axis=1), 1e-9)
+    return pooled / np.maximum(np.linalg.norm(pooled, axis=1, keepdims=True), 1e-12)
+
+class OnnxEmbeddings:
+    """Embeddings from an ONNX export of the sentence-transformer model (see export_onnx_model)
+
+    Texts are tokenized once, sorted by token count and embedded in batches
+    padded only to their own longest text. The session is created on first use
+    and not pickled, so instances can be handed to ingest worker processes.
+    """
+    def __init__(self, model_dir, quantized=True, batch_size=64, max_length=256, threads=0):
+        from langchain_core.embeddings import Embeddings
+
+        # Registered as a virtual subclass so FAISS accepts it without importing LangChain at module load
+        Embeddings.register(OnnxEmbeddings)
+        self.model_dir = model_dir
+        self.quantized = quantized and os.path.exists(os.path.join(model_dir, "model.int8.onnx"))
+        self.model_name = f"{EMBEDDING_MODEL}:onnx{'-int8' if self.quantized else ''}"
+        self.batch_size = batch_size
+        self.max_length = max_length
+        self.threads = threads
+        self._session = None
+        self._tokenizer = None
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.update(_session=None, _tokenizer=None, _lock=None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def _load(self):
+        with self._lock:
+            if self._tokenizer is None:
+                from tokenizers import Tokenizer
+
+                tokenizer = Tokenizer.from_file(os.path.join(self.model_dir, "tokenizer.json"))
+                tokenizer.no_padding()
+                tokenizer.enable_truncation(self.max_length)
+                self._tokenizer = tokenizer
+            if self._session is None:
+                import onnxruntime
+
+                options = onnxruntime.SessionOptions()
+                if self.threads:
+                    options.intra_op_num_threads = self.threads
+                name = "model.int8.onnx" if self.quantized else "model.onnx"
+                self._session = onnxruntime.InferenceSession(
+                    os.path.join(self.model_dir, name), options, providers=["CPUExecutionProvider"]
+                )
+        return self._tokenizer, self._session
+
+    def _embed(self, texts):
+        import numpy as np
+
+        tokenizer, session = self._load()
+        encodings = tokenizer.encode_batch(list(texts))
+        input_names = {i.name for i in session.get_inputs()}
+        vectors = np.empty((len(texts), 0), dtype=np.float32)
+
+        # Similar lengths share a batch, so little compute goes to padding tokens
+        order = np.argsort([len(e.ids) for e in encodings], kind="stable")
+        for start in range(0, len(order), self.batch_size):
+            batch = [encodings[i] for i in order[start:start + self.batch_size]]
+            width = max(len(e.ids) for e in batch)
+            feeds = {}
+            for name, attr in (("input_ids", "ids"), ("attention_mask", "attention_mask"),
+                               ("token_type_ids", "type_ids")):
+                if name in input_names:
+                    array = np.zeros((len(batch), width), dtype=np.int64)
+                    for row, encoding in enumerate(batch):
+                        values = getattr(encoding, attr)
+                        array[row, :len(values)] = values
+                    feeds[name] = array
+            mask = feeds.get("attention_mask")
+            if mask is None:
+                mask = np.zeros((len(batch), width), dtype=np.int64)
+                for row, encoding in enumerate(batch):
+                    mask[row, :len(encoding.ids)] = 1
+            pooled = _mean_pool(session.run(None, feeds)[0], mask)
+            if vectors.shape[1] == 0:
+                vectors = np.empty((len(texts), pooled.shape[1]), dtype=np.float32)
+            vectors[order[start:start + self.batch_size]] = pooled
+        return vectors
+
+    def embed_documents(self, texts):
+        """Embed texts and return float32 rows"""
+        return self._embed(texts)
+
+    def embed_query(self, text):
+        """Embed one text"""
+        return self._embed([text])[0]
+
+def create_faiss_index(dim, settings=None):
+    """Empty FAISS index of the type named by settings, falling back to RETRIEVAL_SETTINGS"""
+    import faiss
+
+    settings = {**RETRIEVAL_SETTINGS, **(settings or {})}
+    if settings["index"] == "hnsw":
+        index = faiss.IndexHNSWFlat(dim, settings["hnsw_m"])
+        index.hnsw.efSearch = settings["hnsw_ef_search"]
+        return index
+    if settings["index"] != "flat":
+        raise ValueError(f"Unknown index type {settings['index']!r}, expected one of {', '.join(INDEX_TYPES)}")
+    return faiss.IndexFlatL2(dim)
+
+@profiled("build_vectorstore")
+def build_vectorstore(texts, metadatas, embeddings, batch_size=4096, sections=None, index_settings=None):
+    """Embed chunk texts and build the FAISS index over a compact columnar docstore
+
+    sections optionally names the source field of every text, which switches the
+    store to "fields" mode where retrieval returns one Document per student.
+    index_settings overrides the index type of RETRIEVAL_SETTINGS.
+    """
+    import numpy as np
+    import faiss
+    from langchain_community.vectorstores import FAISS
+
+    if not texts:
+        raise ValueError("No documents to index")
+
+    # Embed in batches so only one batch of Python float lists exists at a time
+    index = None
+    for start in range(0, len(texts), batch_size):
+        vectors = np.asarray(embeddings.embed_documents(texts[start:start + batch_size]), dtype=np.float32)
+        if index is None:
+            index = create_faiss_index(vectors.shape[1], index_settings)
+        index.add(vectors)
+
+    # Metadata is stored once per student; Documents are only built for returned hits
+    columns = ColumnarMetadata.from_metadatas(metadatas)
+    docstore = ColumnarDocstore(ChunkTexts(texts), columns, sections)
+    vectorstore = FAISS(embeddings, index, docstore, PositionalIds(len(texts)))
+    vectorstore.metadata_columns = columns
+    vectorstore.indexing_mode = "chunks" if sections is None else "fields"
+    return vectorstore
+
+VECTORSTORE_FORMAT = 1
+
+def vectorstore_nbytes(vectorstore):
+    """Approximate memory held by a vectorstore's index and columnar docstore"""
+    index = vectorstore.index
+    total = index.ntotal * index.d * 4
+    hnsw = getattr(index, "hnsw", None)
+    if hnsw is not None:
+        # Graph links: one int32 per neighbor slot on every level
+        total += hnsw.neighbors.size() * 4
+    docstore = vectorstore.docstore
+    if isinstance(docstore, ColumnarDocstore):
+        total += docstore.nbytes
+    return total
+
+def save_vectorstore(vectorstore, path):
+    """Write a vectorstore built by build_vectorstore to a directory, replacing it atomically"""
+    import shutil
+    import tempfile
+    import numpy as np
+    import faiss
+
+    docstore = vectorstore.docstore
+    if not isinstance(docstore, ColumnarDocstore):
+        raise ValueError("Only vectorstores built by build_vectorstore can be saved")
+    columns = docstore.columns
+
+    arrays = {
+        "row_index": columns.row_index,
+        "text_offsets": docstore.texts.offsets,
+        "text_buffer": np.frombuffer(docstore.texts.buffer, dtype=np.uint8)
+    }
+    for field, column in columns.numeric.items():
+        arrays[f"numeric/{field}"] = column
+    for field, (codes, _) in columns.categorical.items():
+        arrays[f"categorical/{field}"] = codes
+    if docstore.section_codes is not None:
+        arrays["section_codes"] = docstore.section_codes
+
+    manifest = {
+        "format": VECTORSTORE_FORMAT,
+        "indexing_mode": getattr(vectorstore, "indexing_mode", "chunks"),
+        "embedding_model": _embedding_model_key(vectorstore.embedding_function),
+        "chunks": len(columns),
+        "students": columns.num_rows,
+        "categories": {field: categories for field, (_, categories) in columns.categorical.items()},
+        "text_columns": {field: column.tolist() for field, column in columns.text.items()},
+        "section_names": docstore.section_names,
+        "theme_clusters": getattr(vectorstore, "theme_clusters", None),
+        "statistics": getattr(vectorstore, "dataset_statistics", None),
+        "source": getattr(vectorstore, "source_fingerprint", None)
+    }
+
+    # Write next to the target and swap it in, so readers never see a half-written shard
+    parent = os.path.dirname(os.path.abspath(path))
+    os.makedirs(parent, exist_ok=True)
+    tmp_path = tempfile.mkdtemp(prefix=".tmp-", dir=parent)
+    try:
+        faiss.write_index(vectorstore.index, os.path.join(tmp_path, "index.faiss"))
+        np.savez(os.path.join(tmp_path, "columns.npz"), **arrays)
+        with open(os.path.join(tmp_path, "manifest.json"), "w") as f:
+            json.dump(manifest, f)
+        if os.path.exists(path):
+            old_path = tempfile.mkdtemp(prefix=".old-", dir=parent)
+            os.replace(path, os.path.join(old_path, "shard"))
+            os.replace(tmp_path, path)
+            shutil.rmtree(old_path, ignore_errors=True)
+        else:
+            os.replace(tmp_path, path)
+    except Exception:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        raise
+    return path
+
+def load_vectorstore(path, embeddings):
+    """Load a vectorstore written by save_vectorstore"""
+    import numpy as np
+    import faiss
+    from langchain_community.vectorstores import FAISS
+
+    with open(os.path.join(path, "manifest.json")) as f:
+        manifest = json.load(f)
+    if manifest.get("format") != VECTORSTORE_FORMAT:
+        raise ValueError(f"Unsupported vectorstore format in {path}: {manifest.get('format')}")
+    if manifest.get("embedding_model", _embedding_model_key(embeddings)) != _embedding_model_key(embeddings):
+        # Vectors from another model or backend still load, but distances are less meaningful
+        logger.warning(f"{path} was embedded with {manifest['embedding_model']}, "
+                       f"querying with {_embedding_model_key(embeddings)}")
+
+    index = faiss.read_index(os.path.join(path, "index.faiss"))
+    with np.load(os.path.join(path, "columns.npz")) as arrays:
+        numeric = {name[len("numeric/"):]: arrays[name] for name in arrays.files if name.startswith("numeric/")}
+        categorical = {
+            name[len("categorical/"):]: (arrays[name], manifest["categories"][name[len("categorical/"):]])
+            for name in arrays.files if name.startswith("categorical/")
+        }
+        text = {field: np.array(values, dtype=object) for field, values in manifest["text_columns"].items()}
+        columns = ColumnarMetadata(numeric, categorical, text, arrays["row_index"], manifest["students"])
+
+        texts = ChunkTexts()
+        texts.offsets = arrays["text_offsets"]
+        texts.buffer = arrays["text_buffer"].tobytes()
+        sections = None
+        if "section_codes" in arrays.files:
+            sections = [manifest["section_names"][code] for code in arrays["section_codes"]]
+
+    docstore = ColumnarDocstore(texts, columns, sections)
+    vectorstore = FAISS(embeddings, index, docstore, PositionalIds(index.ntotal))
+    vectorstore.metadata_columns = columns
+    vectorstore.indexing_mode = manifest["indexing_mode"]
+    if manifest.get("theme_clusters"):
+        vectorstore.theme_clusters = manifest["theme_clusters"]
+    if manifest.get("statistics"):
+        vectorstore.dataset_statistics = manifest["statistics"]
+    return vectorstore
+
+def build_index(data_path, embeddings, indexing="chunks"):
+    """Load one course/term's data and build its vectorstore, theme clusters and statistics"""
+    if indexing not in INDEXING_MODES:
+        raise ValueError(f"Unknown indexing mode: {indexing}")
+
+    # Load and process data
+    df = load_data(data_path)
+    if df is None:
+        raise ValueError("Failed to load data")
+
+    # Create document collection and split it into chunks, or one text per field
+    sections = None
+    if indexing == "fields":
+        texts, metadatas, sections = create_field_documents(df)
+    else:
+        documents = create_student_documents(df)
+        texts, metadatas = split_student_documents(documents)
+
+    vectorstore = build_vectorstore(texts, metadatas, embeddings, sections=sections)
+    if THEME_SETTINGS["enabled"]:
+        vectorstore.theme_clusters = build_theme_clusters(vectorstore, df, embeddings)
+    vectorstore.dataset_statistics = compute_dataset_statistics(df)
+    return vectorstore, df
+
+def _load_openai_key():
+    """Load the OpenAI API key from the environment or a .env file"""
+    from dotenv import load_dotenv
+
+    # Load environment variables for API key
+    load_dotenv()
+    api_key = os.getenv("OPENAI_API_KEY")
+    if not api_key:
+        raise ValueError("OpenAI API key not found")
+
+    # Configure OpenAI settings
+    os.environ["OPENAI_API_KEY"] = api_key
+
+def create_llm():
+    """Create the chat model; retries and timeouts are handled by invoke_llm's call policy"""
+    from langchain_openai import ChatOpenAI
+
+    _load_openai_key()
+    return ChatOpenAI(
+        temperature=0.7,
+        model="gpt-3.5-turbo",
+        timeout=LLM_CALL_SETTINGS["timeout_s"],
+        max_retries=0,
+        stream_usage=True
+    )
+
+# Completed LLM responses kept for repeated prompts; 0 disables the cache
+LLM_CACHE_SETTINGS = {
+    "max_entries": int(os.getenv("RAGPSY_LLM_CACHE_SIZE", "1000"))
+}
+
+def _enable_llm_cache():
+    """Add caching to save tokens"""
+    from langchain_core.caches import InMemoryCache
+    from langchain_core.globals import set_llm_cache
+
+    # Bounded, so a long-lived process with ever-new prompts does not keep every response
+    max_entries = LLM_CACHE_SETTINGS["max_entries"]
+    set_llm_cache(InMemoryCache(maxsize=max_entries) if max_entries > 0 else None)
+
+@profiled("setup_rag")
+def setup_rag(data_path, embeddings=None, llm=None, indexing="chunks", watch=False):
+    """Initialize the RAG system, optionally with a custom embedding model or LLM
+
+    indexing="fields" embeds each student's course review and learning assessment
+    as separate vectors instead of splitting the whole student document into chunks.
+    With watch=True the returned vectorstore is a LiveIndex that rebuilds itself in
+    the background when the CSV files in data_path change.
+    """
+    try:
+        # Fail before the expensive ingest if no LLM can be created
+        if llm is None:
+            _load_openai_key()
+        
+        _enable_llm_cache()
+        load_retrieval_config()
+        
+        # Initialize embeddings and vector store
+        if embeddings is None:
+            embeddings = create_embeddings()
+        # Fingerprint first, so files changed during the build are picked up by the watcher
+        fingerprint = _source_fingerprint(data_path) if watch else None
+        vectorstore, df = build_index(data_path, embeddings, indexing)
+
+        # Canned questions are embedded now so their queries skip the embedding model
+        warmed = QUESTION_EMBEDDINGS.warm(embeddings, canned_questions())
+        if warmed:
+            logger.debug(f"Pre-embedded {warmed} canned questions")
+        QUESTION_EMBEDDINGS.save()
+        
+        if llm is None:
+            llm = create_llm()
+        if LLM_CALL_SETTINGS["batching"]:
+            enable_llm_batching(llm)
+
+        # Keep summary statistics around for degraded answers
+        global _dataset_statistics
+        _dataset_statistics = vectorstore.dataset_statistics
+
+        if watch:
+            vectorstore = LiveIndex(data_path, embeddings, indexing, vectorstore, df, fingerprint)
+            vectorstore.start()
+        
+        return vectorstore, llm, df
+        
+    except Exception as e:
+        logger.error(f"Error setting up RAG: {str(e)}")
+        return None, None, None
+
+# How often a watched data directory is checked for changed CSV files
+RELOAD_SETTINGS = {
+    "interval_s": float(os.getenv("RAGPSY_RELOAD_INTERVAL", "5"))
+}
+
+class LiveIndex:
+    """A data directory's (vectorstore, df) snapshot, rebuilt in the background when its CSV files change
+
+    Pass it to query_rag in place of a vectorstore. Every query reads the current
+    snapshot once, so queries running while a new snapshot is swapped in finish
+    against the old one.
+    """
+    def __init__(self, data_path, embeddings, indexing="chunks", vectorstore=None, df=None,
+                 fingerprint=None, interval_s=None):
+        self.data_path = data_path
+        self.embeddings = embeddings
+        self.indexing = indexing
+        self.interval_s = interval_s or RELOAD_SETTINGS["interval_s"]
+        self.generation = 0  # snapshots swapped in since the first build
+        self.last_error = None
+        self._snapshot = (vectorstore, df)
+        self._fingerprint = fingerprint
+        self._pending = None
+        self._rebuild_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        if vectorstore is None:
+            if not self.reload():
+                raise ValueError(f"Failed to build an index from {data_path}: {self.last_error}")
+        elif fingerprint is None:
+            self._fingerprint = _source_fingerprint(data_path)
+
+    @property
+    def vectorstore(self):
+        return self._snapshot[0]
+
+    @property
+    def df(self):
+        return self._snapshot[1]
+
+    def snapshot(self):
+        """The current (vectorstore, df) pair"""
+        return self._snapshot
+
+    def poll(self):
+        """Rebuild once changed CSV files have stayed unchanged for a poll; True if a new snapshot was swapped in"""
+        try:
+            fingerprint = _source_fingerprint(self.data_path)
+        except OSError:
+            # A file is being replaced; look again next time
+            return False
+        if fingerprint == self._fingerprint:
+            self._pending = None
+            return False
+        if fingerprint != self._pending:
+            # Files may still be being written, so wait for them to settle
+            self._pending = fingerprint
+            return False
+        return self.reload(fingerprint)
+
+    def reload(self, fingerprint=None):
+        """Rebuild from the data directory and swap the result in; on failure the old snapshot stays"""
+        global _dataset_statistics
+
+        with self._rebuild_lock:
+            t0 = time.perf_counter()
+            try:
+                fingerprint = fingerprint or _source_fingerprint(self.data_path)
+                vectorstore, df = build_index(self.data_path, self.embeddings, self.indexing)
+            except Exception as e:
+                logger.error(f"Rebuilding the index for {self.data_path} failed, keeping the current data: {str(e)}")
+                METRICS.incr("reload.failed")
+                self.last_error = str(e)
+                # The same broken files are not retried until they change again
+                self._fingerprint = fingerprint
+                self._pending = None
+                return False
+
+            previous = self._snapshot[0]
+            # One assignment replaces the pair, so readers never see a new index with an old DataFrame
+            self._snapshot = (vectorstore, df)
+            if previous is not None and _dataset_statistics is getattr(previous, "dataset_statistics", None):
+                _dataset_statistics = vectorstore.dataset_statistics
+            self._fingerprint = fingerprint
+            self._pending = None
+            if previous is not None:
+                self.generation += 1
+            self.last_error = None
+
+        elapsed = time.perf_counter() - t0
+        METRICS.incr("reload.success")
+        METRICS.observe("reload.build_s", elapsed)
+        logger.info(f"Reloaded {len(df)} student records from {self.data_path} in {elapsed:.1f}s "
+                    f"(generation {self.generation})")
+        return True
+
+    def start(self):
+        """Start polling the data directory in a daemon thread"""
+        if self._thread is None:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._watch, name="ragpsy-reload", daemon=True)
+            self._thread.start()
+        return self
+
+    def _watch(self):
+        while not self._stop.wait(self.interval_s):
+            self.poll()
+
+    def stop(self):
+        """Stop polling; a rebuild in progress is finished first"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+def _current_vectorstore(vectorstore):
+    """Pin a LiveIndex to its current snapshot; other vectorstores are returned unchanged"""
+    return vectorstore.vectorstore if isinstance(vectorstore, LiveIndex) else vectorstore
+
+def validate_data_sample(docs, filter_metadata):
+    """Validate the data sample and return information about limitations"""
+    try:
+        # Count unique student IDs in retrieved documents
+        student_ids = set()
+        for doc in docs:
+            if 'student_id' in doc.metadata:
+                student_ids.add(doc.metadata['student_id'])
+        
+        sample_size = len(student_ids)
+        
+        # Create warning message if sample size is small
+        if sample_size < 3:
+            return f"Note: Analysis is based on a small sample of {sample_size} student(s). Interpret results with caution."
+        elif sample_size < 5:
+            return f"Note: Analysis is based on {sample_size} students."
+        else:
+            return ""
+            
+    except Exception as e:
+        return "Warning: Unable to determine sample size."
+    
+class SingleFlight:
+    """Deduplicate concurrent calls that share the same key"""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self.stats = {"calls": 0, "shared": 0}
+
+    def do(self, key, fn):
+        """Run fn once per key; concurrent callers with the same key wait and share its result"""
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = {"done": threading.Event(), "result": None, "error": None}
+                self._calls[key] = call
+                self.stats["calls"] += 1
+            else:
+                self.stats["shared"] += 1
+
+        if not leader:
+            call["done"].wait()
+            if call["error"] is not None:
+                raise call["error"]
+            return call["result"], True
+
+        try:
+            call["result"] = fn()
+        except Exception as e:
+            call["error"] = e
+            raise
+        finally:
+            # Forget the key before waking waiters so later calls start fresh
+            with self._lock:
+                del self._calls[key]
+            call["done"].set()
+
+        return call["result"], False
+
+class LLMMicroBatcher:
+    """Collect prompts for a short window and send them as one llm.batch call"""
+    def __init__(self, llm, window_ms=10, max_batch_size=16):
+        # Held weakly so a registered batcher does not keep its LLM alive
+        self._llm = _weak_ref(llm)
+        self.window = window_ms / 1000.0
+        self.max_batch_size = max_batch_size
+        self._lock = threading.Condition()
+        self._pending = []
+        self.stats = {"batches": 0, "prompts": 0}
+
+    def submit(self, prompt_text):
+        """Queue a prompt and block until its batch has been answered"""
+        item = {"prompt": prompt_text, "done": threading.Event(), "result": None, "error": None}
+
+        with self._lock:
+            self._pending.append(item)
+            flusher = len(self._pending) == 1
+            if len(self._pending) >= self.max_batch_size:
+                self._lock.notify_all()
+
+        if flusher:
+            # The first prompt of a batch waits out the window, then sends everything queued
+            with self._lock:
+                deadline = time.monotonic() + self.window
+                while len(self._pending) < self.max_batch_size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._lock.wait(remaining)
+                batch = self._pending[:self.max_batch_size]
+                self._pending = self._pending[self.max_batch_size:]
+                if self._pending:
+                    # Overflow starts its own batch under a new flusher
+                    threading.Thread(target=self._flush_overflow, daemon=True).start()
+            self._send(batch)
+
+        item["done"].wait()
+        if item["error"] is not None:
+            raise item["error"]
+        return item["result"]
+
+    @property
+    def llm(self):
+        return self._llm()
+
+    def _flush_overflow(self):
+        """Send prompts left over after a full batch was taken"""
+        with self._lock:
+            batch = self._pending[:self.max_batch_size]
+            self._pending = self._pending[self.max_batch_size:]
+            if self._pending:
+                threading.Thread(target=self._flush_overflow, daemon=True).start()
+        self._send(batch)
+
+    def _send(self, batch):
+        """Run one batch completion and hand each result back to its caller"""
+        # An overflow flusher may already have taken every pending prompt
+        if not batch:
+            return
+        try:
+            results = self.llm.batch([item["prompt"] for item in batch], return_exceptions=True)
+        except Exception as e:
+            results = [e] * len(batch)
+
+        self.stats["batches"] += 1
+        self.stats["prompts"] += len(batch)
+        for item, result in zip(batch, results):
+            if isinstance(result, Exception):
+                item["error"] = result
+            else:
+                item["result"] = result
+            item["done"].set()
+
+class LLMUnavailableError(Exception):
+    """Raised when the LLM could not produce a response within the call policy"""
+
+class CircuitOpenError(LLMUnavailableError):
+    """Raised when calls are short-circuited because the breaker is open"""
+
+class CircuitBreaker:
+    """Stop calling a failing LLM backend until it has had time to recover"""
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """Return True if a call may go through, moving to half-open once the reset timeout passed"""
+        with self._lock:
+            if self.state == "open":
+                if time.monotonic() - self.opened_at < self.reset_timeout:
+                    return False
+                # Let a single trial call through
+                self.state = "half_open"
+                return True
+            # While the trial call is running everyone else is short-circuited
+            return self.state == "closed"
+
+    def record_success(self):
+        """Close the breaker after a successful call"""
+        with self._lock:
+            self.state = "closed"
+            self.failures = 0
+
+    def release_trial(self):
+        """Let another trial call through after one that failed for reasons unrelated to the backend"""
+        with self._lock:
+            if self.state == "half_open":
+                self.state = "open"
+
+    def record_failure(self):
+        """Count a failed call and open the breaker once the threshold is reached"""
+        with self._lock:
+            self.failures += 1
+            if self.state == "half_open" or self.failures >= self.failure_threshold:
+                self.state = "open"
+                self.opened_at = time.monotonic()
+
+_llm_flight = SingleFlight()
+# Per-LLM state keyed by id(llm). Chat models are unhashable pydantic models, so a
+# WeakKeyDictionary cannot hold them; entries keep a weak reference and are dropped
+# when their LLM is garbage collected.
+_llm_batchers = {}
+_llm_breakers = {}
+_llm_executor = None
+_llm_executor_lock = threading.Lock()
+_llm_registry_lock = threading.Lock()
+_abandoned_llm_calls = 0
+
+def _weak_ref(obj):
+    """A weak reference to obj, or a strong one for objects that do not support weakrefs"""
+    try:
+        return weakref.ref(obj)
+    except TypeError:
+        return lambda: obj
+
+def _registry_get(registry, llm):
+    """Look up a per-LLM entry, ignoring stale entries left by a recycled id()"""
+    entry = registry.get(id(llm))
+    if entry is None or entry[0]() is not llm:
+        return None
+    return entry[1]
+
+def _registry_set(registry, llm, value):
+    """Store a per-LLM entry that is removed once the LLM is garbage collected"""
+    registry[id(llm)] = (_weak_ref(llm), value)
+    try:
+        weakref.finalize(llm, registry.pop, id(llm), None)
+    except TypeError:
+        pass
+
+def get_circuit_breaker(llm):
+    """Return the circuit breaker guarding this LLM, creating it on first use"""
+    with _llm_registry_lock:
+        breaker = _registry_get(_llm_breakers, llm)
+        if breaker is None:
+            breaker = CircuitBreaker(
+                failure_threshold=LLM_CALL_SETTINGS["breaker_failure_threshold"],
+                reset_timeout=LLM_CALL_SETTINGS["breaker_reset_s"]
+            )
+            _registry_set(_llm_breakers, llm, breaker)
+        return breaker
+
+def is_retryable_llm_error(error):
+    """Check whether an LLM error is transient and worth retrying"""
+    if isinstance(error, (TimeoutError, FutureTimeoutError, ConnectionError)):
+        return True
+    return any(cls.__name__ in RETRYABLE_LLM_ERRORS for cls in type(error).__mro__)
+
+def _release_abandoned_call(future):
+    """Forget a timed-out call once its worker thread has finished with it"""
+    global _abandoned_llm_calls
+    with _llm_executor_lock:
+        _abandoned_llm_calls -= 1
+
+def _call_with_timeout(fn, timeout):
+    """Run fn on the shared LLM worker pool and give up waiting after timeout seconds"""
+    global _llm_executor, _abandoned_llm_calls
+    if not timeout:
+        return fn()
+
+    with _llm_executor_lock:
+        if _llm_executor is None:
+            _llm_executor = ThreadPoolExecutor(max_workers=32, thread_name_prefix="ragpsy-llm")
+        # A timed-out call cannot be interrupted and keeps its worker until the backend answers
+        if _abandoned_llm_calls >= LLM_CALL_SETTINGS["max_abandoned_calls"]:
+            raise LLMUnavailableError(f"{_abandoned_llm_calls} timed-out LLM calls are still running")
+
+    future = _llm_executor.submit(fn)
+    try:
+        return future.result(timeout=timeout)
+    except FutureTimeoutError:
+        if not future.cancel():
+            with _llm_executor_lock:
+                _abandoned_llm_calls += 1
+            future.add_done_callback(_release_abandoned_call)
+        raise TimeoutError(f"LLM call exceeded {timeout}s")
+
+def call_llm_with_policy(llm, fn):
+    """Run an LLM call under the configured timeout, retry and circuit-breaker policy
+
+    Only provider and transport errors (timeouts, rate limits, connection and 5xx
+    errors) make the LLM unavailable. The breaker counts one failure per call whose
+    retries all failed with one of them. Any other error, such as a rejected request
+    or a bug in fn, is raised unchanged and leaves the breaker as it was.
+    """
+    breaker = get_circuit_breaker(llm)
+    max_retries = LLM_CALL_SETTINGS["max_retries"]
+
+    for attempt in range(max_retries + 1):
+        if not breaker.allow():
+            raise CircuitOpenError("LLM circuit breaker is open")
+
+        try:
+            result = _call_with_timeout(fn, LLM_CALL_SETTINGS["timeout_s"])
+        except LLMUnavailableError:
+            raise
+        except Exception as e:
+            if not is_retryable_llm_error(e):
+                breaker.release_trial()
+                raise
+            if attempt == max_retries or breaker.state == "half_open":
+                # A failed trial call reopens the breaker straight away
+                breaker.record_failure()
+                raise LLMUnavailableError(f"LLM call failed after {attempt + 1} attempts: {e}") from e
+
+            # Exponential backoff with full jitter
+            delay = min(
+                LLM_CALL_SETTINGS["backoff_max_s"],
+                LLM_CALL_SETTINGS["backoff_base_s"] * (2 ** attempt)
+            )
+            time.sleep(random.uniform(0, delay))
+            continue
+
+        breaker.record_success()
+        return result
+
+def supports_batch_completion(llm):
+    """Check whether the LLM backend implements a native batch completion call"""
+    try:
+        from langchain_core.runnables import Runnable
+    except ImportError:
+        return False
+    batch = getattr(type(llm), "batch", None)
+    return batch is not None and batch is not Runnable.batch
+
+def enable_llm_batching(llm, window_ms=None, max_batch_size=None):
+    """Micro-batch prompts sent to this LLM if its backend supports batch completion"""
+    if not supports_batch_completion(llm):
+        # ChatOpenAI, the model create_llm builds, is one of these
+        logger.warning(f"{type(llm).__name__} has no batch completion endpoint; LLM batching is unavailable "
+                       f"and prompts use single-flight only")
+        return None
+
+    batcher = LLMMicroBatcher(
+        llm,
+        window_ms=window_ms if window_ms is not None else LLM_CALL_SETTINGS["batch_window_ms"],
+        max_batch_size=max_batch_size or LLM_CALL_SETTINGS["max_batch_size"]
+    )
+    with _llm_registry_lock:
+        _registry_set(_llm_batchers, llm, batcher)
+    return batcher
+
+def _response_cache(llm, prompt_text):
+    """The LLM response cache and the (prompt, llm_string) key llm.invoke would use, or None"""
+    from langchain_core.caches import BaseCache
+    from langchain_core.globals import get_llm_cache
+    from langchain_core.load import dumps
+
+    if llm.cache is False:
+        return None
+    cache = llm.cache if isinstance(llm.cache, BaseCache) else get_llm_cache()
+    if cache is None:
+        return None
+    # Private langchain-core helpers, pinned in requirements.txt and checked by
+    # test_response_cache_key_matches_invoke
+    return cache, dumps(llm._convert_input(prompt_text).to_messages()), llm._get_llm_string()
+
+def _stream_llm(llm, prompt_text, trace):
+    """Stream a chat completion, recording time to first token, and return the merged message
+
+    llm.stream never consults the LangChain response cache, so it is looked up
+    here under the key llm.invoke uses and the streamed message is written back.
+    """
+    from langchain_core.messages import AIMessage, message_chunk_to_message
+    from langchain_core.outputs import ChatGeneration
+
+    cached = _response_cache(llm, prompt_text)
+    if cached is not None:
+        cache, prompt_key, llm_string = cached
+        hit = cache.lookup(prompt_key, llm_string)
+        trace.count("cache.llm_response_hit" if hit else "cache.llm_response_miss")
+        if hit:
+            message = getattr(hit[0], "message", None) or AIMessage(content=hit[0].text)
+            # A cached answer costs no tokens
+            return message.model_copy(update={"usage_metadata": None})
+
+    t0 = time.perf_counter()
+    response = None
+    for chunk in llm.stream(prompt_text):
+        if response is None:
+            trace.add_span("llm_first_token", (time.perf_counter() - t0) * 1000)
+            response = chunk
+        else:
+            response = response + chunk
+    if cached is not None and response is not None:
+        cache.update(prompt_key, llm_string, [ChatGeneration(message=message_chunk_to_message(response))])
+    return response
+
+def _record_token_usage(response, trace):
+    """Copy token counts reported by the provider into the trace"""
+    usage = getattr(response, "usage_metadata", None)
+    if not isinstance(usage, dict):
+        return
+    prompt_tokens = usage.get("input_tokens", 0)
+    # Prompt tokens the provider served from its prefix cache (OpenAI and compatible servers)
+    cached = (usage.get("input_token_details") or {}).get("cache_read", 0)
+    trace.count("prompt_tokens", prompt_tokens)
+    trace.count("prompt_cached_tokens", cached)
+    trace.count("prompt_uncached_tokens", prompt_tokens - cached)
+    trace.count("completion_tokens", usage.get("output_tokens", 0))
+
+def invoke_llm(llm, prompt_text, trace=None):
+    """Send a rendered prompt to the LLM, sharing identical in-flight calls"""
+    trace = trace or QueryTrace("invoke_llm")
+
+    def attempt():
+        batcher = _registry_get(_llm_batchers, llm)
+        if batcher is not None:
+            return batcher.submit(prompt_text)
+        if LLM_CALL_SETTINGS["stream"] and _is_chat_model(llm):
+            return _stream_llm(llm, prompt_text, trace)
+        return llm.invoke(prompt_text)
+
+    def call():
+        return call_llm_with_policy(llm, attempt)
+
+    with trace.span("llm_total"):
+        if not LLM_CALL_SETTINGS["coalesce"]:
+            response, shared = call(), False
+        else:
+            response, shared = _llm_flight.do((id(llm), prompt_text), call)
+
+    trace.count("cache.llm_shared_hit" if shared else "cache.llm_shared_miss")
+    if not shared:
+        _record_token_usage(response, trace)
+    return response
+
+def _is_chat_model(llm):
+    """Check whether llm is a LangChain chat model that can stream tokens"""
+    try:
+        from langchain_core.language_models import BaseChatModel
+    except ImportError:
+        return False
+    return isinstance(llm, BaseChatModel)
+
+def build_degraded_response(context, stats=None):
+    """Answer with retrieved records and precomputed statistics when the LLM is unavailable"""
+    stats = stats if stats is not None else _dataset_statistics
+    return (
+        "The analysis service is temporarily unavailable, so no generated analysis is included.\n\n"
+        "Dataset statistics:\n"
+        f"{format_dataset_statistics(stats)}\n\n"
+        "Most relevant student records:\n"
+        f"{context}"
+    )
+
+def is_comparative_question(question):
+    """Detect if a question is asking for comparison between groups"""
+    comparative_phrases = [
+        'compare', 'versus', 'vs', 'difference', 'better', 'worse',
+        'than', 'between', 'higher', 'lower', 'more', 'less'
+    ]
+    demographic_terms = ['male', 'female', 'gender', 'international', 'first-gen']
+    
+    question_lower = question.lower()
+    has_comparative = any(phrase in question_lower for phrase in comparative_phrases)
+    has_demographic = any(term in question_lower for term in demographic_terms)
+    
+    return has_comparative and has_demographic
+
+# Numeric fields that can be filtered with range predicates
+NUMERIC_FILTER_FIELDS = ['midterm_grade', 'final_exam', 'study_hours_per_week', 'attendance_rate']
+
+# Words that identify which numeric field a phrase like "more than 8" refers to
+NUMERIC_FIELD_KEYWORDS = {
+    'study_hours_per_week': ['hour', 'study', 'studies', 'studying'],
+    'attendance_rate': ['attendance', 'attend', 'attended', 'attending'],
+    'final_exam': ['final'],
+    'midterm_grade': ['midterm']
+}
+
+_COMPARATOR_PATTERN = re.compile(
+    r"(more than|greater than|higher than|over|above|at least|no less than|"
+    r"less than|fewer than|lower than|under|below|at most|no more than|exactly)"
+    r"\s+(\d+(?:\.\d+)?)\s*(%|percent|hours?|hrs?)?"
+)
+_BETWEEN_PATTERN = re.compile(
+    r"between\s+(\d+(?:\.\d+)?)\s*(?:%|percent|hours?)?\s+and\s+(\d+(?:\.\d+)?)\s*(%|percent|hours?|hrs?)?"
+)
+_COMPARATOR_OPERATORS = {
+    'more than': '$gt', 'greater than': '$gt', 'higher than': '$gt', 'over': '$gt', 'above': '$gt',
+    'at least': '$gte', 'no less than': '$gte',
+    'less than': '$lt', 'fewer than': '$lt', 'lower than': '$lt', 'under': '$lt', 'below': '$lt',
+    'at most': '$lte', 'no more than': '$lte',
+    'exactly': '$eq'
+}
+
+def _numeric_field_near(text, start, end, unit):
+    """Find the numeric field a number refers to from its unit or a nearby keyword"""
+    if unit and unit.startswith(('hour', 'hr')):
+        return 'study_hours_per_week'
+
+    # A keyword just before the number wins ("attendance below 80"), otherwise
+    # look just after it ("above 90 on the final exam")
+    before = text[max(0, start - 40):start]
+    after = text[end:end + 40]
+    best_before, best_after = None, None
+    for field, keywords in NUMERIC_FIELD_KEYWORDS.items():
+        for keyword in keywords:
+            for match in re.finditer(r"\b" + keyword, before):
+                distance = len(before) - match.start()
+                if best_before is None or distance < best_before[0]:
+                    best_before = (distance, field)
+            match = re.search(r"\b" + keyword, after)
+            if match and (best_after is None or match.start() < best_after[0]):
+                best_after = (match.start(), field)
+
+    if best_before:
+        return best_before[1]
+    if best_after:
+        return best_after[1]
+    if unit in ('%', 'percent'):
+        return 'attendance_rate'
+    return None
+
+def parse_numeric_filters(question):
+    """Turn phrases like "study more than 8 hours" or "perfect attendance" into range predicates"""
+    text = question.lower()
+    predicates = {}
+
+    def add(field, op, value):
+        predicates.setdefault(field, {})[op] = value
+
+    if re.search(r"perfect attendance|100\s*% attendance|never missed", text):
+        add('attendance_rate', '$gte', 100.0)
+
+    for match in _BETWEEN_PATTERN.finditer(text):
+        field = _numeric_field_near(text, match.start(), match.end(), match.group(3))
+        if field:
+            low, high = sorted([float(match.group(1)), float(match.group(2))])
+            add(field, '$gte', low)
+            add(field, '$lte', high)
+
+    for match in _COMPARATOR_PATTERN.finditer(text):
+        if any(b.start() <= match.start() < b.end() for b in _BETWEEN_PATTERN.finditer(text)):
+            continue
+        field = _numeric_field_near(text, match.start(), match.end(), match.group(3))
+        if field:
+            add(field, _COMPARATOR_OPERATORS[match.group(1)], float(match.group(2)))
+
+    return predicates
+
+def merge_filters(*filters):
+    """Combine filters so a document must match all of them"""
+    filters = [f for f in filters if f]
+    if not filters:
+        return None
+    if len(filters) == 1:
+        return filters[0]
+    return {"$and": filters}
+
+class ColumnarMetadata:
+    """Student metadata stored as typed NumPy columns, with a chunk -> student row index"""
+    def __init__(self, numeric=None, categorical=None, text=None, row_index=None, num_rows=0):
+        import numpy as np
+
+        self.numeric = numeric or {}          # field -> float32 array per student, NaN where missing
+        self.categorical = categorical or {}  # field -> (integer codes, categories), -1 where missing
+        self.text = text or {}                # field -> object array for high-cardinality strings (ids)
+        self.num_rows = num_rows
+        self.row_index = row_index if row_index is not None else np.arange(num_rows, dtype=np.int32)
+        self._mask_cache = OrderedDict()
+        self._mask_lock = threading.Lock()  # Batch workers and shard searches share the cache
+        self._rows_sorted = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.update(_mask_cache=OrderedDict(), _mask_lock=None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._mask_lock = threading.Lock()
+
+    @classmethod
+    def from_metadatas(cls, metadatas):
+        """Build columns from per-chunk metadata dicts, storing each student's values once"""
+        import numpy as np
+
+        # Chunks of the same student share one row; fall back to dict identity without an id
+        rows, row_lookup, row_index = [], {}, np.empty(len(metadatas), dtype=np.int32)
+        for position, metadata in enumerate(metadatas):
+            key = metadata.get('student_id', id(metadata))
+            row = row_lookup.get(key)
+            if row is None:
+                row = row_lookup[key] = len(rows)
+                rows.append(metadata)
+            row_index[position] = row
+
+        fields = {}
+        for metadata in rows:
+            for key in metadata:
+                fields.setdefault(key, None)
+
+        numeric, categorical, text = {}, {}, {}
+        for field in fields:
+            values = [metadata.get(field) for metadata in rows]
+            present = [v for v in values if v is not None]
+            if present and all(isinstance(v, (int, float)) and not isinstance(v, bool) for v in present):
+                numeric[field] = np.array(
+                    [np.nan if v is None else v for v in values], dtype=np.float32
+                )
+                continue
+
+            categories = sorted({str(v) for v in present})
+            if len(categories) > 1000 and len(categories) > len(rows) // 2:
+                # Identifiers and free text gain nothing from category codes
+                text[field] = np.array(values, dtype=object)
+                continue
+
+            lookup = {category: code for code, category in enumerate(categories)}
+            codes = np.array(
+                [lookup[str(v)] if v is not None else -1 for v in values],
+                dtype=_codes_dtype(len(categories))
+            )
+            categorical[field] = (codes, categories)
+
+        return cls(numeric, categorical, text, row_index, len(rows))
+
+    def __len__(self):
+        return len(self.row_index)
+
+    @property
+    def nbytes(self):
+        """Approximate memory held by the columns"""
+        total = self.row_index.nbytes
+        total += sum(column.nbytes for column in self.numeric.values())
+        total += sum(codes.nbytes + sum(len(c) + 49 for c in categories)
+                     for codes, categories in self.categorical.values())
+        total += sum(column.nbytes + sum(len(str(v)) + 49 for v in column) for column in self.text.values())
+        return total
+
+    def row_metadata(self, row):
+        """Materialize the metadata dict for one student row"""
+        metadata = {}
+        for field, column in self.text.items():
+            if column[row] is not None:
+                metadata[field] = column[row]
+        for field, (codes, categories) in self.categorical.items():
+            if codes[row] >= 0:
+                metadata[field] = categories[codes[row]]
+        for field, column in self.numeric.items():
+            value = column[row]
+            if value == value:  # Skip NaN
+                metadata[field] = float(value)
+        return metadata
+
+    def chunk_metadata(self, position):
+        """Materialize the metadata dict for one chunk"""
+        return self.row_metadata(self.row_index[position])
+
+    def row_positions(self, row):
+        """Chunk positions belonging to one student row"""
+        import numpy as np
+
+        if self._rows_sorted is None:
+            self._rows_sorted = bool(np.all(self.row_index[1:] >= self.row_index[:-1]))
+        if self._rows_sorted:
+            # Chunks are added student by student, so each row is one contiguous run
+            start, end = np.searchsorted(self.row_index, [row, row + 1])
+            return range(int(start), int(end))
+        return np.flatnonzero(self.row_index == row).tolist()
+
+    def mask(self, filter_metadata):
+        """Evaluate a metadata filter for every chunk at once and return a boolean mask
+
+        Masks of filters are cached and shared between callers, so they are read-only.
+        """
+        import numpy as np
+
+        if not filter_metadata:
+            return np.ones(len(self), dtype=bool)
+
+        # Dashboards repeat the same filters, so recent chunk masks are kept
+        key = json.dumps(filter_metadata, sort_keys=True, default=str)
+        with self._mask_lock:
+            cached = self._mask_cache.get(key)
+            if cached is not None:
+                self._mask_cache.move_to_end(key)
+                return cached
+
+        row_mask = self.row_mask(filter_metadata)
+        chunk_mask = np.take(row_mask.view(np.uint8), self.row_index).view(bool)
+        chunk_mask.setflags(write=False)
+        with self._mask_lock:
+            self._mask_cache[key] = chunk_mask
+            self._mask_cache.move_to_end(key)
+            while len(self._mask_cache) > 16:
+                self._mask_cache.popitem(last=False)
+        return chunk_mask
+
+    def _clear_mask_cache(self):
+        with self._mask_lock:
+            self._mask_cache.clear()
+
+    def row_mask(self, filter_metadata):
+        """Evaluate a metadata filter for every student row"""
+        import numpy as np
+
+        if not filter_metadata:
+            return np.ones(self.num_rows, dtype=bool)
+        if "$and" in filter_metadata:
+            return np.logical_and.reduce([self.row_mask(f) for f in filter_metadata["$and"]])
+        if "$or" in filter_metadata:
+            return np.logical_or.reduce([self.row_mask(f) for f in filter_metadata["$or"]])
+        if "$not" in filter_metadata:
+            return ~self.row_mask(filter_metadata["$not"])
+
+        result = None
+        for field, condition in filter_metadata.items():
+            field_mask = self._field_mask(field, condition)
+            result = field_mask if result is None else result & field_mask
+        return result
+
+    def _field_mask(self, field, condition):
+        """Mask for one field condition: a value, a list of values or an operator dict"""
+        import numpy as np
+
+        if isinstance(condition, dict):
+            conditions = list(condition.items())
+        elif isinstance(condition, (list, tuple, set)):
+            conditions = [("$in", list(condition))]
+        else:
+            conditions = [("$eq", condition)]
+
+        result = None
+        for op, value in conditions:
+            if op not in FILTER_OPERATORS:
+                raise ValueError(f"filter contains unsupported operator: {op}")
+            if field in self.numeric:
+                op_mask = self._numeric_mask(self.numeric[field], op, value)
+            elif field in self.categorical:
+                op_mask = self._categorical_mask(*self.categorical[field], op, value)
+            elif field in self.text:
+                op_mask = np.array([_apply_operator(op, v, value) for v in self.text[field]], dtype=bool)
+            else:
+                op_mask = np.zeros(self.num_rows, dtype=bool)
+            result = op_mask if result is None else result & op_mask
+        return result
+
+    @staticmethod
+    def _categorical_mask(codes, categories, op, value):
+        import numpy as np
+
+        # Evaluate the operator once per category, then compare codes
+        matching = [code for code, category in enumerate(categories) if _apply_operator(op, category, value)]
+        if not matching:
+            return np.zeros(len(codes), dtype=bool)
+        if len(matching) == len(categories):
+            return codes >= 0
+        if len(matching) <= 4:
+            result = codes == matching[0]
+            for code in matching[1:]:
+                result |= codes == code
+            return result
+        return np.isin(codes, matching)
+
+    @staticmethod
+    def _numeric_mask(column, op, value):
+        import numpy as np
+
+        if op in ("$in", "$nin"):
+            values = np.array([float(v) for v in value], dtype=np.float32)
+            hit = np.isin(column, values)
+            return hit if op == "$in" else ~hit & ~np.isnan(column)
+        try:
+            value = float(value)
+        except (TypeError, ValueError):
+            return np.zeros(len(column), dtype=bool)
+        return FILTER_OPERATORS[op](column, value)
+
+    def append(self, other):
+        """Append another column set, e.g. when merging indexes"""
+        import numpy as np
+
+        # Small partitions may store ids as categories that larger ones store as text
+        for field in set(self.text) & set(other.categorical):
+            other._categorical_to_text(field)
+        for field in set(other.text) & set(self.categorical):
+            self._categorical_to_text(field)
+
+        def missing(size, kind):
+            if kind == "numeric":
+                return np.full(size, np.nan, dtype=np.float32)
+            return np.full(size, None, dtype=object)
+
+        for field in set(self.numeric) | set(other.numeric):
+            self.numeric[field] = np.concatenate([
+                self.numeric.get(field, missing(self.num_rows, "numeric")),
+                other.numeric.get(field, missing(other.num_rows, "numeric"))
+            ])
+        for field in set(self.text) | set(other.text):
+            self.text[field] = np.concatenate([
+                self.text.get(field, missing(self.num_rows, "text")),
+                other.text.get(field, missing(other.num_rows, "text"))
+            ])
+        for field in set(self.categorical) | set(other.categorical):
+            codes, categories = self.categorical.get(field, (np.full(self.num_rows, -1, dtype=np.int8), []))
+            other_codes, other_categories = other.categorical.get(field, (np.full(other.num_rows, -1, dtype=np.int8), []))
+            merged = sorted(set(categories) | set(other_categories))
+            lookup = {category: code for code, category in enumerate(merged)}
+            dtype = _codes_dtype(len(merged))
+            remap = np.array([lookup[c] for c in categories] + [-1], dtype=dtype)
+            other_remap = np.array([lookup[c] for c in other_categories] + [-1], dtype=dtype)
+            self.categorical[field] = (
+                np.concatenate([remap[codes], other_remap[other_codes]]),
+                merged
+            )
+
+        self.row_index = np.concatenate([self.row_index, other.row_index + self.num_rows]).astype(np.int32)
+        self.num_rows += other.num_rows
+        self._clear_mask_cache()
+        self._rows_sorted = None
+
+    def _categorical_to_text(self, field):
+        """Store a categorical column as an object array instead"""
+        import numpy as np
+
+        codes, categories = self.categorical.pop(field)
+        lookup = np.array(list(categories) + [None], dtype=object)
+        self.text[field] = lookup[codes]
+        self._clear_mask_cache()
+
+class ChunkTexts:
+    """Chunk texts packed into one UTF-8 buffer with an offsets array"""
+    def __init__(self, texts=()):
+        import numpy as np
+
+        encoded = [text.encode("utf-8") for text in texts]
+        self.offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(chunk) for chunk in encoded], out=self.offsets[1:])
+        self.buffer = b"".join(encoded)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, position):
+        return self.buffer[self.offsets[position]:self.offsets[position + 1]].decode("utf-8")
+
+    @property
+    def nbytes(self):
+        return len(self.buffer) + self.offsets.nbytes
+
+    def append(self, other):
+        import numpy as np
+
+        self.offsets = np.concatenate([self.offsets, other.offsets[1:] + self.offsets[-1]])
+        self.buffer += other.buffer
+
+class PositionalIds:
+    """index_to_docstore_id mapping where every FAISS position is its own docstore id"""
+    def __init__(self, size):
+        self.size = size
+
+    def __getitem__(self, position):
+        if not 0 <= position < self.size:
+            raise KeyError(position)
+        return int(position)
+
+    def get(self, position, default=None):
+        return int(position) if 0 <= position < self.size else default
+
+    def __len__(self):
+        return self.size
+
+    def __contains__(self, position):
+        return 0 <= position < self.size
+
+    def items(self):
+        return ((i, i) for i in range(self.size))
+
+    def values(self):
+        return iter(range(self.size))
+
+class ColumnarDocstore:
+    """Docstore that builds Documents on demand from packed chunk texts and metadata columns"""
+    def __init__(self, texts, columns, sections=None):
+        import numpy as np
+
+        self.texts = texts
+        self.columns = columns
+        # Optional source field per text, stored as small integer codes
+        self.section_names = sorted(set(sections)) if sections is not None else []
+        lookup = {name: code for code, name in enumerate(self.section_names)}
+        self.section_codes = (
+            np.array([lookup[name] for name in sections], dtype=np.int8) if sections is not None else None
+        )
+
+    def section(self, position):
+        """Name of the field a text came from, or None for plain chunks"""
+        if self.section_codes is None:
+            return None
+        return self.section_names[self.section_codes[position]]
+
+    def search(self, search_id):
+        """Materialize the Document stored at a FAISS position"""
+        from langchain_core.documents import Document
+
+        try:
+            position = int(search_id)
+        except (TypeError, ValueError):
+            return f"ID {search_id} not found."
+        if not 0 <= position < len(self.texts):
+            return f"ID {search_id} not found."
+        metadata = self.columns.chunk_metadata(position)
+        if self.section_codes is not None:
+            metadata['section'] = self.section(position)
+        return Document(id=str(position), page_content=self.texts[position], metadata=metadata)
+
+    def student_document(self, positions):
+        """Build one Document for a student from matched positions, including all their fields"""
+        from langchain_core.documents import Document
+
+        row = self.columns.row_index[positions[0]]
+        fields = {
+            self.section(position): self.texts[position]
+            for position in self.columns.row_positions(row)
+        }
+        metadata = self.columns.row_metadata(row)
+        metadata['matched_sections'] = [self.section(position) for position in positions]
+        return Document(
+            id=str(metadata.get('student_id', row)),
+            page_content=format_student_document(metadata, fields),
+            metadata=metadata
+        )
+
+    @property
+    def nbytes(self):
+        total = self.texts.nbytes + self.columns.nbytes
+        if self.section_codes is not None:
+            total += self.section_codes.nbytes
+        return total
+
+    def append(self, other):
+        """Append another columnar docstore, keeping positions aligned with a merged index"""
+        import numpy as np
+
+        if (self.section_codes is None) != (other.section_codes is None):
+            raise ValueError("Cannot merge chunk and field docstores")
+        if self.section_codes is not None:
+            sections = [self.section(i) for i in range(len(self.texts))]
+            sections += [other.section(i) for i in range(len(other.texts))]
+            self.section_names = sorted(set(sections))
+            lookup = {name: code for code, name in enumerate(self.section_names)}
+            self.section_codes = np.array([lookup[name] for name in sections], dtype=np.int8)
+        self.texts.append(other.texts)
+        self.columns.append(other.columns)
+
+def _codes_dtype(category_count):
+    """Smallest signed integer type that holds the category codes plus -1 for missing"""
+    import numpy as np
+
+    if category_count < 127:
+        return np.int8
+    if category_count < 32767:
+        return np.int16
+    return np.int32
+
+def _apply_operator(op, left, right):
+    """Apply a filter operator to one scalar value"""
+    if op == "$in":
+        return left in right
+    if op == "$nin":
+        return left not in right
+    try:
+        return bool(FILTER_OPERATORS[op](left, right))
+    except TypeError:
+        return False
+
+FILTER_OPERATORS = {
+    "$eq": operator.eq, "$neq": operator.ne,
+    "$gt": operator.gt, "$gte": operator.ge,
+    "$lt": operator.lt, "$lte": operator.le,
+    "$in": None, "$nin": None
+}
+
+def search_with_mask(index, vector, k, mask):
+    """Search only the index positions allowed by mask"""
+    import numpy as np
+    import faiss
+
+    allowed = np.flatnonzero(mask)
+    if len(allowed) == 0:
+        return np.empty((1, 0), dtype=np.float32), np.empty((1, 0), dtype=np.int64)
+
+    if isinstance(index, faiss.IndexFlat):
+        # Flat indexes skip excluded vectors during the scan
+        bitmap = np.packbits(mask.astype(np.uint8), bitorder="little")
+        params = faiss.SearchParameters(sel=faiss.IDSelectorBitmap(len(mask), faiss.swig_ptr(bitmap)))
+        return index.search(vector, min(k, len(allowed)), params=params)
+
+    # Graph and cluster indexes can miss sparse selections, so score the allowed vectors directly
+    vectors = index.reconstruct_batch(allowed)
+    if index.metric_type == faiss.METRIC_INNER_PRODUCT:
+        distances = -(vectors @ vector[0])
+    else:
+        distances = ((vectors - vector[0]) ** 2).sum(axis=1)
+    top = np.argsort(distances)[:k]
+    scores = -distances[top] if index.metric_type == faiss.METRIC_INNER_PRODUCT else distances[top]
+    return scores[None, :], allowed[top][None, :]
+
+def _mmr_order(vectors, distances, rows, query, k, mmr_lambda):
+    """Indices of up to k candidates: each row's closest one, in maximal marginal relevance order"""
+    import numpy as np
+
+    # Each student's closest chunk, closest students first
+    order = np.lexsort((distances, rows))
+    first = np.ones(len(order), dtype=bool)
+    first[1:] = rows[order[1:]] != rows[order[:-1]]
+    best = order[first]
+    best = best[np.argsort(distances[best], kind="stable")]
+    if mmr_lambda >= 1 or len(best) <= 2 or k <= 1:
+        return best[:k]
+
+    unit = vectors[best] / np.maximum(np.linalg.norm(vectors[best], axis=1, keepdims=True), 1e-12)
+    relevance = unit @ (query / max(float(np.linalg.norm(query)), 1e-12))
+    similarity = unit @ unit.T
+    # The closest student always comes first; each later pick updates the redundancy vector once
+    selected = [0]
+    redundancy = similarity[0].copy()
+    taken = np.zeros(len(best), dtype=bool)
+    taken[0] = True
+    for _ in range(1, min(k, len(best))):
+        mmr = mmr_lambda * relevance - (1 - mmr_lambda) * redundancy
+        mmr[taken] = -np.inf
+        pick = int(np.argmax(mmr))
+        selected.append(pick)
+        taken[pick] = True
+        np.maximum(redundancy, similarity[pick], out=redundancy)
+    return best[selected]
+
+def _distances(index, vectors, query):
+    """Distances from query to vectors in the index's metric, smaller is closer"""
+    import faiss
+
+    if index.metric_type == faiss.METRIC_INNER_PRODUCT:
+        return -(vectors @ query)
+    return ((vectors - query) ** 2).sum(axis=1)
+
+def select_diverse(index, row_index, vector, positions, k, mmr_lambda=None):
+    """Choose k of the candidate positions: one chunk per student, diversified by maximal marginal relevance
+
+    Candidates are first reduced to each student's closest chunk. Students are
+    then picked greedily by mmr_lambda * similarity to the question minus
+    (1 - mmr_lambda) * highest similarity to a student already picked, using
+    cosine similarities from one matrix product. Returns (positions, scores)
+    in selection order, with scores in the index's metric like FAISS search.
+    """
+    import numpy as np
+    import faiss
+
+    mmr_lambda = RETRIEVAL_SETTINGS["mmr_lambda"] if mmr_lambda is None else mmr_lambda
+    positions = np.asarray(positions, dtype=np.int64)
+    positions = positions[positions != -1]
+    if not len(positions):
+        return positions, np.empty(0, dtype=np.float32)
+
+    vectors = index.reconstruct_batch(positions)
+    distances = _distances(index, vectors, vector[0])
+    chosen = _mmr_order(vectors, distances, row_index[positions], vector[0], k, mmr_lambda)
+    inner_product = index.metric_type == faiss.METRIC_INNER_PRODUCT
+    return positions[chosen], (-distances[chosen] if inner_product else distances[chosen])
+
+def _candidate_positions(vectorstore, vector, fetch_k, filter_metadata, trace):
+    """Positions of the fetch_k closest chunks matching the filter, closest first"""
+    if not filter_metadata:
+        with trace.span("vector_search"):
+            _, indices = vectorstore.index.search(vector, fetch_k)
+        return indices[0][indices[0] != -1]
+    with trace.span("filter"):
+        mask = vectorstore.metadata_columns.mask(filter_metadata)
+    trace.count("filter_candidates", int(mask.sum()))
+    with trace.span("vector_search"):
+        _, indices = search_with_mask(vectorstore.index, vector, fetch_k, mask)
+    return indices[0][indices[0] != -1]
+
+def _is_chunk_store(vectorstore):
+    """A chunk-indexed FAISS store with columnar metadata, as build_vectorstore makes"""
+    return (_is_faiss(vectorstore)
+            and getattr(vectorstore, "indexing_mode", "chunks") == "chunks"
+            and isinstance(getattr(vectorstore, "metadata_columns", None), ColumnarMetadata)
+            and len(vectorstore.metadata_columns) == vectorstore.index.ntotal)
+
+def _diverse_results(vectorstore, vector, indices, k, trace):
+    """Diversify over-fetched chunk hits and build their Documents"""
+    with trace.span("diversify"):
+        positions, scores = select_diverse(vectorstore.index, vectorstore.metadata_columns.row_index,
+                                           vector, indices, k)
+    trace.count("diversify_candidates", len(indices))
+    results = [
+        (vectorstore.docstore.search(vectorstore.index_to_docstore_id[int(i)]), float(score))
+        for i, score in zip(positions, scores)
+    ]
+    trace.count("retrieved_chunks", len(results))
+    return results
+
+def _is_faiss(vectorstore):
+    """Check for a LangChain FAISS store without importing FAISS if nothing has loaded it yet"""
+    faiss_module = sys.modules.get("langchain_community.vectorstores.faiss")
+    return faiss_module is not None and isinstance(vectorstore, faiss_module.FAISS)
+
+def _group_student_hits(vectorstore, indices, scores, k, trace):
+    """Collapse field-level hits into one Document per student, in rank order"""
+    with trace.span("context_assembly"):
+        row_index = vectorstore.metadata_columns.row_index
+        hits, best = {}, {}
+        for i, score in zip(indices, scores):
+            if i == -1:
+                continue
+            row = int(row_index[i])
+            if row not in hits:
+                if len(hits) == k:
+                    break
+                hits[row] = []
+                best[row] = float(score)
+            hits[row].append(int(i))
+        results = [
+            (vectorstore.docstore.student_document(positions), best[row])
+            for row, positions in hits.items()
+        ]
+
+    trace.count("retrieved_chunks", sum(len(positions) for positions in hits.values()))
+    trace.count("retrieved_students", len(results))
+    return results
+
+# Question embeddings are cached in memory and, when a path is set, on disk between runs
+EMBEDDING_CACHE_SETTINGS = {
+    "max_entries": 10_000,
+    "path": os.getenv("RAGPSY_EMBEDDING_CACHE")
+}
+
+def normalize_question(question):
+    """Canonical form of a question used as its embedding cache key"""
+    return " ".join(question.lower().split()).rstrip("?!. ")
+
+def _embedding_model_key(embeddings):
+    """Identify an embedding model so cached vectors are never shared between models"""
+    model = (getattr(embeddings, "model_name", None) or getattr(embeddings, "model", None)
+             or getattr(embeddings, "size", None))
+    return f"{type(embeddings).__module__}.{type(embeddings).__name__}:{model}"
+
+class QuestionEmbeddingCache:
+    """LRU cache of question embeddings keyed by embedding model and normalized question"""
+    def __init__(self, max_entries=None, path=None):
+        self.max_entries = max_entries
+        self.path = path
+        self._entries = OrderedDict()  # (model key, normalized question) -> float32 vector
+        self._lock = threading.Lock()
+        self._loaded_path = None
+        self._dirty = False
+        self.stats = {"hits": 0, "misses": 0}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _ensure_loaded(self):
+        """Load the persisted cache the first time it is used with a configured path"""
+        path = self.path if self.path is not None else EMBEDDING_CACHE_SETTINGS["path"]
+        if path and path != self._loaded_path:
+            self._loaded_path = path
+            self.load(path)
+            atexit.register(self.save)
+
+    def get(self, embeddings, question):
+        """Cached vector for a question, or None"""
+        key = (_embedding_model_key(embeddings), normalize_question(question))
+        with self._lock:
+            self._ensure_loaded()
+            vector = self._entries.get(key)
+            if vector is not None:
+                self._entries.move_to_end(key)
+                self.stats["hits"] += 1
+            else:
+                self.stats["misses"] += 1
+            return vector
+
+    def put(self, embeddings, question, vector):
+        import numpy as np
+
+        key = (_embedding_model_key(embeddings), normalize_question(question))
+        max_entries = self.max_entries or EMBEDDING_CACHE_SETTINGS["max_entries"]
+        with self._lock:
+            self._entries[key] = np.asarray(vector, dtype=np.float32)
+            self._entries.move_to_end(key)
+            while len(self._entries) > max_entries:
+                self._entries.popitem(last=False)
+            self._dirty = True
+
+    def embed(self, embeddings, question, trace=None):
+        """Embed a question through the cache; returns a float32 vector"""
+        import numpy as np
+
+        vector = self.get(embeddings, question)
+        if trace is not None:
+            trace.count("cache.embedding_hit" if vector is not None else "cache.embedding_miss")
+        if vector is None:
+            vector = np.asarray(embeddings.embed_query(normalize_question(question)), dtype=np.float32)
+            self.put(embeddings, question, vector)
+        return vector
+
+    def get_cached(self, embeddings, question):
+        """Cached vector without touching the hit/miss statistics"""
+        key = (_embedding_model_key(embeddings), normalize_question(question))
+        with self._lock:
+            return self._entries.get(key)
+
+    def warm(self, embeddings, questions):
+        """Pre-embed questions that are not cached yet; returns how many were embedded"""
+        with self._lock:
+            self._ensure_loaded()
+        missing = [q for q in dict.fromkeys(questions) if self.get_cached(embeddings, q) is None]
+        for question in missing:
+            self.put(embeddings, question, embeddings.embed_query(normalize_question(question)))
+        return len(missing)
+
+    def save(self, path=None):
+        """Write the cache to an .npz file, replacing it atomically"""
+        import numpy as np
+
+        path = path or self._loaded_path or self.path or EMBEDDING_CACHE_SETTINGS["path"]
+        if not path or not self._dirty:
+            return None
+        with self._lock:
+            keys = list(self._entries)
+            vectors = list(self._entries.values())
+            self._dirty = False
+
+        # Vectors of different models can differ in size, so each model gets its own array
+        models = sorted({model for model, _ in keys})
+        arrays, index = {}, []
+        for number, model in enumerate(models):
+            positions = [i for i, (key_model, _) in enumerate(keys) if key_model == model]
+            arrays[f"vectors_{number}"] = np.stack([vectors[i] for i in positions])
+            index.append({"model": model, "questions": [keys[i][1] for i in positions]})
+        arrays["index"] = np.array(json.dumps(index))
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        tmp_path = f"{path}.tmp-{os.getpid()}.npz"
+        np.savez(tmp_path, **arrays)
+        os.replace(tmp_path, path)
+        return path
+
+    def load(self, path):
+        """Add the entries of a saved cache; missing or unreadable files are ignored"""
+        import numpy as np
+
+        if not os.path.exists(path):
+            return 0
+        try:
+            with np.load(path) as arrays:
+                index = json.loads(str(arrays["index"]))
+                loaded = [
+                    ((entry["model"], question), vector)
+                    for number, entry in enumerate(index)
+                    for question, vector in zip(entry["questions"], arrays[f"vectors_{number}"])
+                ]
+        except Exception as e:
+            logger.warning(f"Ignoring unreadable question embedding cache {path}: {str(e)}")
+            return 0
+        for key, vector in loaded:
+            self._entries.setdefault(key, vector)
+        return len(loaded)
+
+QUESTION_EMBEDDINGS = QuestionEmbeddingCache()
+
+# Used by the command line and example scripts when RAGPSY_EMBEDDING_CACHE is not set
+DEFAULT_EMBEDDING_CACHE_PATH = os.path.join(".ragpsy_cache", "question_embeddings.npz")
+
+def sample_documents(vectorstore, k):
+    """Documents spread evenly over the index, for checks that need records but no question"""
+    import numpy as np
+
+    vectorstore = _current_vectorstore(vectorstore)
+    if isinstance(vectorstore, ShardView):
+        per_shard = max(1, k // len(vectorstore.names))
+        docs = [doc for name in vectorstore.names
+                for doc in sample_documents(vectorstore.registry.get(name), per_shard)]
+        return docs[:k]
+    if not _is_faiss(vectorstore):
+        return vectorstore.similarity_search("student course feedback", k=k)
+
+    total = vectorstore.index.ntotal
+    positions = np.unique(np.linspace(0, total - 1, num=min(k, total)).astype(int)) if total else []
+    return [vectorstore.docstore.search(vectorstore.index_to_docstore_id[int(i)]) for i in positions]
+
+def embed_question(vectorstore, question, trace=None):
+    """Embed a question as a (1, d) float32 array ready for FAISS search"""
+    import numpy as np
+
+    trace = trace or QueryTrace("embed_question")
+    with trace.span("embed_question"):
+        if vectorstore.embeddings is not None:
+            vector = np.array([QUESTION_EMBEDDINGS.embed(vectorstore.embeddings, question, trace)], dtype=np.float32)
+        else:
+            # Plain embedding functions have no model identity to cache under
+            vector = np.array([vectorstore._embed_query(question)], dtype=np.float32)
+        if vectorstore._normalize_L2:
+            import faiss
+            faiss.normalize_L2(vector)
+    return vector
+
+def search_vectorstore(vectorstore, vector, k, filter_metadata=None, trace=None):
+    """Search a FAISS store with an embedded question and return (Document, distance) pairs"""
+    trace = trace or QueryTrace("search_vectorstore")
+
+    columns = getattr(vectorstore, "metadata_columns", None)
+    student_level = getattr(vectorstore, "indexing_mode", "chunks") == "fields"
+    if student_level:
+        # Each student has at most one vector per field, so this many hits cover k students
+        search_k = k * len(INDEX_FIELDS)
+    else:
+        search_k = k
+    columnar = isinstance(columns, ColumnarMetadata) and len(columns) == vectorstore.index.ntotal
+    if columnar and not student_level and RETRIEVAL_SETTINGS["diversify"]:
+        # Chunks of one student are near-duplicates, so over-fetch and keep varied students
+        fetch_k = k * max(1, RETRIEVAL_SETTINGS["mmr_fetch_factor"])
+        positions = _candidate_positions(vectorstore, vector, fetch_k, filter_metadata, trace)
+        return _diverse_results(vectorstore, vector, positions, k, trace)
+
+    if filter_metadata and columnar:
+        # Evaluate the filter over all chunks first, then search only the matching ones
+        with trace.span("filter"):
+            mask = columns.mask(filter_metadata)
+        trace.count("filter_candidates", int(mask.sum()))
+        with trace.span("vector_search"):
+            scores, indices = search_with_mask(vectorstore.index, vector, search_k, mask)
+        if student_level:
+            return _group_student_hits(vectorstore, indices[0], scores[0], k, trace)
+        results = [
+            (vectorstore.docstore.search(vectorstore.index_to_docstore_id[i]), float(score))
+            for i, score in zip(indices[0], scores[0]) if i != -1
+        ]
+        trace.count("retrieved_chunks", len(results))
+        return results
+
+    # Over-fetch when filtering so enough candidates survive the filter
+    fetch_k = search_k if filter_metadata is None else max(20, search_k * 4)
+    with trace.span("vector_search"):
+        scores, indices = vectorstore.index.search(vector, fetch_k)
+
+    with trace.span("filter"):
+        filter_func = type(vectorstore)._create_filter_func(filter_metadata) if filter_metadata else None
+        results, positions = [], []
+        for i, score in zip(indices[0], scores[0]):
+            if i == -1:
+                continue
+            doc = vectorstore.docstore.search(vectorstore.index_to_docstore_id[i])
+            if filter_func is None or filter_func(doc.metadata):
+                results.append((doc, float(score)))
+                positions.append(i)
+                if len(results) == search_k:
+                    break
+
+    if student_level:
+        return _group_student_hits(vectorstore, positions, [score for _, score in results], k, trace)
+
+    trace.count("retrieved_chunks", len(results))
+    return results
+
+def retrieve_documents(vectorstore, question, k, filter_metadata=None, trace=None):
+    """Retrieve the k most similar chunks, timing embedding, search and filtering separately
+
+    Stores built in "fields" indexing mode return the k most similar students instead.
+    """
+    trace = trace or QueryTrace("retrieve_documents")
+    vectorstore = _current_vectorstore(vectorstore)
+
+    if isinstance(vectorstore, ShardView):
+        return [doc for doc, _ in vectorstore.search(question, k, filter_metadata, trace=trace)]
+
+    if not _is_faiss(vectorstore):
+        # Other vector stores only expose the combined search call
+        with trace.span("vector_search"):
+            return vectorstore.similarity_search(question, k=k, filter=filter_metadata)
+
+    vector = embed_question(vectorstore, question, trace)
+    return [doc for doc, _ in search_vectorstore(vectorstore, vector, k, filter_metadata, trace)]
+
+# Adaptive k: start from the configured k and keep as many results as the scores support
+ADAPTIVE_K_SETTINGS = {
+    "enabled": True,
+    "min_k": 2,
+    "max_k": 8,
+    "knee_factor": 2.5,  # a gap this many times the mean gap before it ends the results
+    "min_gap": 0.05,  # ignore smaller gaps (squared L2 between unit vectors)
+    "flat_spread": 0.15  # expand only while every result is within this fraction of the best distance
+}
+
+def count_matching_students(vectorstore, filter_metadata=None):
+    """Students matching filter_metadata, or None if the store keeps no columnar metadata"""
+    vectorstore = _current_vectorstore(vectorstore)
+    if isinstance(vectorstore, ShardView):
+        counts = [count_matching_students(vectorstore.registry.get(name), filter_metadata)
+                  for name in vectorstore.names]
+        return None if None in counts else sum(counts)
+    columns = getattr(vectorstore, "metadata_columns", None)
+    if not isinstance(columns, ColumnarMetadata):
+        return None
+    return int(columns.row_mask(filter_metadata).sum())
+
+def score_knee(distances, min_k=1, knee_factor=None, min_gap=None):
+    """Number of results before the first large gap in ascending distances, or None if there is none
+
+    A gap after result i counts when it is at least min_gap and knee_factor
+    times the mean gap among results 0..i, so there is always one gap to
+    compare against and at least max(min_k, 2) results are kept.
+    """
+    import numpy as np
+
+    knee_factor = ADAPTIVE_K_SETTINGS["knee_factor"] if knee_factor is None else knee_factor
+    min_gap = ADAPTIVE_K_SETTINGS["min_gap"] if min_gap is None else min_gap
+    distances = np.sort(np.asarray(distances, dtype=np.float64))
+    gaps = np.diff(distances)
+    for i in range(max(min_k - 1, 1), len(gaps)):
+        baseline = (distances[i] - distances[0]) / i
+        if gaps[i] >= min_gap and gaps[i] >= knee_factor * baseline:
+            return i + 1
+    return None
+
+def _is_inner_product(vectorstore):
+    """Whether the store's scores are similarities (larger is closer) rather than distances"""
+    import faiss
+
+    if isinstance(vectorstore, ShardView):
+        vectorstore = vectorstore.registry.get(vectorstore.names[0])
+    return vectorstore.index.metric_type == faiss.METRIC_INNER_PRODUCT
+
+def retrieve_adaptive(vectorstore, question, k, filter_metadata=None, trace=None, settings=None):
+    """Retrieve between min_k and max_k results, as many as the score distribution supports
+
+    The first search asks for k results (plus one, to see the gap after the
+    last). Results are ranked by distance, so with diversification the MMR
+    order is not kept. It stops early at the first clear gap (score_knee),
+    once every student matching the filter has been returned, or when a
+    search returns no new students. Only when the scores are still flat (all
+    within flat_spread of the best) does the request double, up to max_k;
+    otherwise the k results are kept. Stores without scores fall back to
+    retrieve_documents with k. The decision is recorded in
+    trace.attributes["adaptive_k"] and logged.
+    """
+    settings = {**ADAPTIVE_K_SETTINGS, **(settings or {})}
+    trace = trace or QueryTrace("retrieve_adaptive")
+    vectorstore = _current_vectorstore(vectorstore)
+    shards = isinstance(vectorstore, ShardView)
+    if not settings["enabled"] or not (shards or _is_faiss(vectorstore)):
+        return retrieve_documents(vectorstore, question, k, filter_metadata, trace)
+
+    population = count_matching_students(vectorstore, filter_metadata)
+    min_k = min(settings["min_k"], k)
+    max_k = max(settings["max_k"], k)
+    request = k
+
+    if shards:
+        def search(n):
+            return vectorstore.search(question, n, filter_metadata, trace=trace)
+    else:
+        vector = embed_question(vectorstore, question, trace)
+
+        def search(n):
+            return search_vectorstore(vectorstore, vector, n, filter_metadata, trace)
+
+    sign = -1.0 if _is_inner_product(vectorstore) else 1.0
+    probes, students = 0, 0
+    while True:
+        # Results come in MMR order when diversified; the gap is found in distance order
+        results = sorted(search(request + 1), key=lambda pair: sign * pair[1])
+        probes += 1
+        seen = len({doc.metadata.get("student_id", doc.id) for doc, _ in results[:request]})
+        distances = [sign * score for _, score in results]
+        keep = score_knee(distances, min_k, settings["knee_factor"], settings["min_gap"])
+        if keep is not None:
+            reason = "score_gap"
+        elif len(results) <= request:
+            keep, reason = len(results), "exhausted"
+        elif population is not None and seen >= population:
+            # Every student matching the filter is already in the results
+            keep, reason = request, "coverage"
+        elif request >= max_k:
+            keep, reason = request, "max_k"
+        elif probes > 1 and seen <= students:
+            keep, reason = request, "no_new_students"
+        elif max(distances) - min(distances) > settings["flat_spread"] * abs(min(distances)):
+            # Relevance is already falling off, so more results would only pad the prompt
+            keep, reason = request, "spread"
+        else:
+            students = seen
+            request = min(max_k, request * 2)
+            continue
+        break
+
+    docs = [doc for doc, _ in results[:keep]]
+    decision = {"k": k, "kept": len(docs), "reason": reason, "probes": probes,
+                "population": population,
+                "students": len({doc.metadata.get("student_id", doc.id) for doc in docs})}
+    trace.attributes["adaptive_k"] = decision
+    trace.count("adaptive_k.kept", len(docs))
+    trace.count("adaptive_k.saved", max(0, k - len(docs)))
+    trace.count("adaptive_k.added", max(0, len(docs) - k))
+    logger.debug(f"Adaptive k: {decision}")
+    return docs
+
+# Exhaustive retrieval pages through every matching student instead of stopping at k
+EXHAUSTIVE_SETTINGS = {
+    "page_size": 50,
+    "scan_batch": 8192,
+    "max_concurrency": 4,
+    "reduce_fan_in": 8,
+    "snippet_chars": 300
+}
+
+def _rank_matching_students(vectorstore, vector, filter_metadata, scan_batch, trace):
+    """Scores and closest chunk positions of every student matching the filter, best first
+
+    Matching vectors are scored scan_batch at a time, so besides one block of
+    vectors only a distance per matching chunk is held.
+    """
+    import numpy as np
+    import faiss
+
+    columns = getattr(vectorstore, "metadata_columns", None)
+    if not isinstance(columns, ColumnarMetadata) or len(columns) != vectorstore.index.ntotal:
+        raise ValueError("Exhaustive retrieval needs a vectorstore built by build_vectorstore")
+    with trace.span("filter"):
+        allowed = np.flatnonzero(columns.mask(filter_metadata))
+    trace.count("filter_candidates", len(allowed))
+
+    index = vectorstore.index
+    inner_product = index.metric_type == faiss.METRIC_INNER_PRODUCT
+    with trace.span("vector_search"):
+        distances = np.empty(len(allowed), dtype=np.float32)
+        for start in range(0, len(allowed), scan_batch):
+            block = index.reconstruct_batch(allowed[start:start + scan_batch])
+            if inner_product:
+                distances[start:start + len(block)] = -(block @ vector[0])
+            else:
+                distances[start:start + len(block)] = ((block - vector[0]) ** 2).sum(axis=1)
+
+        # Keep each student's closest chunk, then order students by it
+        rows = columns.row_index[allowed]
+        order = np.lexsort((distances, rows))
+        first = np.ones(len(order), dtype=bool)
+        first[1:] = rows[order[1:]] != rows[order[:-1]]
+        best = order[first]
+        ranked = best[np.argsort(distances[best], kind="stable")]
+    scores = -distances[ranked] if inner_product else distances[ranked]
+    return distances[ranked], scores, allowed[ranked]
+
+def iter_matching_students(vectorstore, question, filter_metadata=None, page_size=None, trace=None):
+    """Yield every student matching filter_metadata, most similar to the question first, in pages
+
+    Each page is a list of up to page_size Documents, one per student: the
+    student's closest chunk (or field text in "fields" indexing mode) with its
+    "rank" and "score" added to the metadata. Documents are built only for
+    the page being yielded, so memory stays bounded however many students
+    match. Shard views are ranked across all selected shards.
+    """
+    import numpy as np
+
+    trace = trace or QueryTrace("iter_matching_students")
+    page_size = page_size or EXHAUSTIVE_SETTINGS["page_size"]
+    vectorstore = _current_vectorstore(vectorstore)
+    if isinstance(vectorstore, ShardView):
+        names = vectorstore.names
+        get_store = vectorstore.registry.get
+    elif _is_faiss(vectorstore):
+        names = [None]
+        get_store = lambda name: vectorstore  # noqa: E731
+    else:
+        raise ValueError("Exhaustive retrieval needs a FAISS vectorstore or shard view")
+
+    ranked = []
+    for source, name in enumerate(names):
+        store = get_store(name)
+        vector = embed_question(store, question, trace)
+        distances, scores, positions = _rank_matching_students(
+            store, vector, filter_metadata, EXHAUSTIVE_SETTINGS["scan_batch"], trace
+        )
+        ranked.append((distances, scores, positions, np.full(len(positions), source, dtype=np.int32)))
+    distances, scores, positions, sources = (np.concatenate(parts) for parts in zip(*ranked))
+    if len(names) > 1:
+        # Shards use the same metric, so distances are comparable across them
+        order = np.argsort(distances, kind="stable")
+        scores, positions, sources = scores[order], positions[order], sources[order]
+    trace.count("matched_students", len(positions))
+
+    for start in range(0, len(positions), page_size):
+        ranks = np.arange(start, min(start + page_size, len(positions)))
+        page = [None] * len(ranks)
+        with trace.span("context_assembly"):
+            # Ranks interleave shards; load each shard once per page so a small
+            # shard cache does not evict and reload it for every document
+            for source in np.unique(sources[ranks]):
+                name = names[source]
+                store = get_store(name)
+                for slot in np.flatnonzero(sources[ranks] == source):
+                    rank = int(ranks[slot])
+                    doc = store.docstore.search(store.index_to_docstore_id[int(positions[rank])])
+                    doc.metadata["rank"] = rank + 1
+                    doc.metadata["score"] = float(scores[rank])
+                    if name is not None:
+                        doc.metadata["shard"] = name
+                    page[slot] = doc
+        trace.count("pages")
+        yield page
+
+SHARD_SETTINGS = {
+    "max_bytes": int(os.getenv("RAGPSY_SHARD_CACHE_MB", "2048")) * 1024 * 1024,
+    "max_workers": 8
+}
+
+def _has_course_data(path):
+    return all(os.path.exists(os.path.join(path, name))
+               for name in ('psych101-quantitative.csv', 'psych101-qualitative.csv'))
+
+def find_shard_sources(data_root):
+    """Map shard names such as "PSY101/F24" to the course/term directories holding their CSVs"""
+    sources = {}
+    for dirpath, dirnames, _ in os.walk(data_root):
+        dirnames.sort()
+        if _has_course_data(dirpath):
+            name = os.path.relpath(dirpath, data_root).replace(os.sep, "/")
+            sources["default" if name == "." else name] = dirpath
+    return sources
+
+INGEST_SETTINGS = {
+    "workers": os.cpu_count() or 1,
+    "partition_size": 50_000  # Students per worker task
+}
+
+# Embedding model of an ingest worker process, created once per process
+_ingest_embeddings = None
+
+def _init_ingest_worker(embeddings, embedding_settings=None, retrieval_settings=None):
+    """Process pool initializer: one thread per worker so processes do not oversubscribe cores"""
+    global _ingest_embeddings
+    for var in ("OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS"):
+        os.environ[var] = "1"
+    # Spawned workers re-import the module, so the parent's embedding and chunking settings are passed along
+    if embedding_settings:
+        EMBEDDING_SETTINGS.update(embedding_settings)
+    if retrieval_settings:
+        RETRIEVAL_SETTINGS.update(retrieval_settings)
+    EMBEDDING_SETTINGS["threads"] = 1
+    if isinstance(embeddings, OnnxEmbeddings):
+        embeddings.threads = 1
+    os.environ["TOKENIZERS_PARALLELISM"] = "false"
+    configure_logging()
+    _ingest_embeddings = embeddings
+
+def _ingest_partition(task):
+    """Build and save the partial index for one partition of a shard's students"""
+    import numpy as np
+
+    global _ingest_embeddings
+    if _ingest_embeddings is None:
+        _ingest_embeddings = create_embeddings()
+
+    df = task["df"]
+    sections = None
+    if task["indexing"] == "fields":
+        texts, metadatas, sections = create_field_documents(df)
+    else:
+        texts, metadatas = split_student_documents(create_student_documents(df))
+    vectorstore = build_vectorstore(texts, metadatas, _ingest_embeddings, sections=sections)
+
+    # Chunk indexes do not contain review vectors, so workers embed reviews for the theme clusters
+    if task["indexing"] != "fields" and THEME_SETTINGS["enabled"]:
+        vectorstore.review_vectors = embed_reviews(df, _ingest_embeddings)[2]
+
+    save_vectorstore(vectorstore, task["path"])
+    if getattr(vectorstore, "review_vectors", None) is not None:
+        np.save(os.path.join(task["path"], "review_vectors.npy"), vectorstore.review_vectors)
+    return vectorstore.index.ntotal
+
+def merge_vectorstores(vectorstores):
+    """Concatenate vectorstores built by build_vectorstore into the first one, in order"""
+    import faiss
+
+    merged = vectorstores[0]
+    for other in vectorstores[1:]:
+        if getattr(other, "indexing_mode", "chunks") != getattr(merged, "indexing_mode", "chunks"):
+            raise ValueError("Cannot merge vectorstores with different indexing modes")
+        if isinstance(merged.index, faiss.IndexFlat):
+            merged.index.merge_from(other.index)
+        else:
+            # Graph indexes cannot be merged, so the other store's vectors are inserted
+            merged.index.add(other.index.reconstruct_n(0, other.index.ntotal))
+        merged.docstore.append(other.docstore)
+    merged.index_to_docstore_id = PositionalIds(merged.index.ntotal)
+    merged.metadata_columns = merged.docstore.columns
+    return merged
+
+def _source_fingerprint(source):
+    """Sizes and modification times of a data directory's CSV files"""
+    fingerprint = {}
+    for name in ('psych101-quantitative.csv', 'psych101-qualitative.csv'):
+        stat = os.stat(os.path.join(source, name))
+        fingerprint[name] = [stat.st_size, stat.st_mtime_ns]
+    return fingerprint
+
+def _read_manifest(path):
+    try:
+        with open(os.path.join(path, "manifest.json")) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def build_shards(data_root, shards_root, embeddings=None, indexing="chunks",
+                 workers=None, partition_size=None, progress=None):
+    """Build and save one index per course/term directory under data_root
+
+    Students are split into partitions that a process pool indexes in parallel;
+    each finished partition is saved under shards_root/.partitions, so a rerun
+    after a failure only builds the missing partitions. Shards whose CSV files
+    have not changed since they were built are skipped. progress, if given, is
+    called with (done, total, shard, partition) after every partition.
+
+    Returns a report with the "built", "skipped" and "failed" shards.
+    """
+    import shutil
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+    import multiprocessing
+
+    workers = workers or INGEST_SETTINGS["workers"]
+    partition_size = partition_size or INGEST_SETTINGS["partition_size"]
+    report = {"built": [], "skipped": [], "failed": {}}
+
+    # Plan partitions for every shard that is missing or out of date
+    plans = {}
+    for name, source in find_shard_sources(data_root).items():
+        fingerprint = {"source": _source_fingerprint(source), "indexing": indexing}
+        manifest = _read_manifest(os.path.join(shards_root, name))
+        if manifest is not None and manifest.get("source") == fingerprint:
+            report["skipped"].append(name)
+            continue
+
+        df = load_data(source)
+        if df is None:
+            report["failed"][name] = ["Failed to load data"]
+            continue
+
+        part_root = os.path.join(shards_root, ".partitions", name)
+        plan = {**fingerprint, "students": len(df), "partition_size": partition_size}
+        if _read_plan(part_root) != plan:
+            # Partitions from a different plan cannot be reused
+            shutil.rmtree(part_root, ignore_errors=True)
+            os.makedirs(part_root)
+            with open(os.path.join(part_root, "plan.json"), "w") as f:
+                json.dump(plan, f)
+
+        parts = [
+            {"shard": name, "part": number, "path": os.path.join(part_root, f"part-{number:05d}"),
+             "df": df.iloc[start:start + partition_size], "indexing": indexing}
+            for number, start in enumerate(range(0, len(df), partition_size))
+        ]
+        plans[name] = {"df": df, "fingerprint": fingerprint, "parts": parts, "errors": []}
+
+    tasks = [part for plan in plans.values() for part in plan["parts"]
+             if _read_manifest(part["path"]) is None]
+    total = len(tasks)
+    logger.info(f"Ingesting {len(plans)} shards: {total} partitions to build with {workers} workers")
+
+    def finished(task, error, done):
+        if error is not None:
+            logger.error(f"Partition {task['part']} of shard {task['shard']} failed: {error}")
+            plans[task["shard"]]["errors"].append(f"partition {task['part']}: {error}")
+        if progress is not None:
+            progress(done, total, task["shard"], task["part"])
+        logger.info(f"Ingest progress: {done}/{total} partitions")
+
+    if workers > 1 and total > 1:
+        # Spawned workers start clean instead of inheriting threads from this process
+        context = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(max_workers=min(workers, total), mp_context=context,
+                                 initializer=_init_ingest_worker,
+                                 initargs=(embeddings, dict(EMBEDDING_SETTINGS), dict(RETRIEVAL_SETTINGS))) as pool:
+            futures = {pool.submit(_ingest_partition, task): task for task in tasks}
+            for done, future in enumerate(as_completed(futures), 1):
+                error = future.exception()
+                finished(futures[future], None if error is None else str(error), done)
+    else:
+        global _ingest_embeddings
+        _ingest_embeddings = embeddings
+        for done, task in enumerate(tasks, 1):
+            try:
+                _ingest_partition(task)
+                error = None
+            except Exception as e:
+                error = str(e)
+            finished(task, error, done)
+
+    # Merge the partitions of every shard that has all of them
+    for name, plan in plans.items():
+        if plan["errors"]:
+            report["failed"][name] = plan["errors"]
+            continue
+        try:
+            vectorstore = _merge_partitions(plan, embeddings)
+            save_vectorstore(vectorstore, os.path.join(shards_root, name))
+        except Exception as e:
+            logger.error(f"Merging shard {name} failed: {str(e)}")
+            report["failed"][name] = [str(e)]
+            continue
+        shutil.rmtree(os.path.join(shards_root, ".partitions", name), ignore_errors=True)
+        logger.info(f"Saved shard {name} ({vectorstore.index.ntotal} vectors)")
+        report["built"].append(name)
+
+    return report
+
+def _read_plan(part_root):
+    try:
+        with open(os.path.join(part_root, "plan.json")) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def _merge_partitions(plan, embeddings):
+    """Load a shard's saved partitions, merge them and add theme clusters and statistics"""
+    import numpy as np
+
+    partitions = [load_vectorstore(part["path"], embeddings) for part in plan["parts"]]
+    vectorstore = merge_vectorstores(partitions)
+    df = plan["df"]
+
+    if THEME_SETTINGS["enabled"]:
+        review_vectors = None
+        paths = [os.path.join(part["path"], "review_vectors.npy") for part in plan["parts"]]
+        if all(os.path.exists(path) for path in paths):
+            review_vectors = np.concatenate([np.load(path) for path in paths])
+        vectorstore.theme_clusters = build_theme_clusters(vectorstore, df, embeddings, review_vectors)
+    vectorstore.dataset_statistics = compute_dataset_statistics(df)
+    vectorstore.source_fingerprint = plan["fingerprint"]
+    return vectorstore
+
+class ShardRegistry:
+    """Saved per-course/term indexes loaded on demand, with an LRU of loaded shards under a RAM cap"""
+    def __init__(self, shards_root, embeddings, max_bytes=None, max_workers=None):
+        self.shards_root = shards_root
+        self.embeddings = embeddings
+        self.max_bytes = max_bytes if max_bytes is not None else SHARD_SETTINGS["max_bytes"]
+        self.max_workers = max_workers or SHARD_SETTINGS["max_workers"]
+        self._loaded = OrderedDict()  # name -> (vectorstore, nbytes), least recently used first
+        self._lock = threading.Lock()
+        self._loading = SingleFlight()
+        self._pool = None
+
+    def names(self):
+        """All shards available on disk"""
+        names = []
+        for dirpath, dirnames, filenames in os.walk(self.shards_root):
+            dirnames[:] = sorted(d for d in dirnames if not d.startswith("."))
+            if "manifest.json" in filenames:
+                names.append(os.path.relpath(dirpath, self.shards_root).replace(os.sep, "/"))
+        return names
+
+    @property
+    def loaded_bytes(self):
+        with self._lock:
+            return sum(nbytes for _, nbytes in self._loaded.values())
+
+    def loaded(self):
+        """Names of the shards currently in memory, least recently used first"""
+        with self._lock:
+            return list(self._loaded)
+
+    def get(self, name):
+        """Return a shard's vectorstore, loading it and evicting cold shards if needed"""
+        with self._lock:
+            entry = self._loaded.get(name)
+            if entry is not None:
+                self._loaded.move_to_end(name)
+                METRICS.incr("shards.hit")
+                return entry[0]
+
+        # Concurrent queries for the same cold shard share one load
+        vectorstore, _ = self._loading.do(name, lambda: self._load(name))
+        return vectorstore
+
+    def _load(self, name):
+        with self._lock:
+            # Another caller may have finished loading it since get() looked
+            if name in self._loaded:
+                return self._loaded[name][0]
+
+        path = os.path.join(self.shards_root, *name.split("/"))
+        if not os.path.exists(os.path.join(path, "manifest.json")):
+            raise KeyError(f"Unknown shard: {name}")
+
+        start = time.perf_counter()
+        vectorstore = load_vectorstore(path, self.embeddings)
+        nbytes = vectorstore_nbytes(vectorstore)
+        METRICS.incr("shards.load")
+        METRICS.observe("shards.load_ms", (time.perf_counter() - start) * 1000)
+
+        with self._lock:
+            self._loaded[name] = (vectorstore, nbytes)
+            self._loaded.move_to_end(name)
+            # Evict least recently used shards, but always keep the one just loaded
+            total = sum(size for _, size in self._loaded.values())
+            while total > self.max_bytes and len(self._loaded) > 1:
+                evicted, (_, size) = self._loaded.popitem(last=False)
+                total -= size
+                METRICS.incr("shards.evict")
+                logger.debug(f"Evicted shard {evicted} ({size} bytes)")
+        return vectorstore
+
+    def view(self, names=None):
+        """A queryable set of shards; pass it to query_rag in place of a vectorstore"""
+        return ShardView(self, list(names) if names is not None else self.names())
+
+    def _map(self, fn, items):
+        if len(items) == 1:
+            return [fn(items[0])]
+        with self._lock:
+            if self._pool is None:
+                self._pool = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="ragpsy-shard")
+        return list(self._pool.map(fn, items))
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False)
+            self._pool = None
+
+class ShardView:
+    """A subset of shards searched in parallel with merged top-k results"""
+    def __init__(self, registry, names):
+        if not names:
+            raise ValueError("No shards selected")
+        self.registry = registry
+        self.names = names
+
+    @property
+    def theme_clusters(self):
+        """Theme clusters are per shard, so they only answer questions about a single shard"""
+        if len(self.names) != 1:
+            return None
+        return getattr(self.registry.get(self.names[0]), "theme_clusters", None)
+
+    def search(self, question, k, filter_metadata=None, trace=None):
+        """Fan the question out to every shard and keep the k closest results overall"""
+        trace = trace or QueryTrace("shard_search")
+        trace.count("shards", len(self.names))
+
+        # Shards share one embedding model, so the question is embedded once
+        with trace.span("embed_question"):
+            vector = QUESTION_EMBEDDINGS.embed(self.registry.embeddings, question, trace)
+
+        def shard_query(vectorstore):
+            import numpy as np
+
+            query = np.array([vector], dtype=np.float32)
+            if vectorstore._normalize_L2:
+                import faiss
+                faiss.normalize_L2(query)
+            return query
+
+        def search_shard(name):
+            vectorstore = self.registry.get(name)
+            results = search_vectorstore(vectorstore, shard_query(vectorstore), k, filter_metadata,
+                                         QueryTrace("shard"))
+            for doc, _ in results:
+                doc.metadata["shard"] = name
+            return results
+
+        def shard_candidates(name):
+            vectorstore = self.registry.get(name)
+            if not _is_chunk_store(vectorstore):
+                return None
+            query = shard_query(vectorstore)
+            positions = _candidate_positions(vectorstore, query, fetch_k, filter_metadata, QueryTrace("shard"))
+            return vectorstore, query, positions, vectorstore.index.reconstruct_batch(positions)
+
+        if RETRIEVAL_SETTINGS["diversify"]:
+            # Diversify over the union of every shard's candidates, as one combined index would
+            fetch_k = k * max(1, RETRIEVAL_SETTINGS["mmr_fetch_factor"])
+            with trace.span("vector_search"):
+                candidates = self.registry._map(shard_candidates, self.names)
+            if all(candidate is not None for candidate in candidates):
+                return self._diverse_merge(candidates, k, fetch_k, trace)
+
+        with trace.span("vector_search"):
+            per_shard = self.registry._map(search_shard, self.names)
+
+        # Shards share one metric; inner-product scores are similarities, so larger is closer
+        sign = -1.0 if _is_inner_product(self) else 1.0
+        merged = sorted((pair for results in per_shard for pair in results), key=lambda pair: sign * pair[1])
+        trace.count("retrieved_chunks", min(k, len(merged)))
+        return merged[:k]
+
+    def _diverse_merge(self, candidates, k, fetch_k, trace):
+        """Keep the fetch_k closest candidates over all shards, then pick k students by MMR"""
+        import numpy as np
+
+        with trace.span("diversify"):
+            shard_ids = np.concatenate([np.full(len(positions), shard, dtype=np.int64)
+                                        for shard, (_, _, positions, _) in enumerate(candidates)])
+            positions = np.concatenate([positions for _, _, positions, _ in candidates])
+            vectors = np.concatenate([vectors for _, _, _, vectors in candidates])
+            query = candidates[0][1][0]
+            distances = np.concatenate([_distances(vectorstore.index, vectors, query)
+                                        for vectorstore, _, _, vectors in candidates])
+            # Rows are numbered per shard, so the shard number keeps students apart
+            rows = np.concatenate([vectorstore.metadata_columns.row_index[positions]
+                                   for vectorstore, _, positions, _ in candidates]).astype(np.int64)
+            rows += shard_ids << 32
+            closest = np.argsort(distances, kind="stable")[:fetch_k]
+            chosen = closest[_mmr_order(vectors[closest], distances[closest], rows[closest], query, k,
+                                        RETRIEVAL_SETTINGS["mmr_lambda"])]
+
+        # Report scores as search_with_mask does: similarities for inner-product indexes
+        sign = -1.0 if _is_inner_product(self) else 1.0
+        results = []
+        for i in chosen:
+            vectorstore = candidates[shard_ids[i]][0]
+            doc = vectorstore.docstore.search(vectorstore.index_to_docstore_id[int(positions[i])])
+            doc.metadata["shard"] = self.names[shard_ids[i]]
+            results.append((doc, float(sign * distances[i])))
+        trace.count("diversify_candidates", len(closest))
+        trace.count("retrieved_chunks", len(results))
+        return results
+
+class PromptRegistry:
+    """Prompt layouts compiled once: a static prefix followed by the fields that change per call
 
-        Student Feedback:
-        {row['course_review']}
+    Every prompt starts with the same preamble and then its own fixed instructions,
+    and all per-call values (filter, context, question) come last, so repeated
+    query shapes share a long identical prefix that LLM backends with prompt or
+    KV prefix caching can reuse.
+    """
+    def __init__(self, preamble):
+        self.preamble = preamble
+        self._prompts = {}
 
-        Learning Assessment:
-        {row['learning_outcomes_assessment']}
-        """
-        
-        # Create focused metadata
-        metadata = {
-            'student_id': row['student_id'],
-            'international_student': row['international_student'],
-            'first_gen_student': row['first_gen_student'],
-            'final_exam': float(row['final_exam'])
-        }
-        
-        documents.append({"content": doc_text.strip(), "metadata": metadata})
-    
-    return documents
+    def register(self, name, instructions, dynamic):
+        """Add a prompt; instructions are sent verbatim, dynamic is a str.format template"""
+        fields = [field for _, field, _, _ in string.Formatter().parse(dynamic) if field]
+        self._prompts[name] = (f"{self.preamble}\n\n{instructions}\n\n", dynamic, frozenset(fields))
+
+    def prefix(self, name):
+        """Static text every rendering of the prompt starts with"""
+        return self._prompts[name][0]
+
+    def parts(self, name, **values):
+        """(static prefix, rendered dynamic part) of a prompt"""
+        prefix, dynamic, fields = self._prompts[name]
+        missing = fields - values.keys()
+        if missing:
+            raise ValueError(f"Prompt {name!r} is missing values for {', '.join(sorted(missing))}")
+        return prefix, dynamic.format(**values)
+
+    def render(self, name, **values):
+        """Full prompt text"""
+        return "".join(self.parts(name, **values))
+
+# Shared by every prompt; nothing in it may vary between calls
+PROMPT_PREAMBLE = f"""You are analyzing psychology course data. Each student record has an id, the demographic \
+fields {", ".join(CATEGORICAL_COLUMNS)}, the numeric fields {", ".join(NUMERIC_COLUMNS)} \
+(grades and attendance in percent, study hours per week), a course review and a learning assessment \
+written by the student. The dataset is synthetic sample data.
+Base every statement on the records, statistics or summaries given below. Refer to students by id, \
+give counts and numbers where the data has them, do not invent students, grades or quotes, and say \
+plainly when the data is too thin to support a conclusion."""
+
+PROMPTS = PromptRegistry(PROMPT_PREAMBLE)
+PROMPTS.register(
+    "analysis",
+    "Analyze the student records to answer the question. Provide specific insights with evidence.",
+    "Students: {students}\\nContext: {context}\\nQuestion: {question}\\n\\nAnalysis:"
+)
+PROMPTS.register(
+    "comparison",
+    """Analyze the student records and provide a detailed comparison. Focus on:
+1. Clear statistical comparison between groups
+2. Notable patterns or differences
+3. Important context or limitations of the comparison""",
+    "Context: {context}\\nQuestion: {question}\\n\\nComparative Analysis:"
+)
+PROMPTS.register(
+    "themes",
+    """Summarize the common themes in the student feedback. The themes were found by clustering every \
+course review in the cohort, so the counts describe all students, not a sample. Name each theme, say how \
+common it is and illustrate it with the quoted reviews.""",
+    "Themes: {context}\\nQuestion: {question}\\n\\nAnalysis:"
+)
+PROMPTS.register(
+    "summary_map",
+    """Summarize a page of students as they relate to the question. Students are listed most relevant \
+first. Name the students (by id) who stand out, give counts where you can and do not generalize beyond \
+the list.""",
+    "Students {first}-{last} of the {total} students matching the filter:\\n{context}\\n"
+    "Question: {question}\\n\\nSummary:"
+)
+_REDUCE_INSTRUCTIONS = """The partial summaries below together cover every student matching the filter, \
+in order of relevance. Keep student ids, and add counts up across the summaries."""
+PROMPTS.register(
+    "summary_reduce",
+    _REDUCE_INSTRUCTIONS + " Combine them into one summary, keeping the details the question needs.",
+    "Summaries of all {total} psychology students matching the filter:\\n{context}\\n"
+    "Question: {question}\\n\\nSummary:"
+)
+PROMPTS.register(
+    "summary_answer",
+    _REDUCE_INSTRUCTIONS + " Combine them into one answer to the question.",
+    "Summaries of all {total} psychology students matching the filter:\\n{context}\\n"
+    "Question: {question}\\n\\nAnswer:"
+)
+
+def render_prompt(name, trace=None, **values):
+    """Render a registered prompt, recording its name and the size of its static prefix"""
+    trace = trace or QueryTrace("render_prompt")
+    with trace.span("prompt_render"):
+        prefix, dynamic = PROMPTS.parts(name, **values)
+    trace.attributes["prompt"] = name
+    trace.count("prompt_static_chars", len(prefix))
+    trace.count("prompt_dynamic_chars", len(dynamic))
+    return prefix + dynamic
+
+def answer_theme_question(llm, question, themes, group=None, trace=None):
+    """Answer a theme question with one LLM call over the precomputed review clusters"""
+    trace = trace or QueryTrace("answer_theme_question")
+    trace.attributes["route"] = "themes"
+    with trace.span("context_assembly"):
+        context = format_theme_clusters(themes, group)
+
+    prompt_text = render_prompt("themes", trace, context=context, question=question)
 
-def setup_rag(data_path):
-    """Initialize the RAG system"""
     try:
-        # Load environment variables for API key
-        load_dotenv()
-        api_key = os.getenv("OPENAI_API_KEY")
-        if not api_key:
-            raise ValueError("OpenAI API key not found")
-        
-        # Add caching to save tokens
-        langchain.cache = InMemoryCache()
-        
-        # Initialize LLM with optimized settings
-        llm = ChatOpenAI(
-            temperature=0.5,  # Lower temperature for more focused responses
-            model="gpt-3.5-turbo",
-            cache=True  # Enable caching
-        )
-            
-        # Configure OpenAI settings
-        os.environ["OPENAI_API_KEY"] = api_key
-            
-        # Load and process data
-        df = load_data(data_path)
-        if df is None:
-            raise ValueError("Failed to load data")
-            
-        # Create document collection
-        documents = create_student_documents(df)
-        
-        # Set up text splitter with optimized settings
-        text_splitter = RecursiveCharacterTextSplitter(
-            chunk_size=500,      # Smaller chunks for more focused retrieval
-            chunk_overlap=50,    # Reduced overlap
-            separators=["\n\n", "\n", ". ", " ", ""],  # More granular splitting
-            length_function=len
-        )
-        
-        # Split documents
-        texts = []
-        metadatas = []
-        for doc in documents:
-            chunks = text_splitter.split_text(doc["content"])
-            texts.extend(chunks)
-            metadatas.extend([doc["metadata"]] * len(chunks))
-        
-        # Initialize embeddings and vector store
-        embeddings = HuggingFaceEmbeddings(
-            model_name="sentence-transformers/all-MiniLM-L6-v2"
-        )
-        
-        vectorstore = FAISS.from_texts(
-            texts=texts,
-            embedding=embeddings,
-            metadatas=metadatas
-        )
-        
-        # Initialize LLM
-        llm = ChatOpenAI(temperature=0.7, model="gpt-3.5-turbo")
-        
-        return vectorstore, llm, df
-        
-    except Exception as e:
-        print(f"Error setting up RAG: {str(e)}")
-        return None, None, None
+        response = invoke_llm(llm, prompt_text, trace=trace)
+    except LLMUnavailableError as e:
+        logger.warning(f"LLM unavailable, returning theme clusters: {str(e)}")
+        trace.attributes["degraded"] = True
+        return build_degraded_response(context)
+    return response.content
 
-def validate_data_sample(docs, filter_metadata):
-    """Validate the data sample and return information about limitations"""
+_EXHAUSTIVE_PATTERN = re.compile(
+    r"\b(?:list|show|name|identify|find)\s+(?:me\s+)?(?:all|every|each)\b|"
+    r"\b(?:all|every|each)\s+(?:of\s+)?(?:the\s+)?students?\s+(?:who|with|that|whose|where)\b"
+)
+
+def is_exhaustive_question(question):
+    """Detect questions that ask about every matching student rather than the most relevant few"""
+    return bool(_EXHAUSTIVE_PATTERN.search(question.lower()))
+
+# Structured fields shown for each student in exhaustive summaries
+STUDENT_SUMMARY_FIELDS = CATEGORICAL_COLUMNS + NUMERIC_COLUMNS
+
+def format_student_line(doc):
+    """One line per student: id, structured fields and a snippet of the matched text"""
+    def number(value):
+        return f"{value:g}" if isinstance(value, float) else value
+
+    facts = ", ".join(
+        f"{field}={number(doc.metadata[field])}" for field in STUDENT_SUMMARY_FIELDS if field in doc.metadata
+    )
+    text = _snippet(" ".join(doc.page_content.split()), EXHAUSTIVE_SETTINGS["snippet_chars"])
+    return f"- {doc.metadata.get('student_id', doc.id)} ({facts}): {text}"
+
+def _summarize_students(llm, question, page, total):
+    """Map step: summarize one page of students; returns (summary, degraded, trace)"""
+    trace = QueryTrace("summary_map")
+    context = "\n".join(format_student_line(doc) for doc in page)
+    first, last = page[0].metadata["rank"], page[-1].metadata["rank"]
+    prompt_text = render_prompt("summary_map", trace, first=first, last=last, total=total,
+                                context=context, question=question)
     try:
-        # Count unique student IDs in retrieved documents
-        student_ids = set()
-        for doc in docs:
-            if 'student_id' in doc.metadata:
-                student_ids.add(doc.metadata['student_id'])
-        
-        sample_size = len(student_ids)
-        
-        # Create warning message if sample size is small
-        if sample_size < 3:
-            return f"Note: Analysis is based on a small sample of {sample_size} student(s). Interpret results with caution."
-        elif sample_size < 5:
-            return f"Note: Analysis is based on {sample_size} students."
-        else:
-            return ""
-            
-    except Exception as e:
-        return "Warning: Unable to determine sample size."
-    
-def query_rag(vectorstore, llm, question, filter_metadata=None, memory=None):
-    """Enhanced query function with error handling and data validation"""
+        return invoke_llm(llm, prompt_text, trace=trace).content, False, trace
+    except LLMUnavailableError as e:
+        logger.warning(f"LLM unavailable, keeping the student list for ranks {first}-{last}: {str(e)}")
+        return f"Students {first}-{last}:\n{context}", True, trace
+
+def _combine_summaries(llm, question, summaries, total, final):
+    """Reduce step: merge partial summaries into one; returns (summary, degraded, trace)"""
+    trace = QueryTrace("summary_reduce")
+    joined = "\n\n".join(summaries)
+    prompt_text = render_prompt("summary_answer" if final else "summary_reduce", trace,
+                                total=total, context=joined, question=question)
     try:
-        # Retrieve documents
-        docs = vectorstore.similarity_search(
-            question,
-            k=2,
-            filter=filter_metadata
-        )
-        
-        # Check if we found any relevant documents
-        if not docs:
-            return "No relevant data found for your question. Try adjusting your question or using a different filter."
-            
-        # Validate sample size and get any warnings
-        sample_size_warning = validate_data_sample(docs, filter_metadata)
+        return invoke_llm(llm, prompt_text, trace=trace).content, False, trace
+    except LLMUnavailableError as e:
+        logger.warning(f"LLM unavailable, concatenating partial summaries: {str(e)}")
+        return joined, True, trace
+
+def summarize_matching_students(vectorstore, llm, question, filter_metadata=None, page_size=None,
+                                max_concurrency=None, trace=None):
+    """Answer a question about every student matching filter_metadata with map-reduce summarization
+
+    Pages from iter_matching_students are summarized by at most max_concurrency
+    concurrent LLM calls, with no more pages read ahead than are being
+    summarized. The page summaries are then combined reduce_fan_in at a time
+    until one answer is left. Without the LLM the student lists themselves are
+    returned.
+    """
+    from concurrent.futures import wait, FIRST_COMPLETED
+
+    trace = trace or QueryTrace("summarize_matching_students")
+    trace.attributes["route"] = "exhaustive"
+    max_concurrency = max_concurrency or EXHAUSTIVE_SETTINGS["max_concurrency"]
+    fan_in = max(2, EXHAUSTIVE_SETTINGS["reduce_fan_in"])
+    summaries, degraded = {}, False
+
+    def record(result):
+        # Calls run on worker threads with their own traces; counters are merged here
+        nonlocal degraded
+        summary, failed, call_trace = result
+        degraded |= failed
+        for name, value in call_trace.counters.items():
+            trace.count(name, value)
+        trace.count("llm_calls")
+        return summary
+
+    def summarize(number, page, total):
+        return number, _summarize_students(llm, question, page, total)
+
+    def collect(futures):
+        for future in futures:
+            number, result = future.result()
+            summaries[number] = record(result)
+
+    with ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix="ragpsy-summary") as pool:
+        pending = set()
+        pages = iter_matching_students(vectorstore, question, filter_metadata, page_size, trace)
+        for number, page in enumerate(pages):
+            if len(pending) >= max_concurrency:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                collect(done)
+            pending.add(pool.submit(summarize, number, page, trace.counters["matched_students"]))
+        collect(wait(pending).done)
+
+        total = trace.counters.get("matched_students", 0)
+        if not total:
+            return "No students match the filter."
+        level = [summaries[number] for number in sorted(summaries)]
+        while len(level) > fan_in:
+            futures = [pool.submit(_combine_summaries, llm, question, level[i:i + fan_in], total, False)
+                       for i in range(0, len(level), fan_in)]
+            level = [record(future.result()) for future in futures]
+
+    # A single page's summary already answers the question
+    answer = level[0] if len(summaries) == 1 else record(_combine_summaries(llm, question, level, total, True))
+    if degraded:
+        trace.attributes["degraded"] = True
+    return answer
+
+def answer_from_documents(llm, question, docs, comparative=False, filter_metadata=None, trace=None):
+    """Render the query prompt over retrieved documents and ask the LLM"""
+    trace = trace or QueryTrace("answer_from_documents")
+    if not docs:
+        return "No relevant information found. Try rephrasing your question."
         
-        # Combine context
+    with trace.span("context_assembly"):
         context = "\n\n".join([doc.page_content for doc in docs])
-        
-        # Create enhanced prompt
-        prompt = PromptTemplate(
-            template="""You are analyzing psychology student data. Provide a detailed analysis based only on the provided context.
-            
-            Context: {context}
-            Question: {question}
-            Data Limitations: {sample_size_warning}
-            
-            Analysis:""",
-            input_variables=["context", "question", "sample_size_warning"]
-        )
-        
-        # Generate response
-        chain = prompt | llm
-        response = chain.invoke({
-            "context": context,
-            "question": question,
-            "sample_size_warning": sample_size_warning
-        })
-        
-        return response.content
-        
-    except Exception as e:
-        return f"Error processing your question: {str(e)}"
-    
-def is_comparative_question(question):
-    """Detect if a question is asking for comparison between groups"""
-    comparative_phrases = [
-        'compare', 'versus', 'vs', 'difference', 'better', 'worse',
-        'than', 'between', 'higher', 'lower', 'more', 'less'
-    ]
-    demographic_terms = ['male', 'female', 'gender', 'international', 'first-gen']
-    
-    question_lower = question.lower()
-    has_comparative = any(phrase in question_lower for phrase in comparative_phrases)
-    has_demographic = any(term in question_lower for term in demographic_terms)
+
+    # Enhanced prompt for comparative questions, which ignore the group filter
+    if comparative:
+        prompt_text = render_prompt("comparison", trace, context=context, question=question)
+    else:
+        prompt_text = render_prompt("analysis", trace, students=describe_filter(filter_metadata),
+                                    context=context, question=question)
+
+    # Identical prompts already in flight share a single LLM call
+    try:
+        response = invoke_llm(llm, prompt_text, trace=trace)
+    except LLMUnavailableError as e:
+        logger.warning(f"LLM unavailable, returning degraded response: {str(e)}")
+        trace.attributes["degraded"] = True
+        return build_degraded_response(context)
     
-    return has_comparative and has_demographic
+    return response.content
 
-def query_rag(vectorstore, llm, question, filter_metadata=None):
+@profiled("query_rag")
+def query_rag(vectorstore, llm, question, filter_metadata=None, trace=None):
     """Enhanced query function with comparative analysis support"""
+    if not question or len(question.strip()) < 3:
+        return "Please enter a longer question."
+
+    trace = trace or QueryTrace()
+    # The whole query runs against one snapshot even if a reload swaps in another meanwhile
+    vectorstore = _current_vectorstore(vectorstore)
     try:
+        # Numeric conditions in the question ("more than 8 hours") become range filters
+        numeric_filter = parse_numeric_filters(question)
+        if numeric_filter:
+            logger.debug(f"Parsed numeric filter from question: {numeric_filter}")
+            trace.attributes["numeric_filter"] = numeric_filter
+
+        # Theme questions are answered from the precomputed clusters covering every review
+        themes = getattr(vectorstore, "theme_clusters", None)
+        if isinstance(themes, dict) and not numeric_filter and is_theme_question(question):
+            group = theme_question_group(question, filter_metadata)
+            if group is not False:
+                return answer_theme_question(llm, question, themes, group, trace)
+
+        # "List all students who..." questions with a filter are answered over every match, not the top k
+        if is_exhaustive_question(question) and (filter_metadata or numeric_filter):
+            return summarize_matching_students(
+                vectorstore, llm, question, merge_filters(filter_metadata, numeric_filter), trace=trace
+            )
+
         # Check if this is a comparative question
-        if is_comparative_question(question):
-            print("\nDebug - Detected comparative question, retrieving data for all groups...")
-            # For comparative questions, ignore the filter and get data for all groups
-            docs = vectorstore.similarity_search(
+        comparative = is_comparative_question(question)
+        trace.attributes["comparative"] = comparative
+        if comparative:
+            logger.debug("Detected comparative question, retrieving data for all groups")
+            # For comparative questions, ignore the group filter and get data for all groups
+            combined_filter = numeric_filter or None
+            docs = retrieve_adaptive(
+                vectorstore,
                 question,
-                k=6  # Increased to get more documents for comparison
+                k=RETRIEVAL_SETTINGS["comparative_k"],  # Increased to get more documents for comparison
+                filter_metadata=combined_filter,
+                trace=trace,
+                # A comparison needs students from every group, so never cut below the regular k
+                settings={"min_k": RETRIEVAL_SETTINGS["k"]}
             )
         else:
             # Normal filtered query
-            print(f"\nDebug - Applied filter: {filter_metadata}")
-            docs = vectorstore.similarity_search(
+            combined_filter = merge_filters(filter_metadata, numeric_filter)
+            logger.debug(f"Applied filter: {combined_filter}")
+            docs = retrieve_adaptive(
+                vectorstore,
                 question,
-                k=3,
-                filter=filter_metadata
-            )
-        
-        print(f"Debug - Number of documents found: {len(docs)}")
-        
-        if not docs:
-            return "No relevant information found. Try rephrasing your question."
-            
-        # Enhanced prompt for comparative questions
-        if is_comparative_question(question):
-            prompt = PromptTemplate(
-                template="""Analyze the psychology student data and provide a detailed comparison.
-                Focus on:
-                1. Clear statistical comparison between groups
-                2. Notable patterns or differences
-                3. Important context or limitations of the comparison
-                
-                Context: {context}
-                Question: {question}
-                
-                Comparative Analysis:""",
-                input_variables=["context", "question"]
-            )
-        else:
-            # Regular prompt for non-comparative questions
-            prompt = PromptTemplate(
-                template="""Analyze the psychology student data based on this context. 
-                {filter_context}Provide specific insights with evidence.
-                
-                Context: {context}
-                Question: {question}
-                
-                Analysis:""",
-                input_variables=["context", "question", "filter_context"]
+                k=RETRIEVAL_SETTINGS["k"],
+                filter_metadata=combined_filter,
+                trace=trace
             )
         
-        # Generate response
-        context = "\n\n".join([doc.page_content for doc in docs])
-        
-        if is_comparative_question(question):
-            chain = prompt | llm
-            response = chain.invoke({
-                "context": context,
-                "question": question
-            })
-        else:
-            filter_context = filter_metadata.get('gender', '') if filter_metadata else ''
-            chain = prompt | llm
-            response = chain.invoke({
-                "context": context,
-                "question": question,
-                "filter_context": filter_context
-            })
+        logger.debug(f"Number of documents found: {len(docs)}")
         
-        return response.content
+        # The prompt describes the students that were actually retrieved
+        return answer_from_documents(llm, question, docs, comparative, combined_filter, trace)
         
     except Exception as e:
-        print(f"Unexpected error: {str(e)}")
+        logger.exception(f"Unexpected error: {str(e)}")
+        trace.attributes["error"] = type(e).__name__
         return "An error occurred. Please try again."
+
+    finally:
+        trace.finish()
     
+# Follow-up questions reuse the students retrieved earlier in the same conversation
+SESSION_SETTINGS = {
+    "max_students": 50,
+    "prefetch_k": 12  # chunks kept from a new question's search for its follow-ups
+}
+
+_FOLLOW_UP_PATTERN = re.compile(
+    r"\b(?:they|them|their|theirs|these|those|such students|same students|this group|that group)\b|"
+    r"^\s*(?:and|what about|how about)\b"
+)
+
+def is_follow_up_question(question):
+    """Detect questions that refer back to the students discussed in earlier turns"""
+    return bool(_FOLLOW_UP_PATTERN.search(question.lower()))
+
+# Demographic words that name a cohort of their own ("How do first-generation students ...")
+_COHORT_PATTERN = re.compile(
+    r"\b(?:male|female|men|women|gender|international|domestic|first[- ]gen(?:eration)?)\b"
+)
+
+def names_cohort(question):
+    """Detect questions that name the group of students they are about"""
+    return bool(_COHORT_PATTERN.search(question.lower()))
+
+def describe_filter(filter_metadata):
+    """Short readable form of a metadata filter, e.g. "international_student = Yes and attendance_rate < 80" """
+    if not filter_metadata:
+        return "all students"
+    if "$and" in filter_metadata:
+        return " and ".join(describe_filter(f) for f in filter_metadata["$and"])
+    if "$or" in filter_metadata:
+        return "(" + " or ".join(describe_filter(f) for f in filter_metadata["$or"]) + ")"
+    if "$not" in filter_metadata:
+        return f"not ({describe_filter(filter_metadata['$not'])})"
+
+    symbols = {"$eq": "=", "$neq": "!=", "$gt": ">", "$gte": ">=", "$lt": "<", "$lte": "<=",
+               "$in": "in", "$nin": "not in"}
+    parts = []
+    for field, condition in filter_metadata.items():
+        if isinstance(condition, dict):
+            parts += [f"{field} {symbols.get(op, op)} {value:g}" if isinstance(value, float)
+                      else f"{field} {symbols.get(op, op)} {value}" for op, value in condition.items()]
+        elif isinstance(condition, (list, tuple, set)):
+            parts.append(f"{field} in {', '.join(map(str, condition))}")
+        else:
+            parts.append(f"{field} = {condition}")
+    return " and ".join(parts)
+
+def _same_cohort(filter_metadata, working_filter):
+    """Check whether a turn's filter selects no other students than the working set's filter"""
+    if not filter_metadata or filter_metadata == working_filter:
+        return True
+    # The working set may also carry the numeric conditions parsed from its question
+    return isinstance(working_filter, dict) and filter_metadata in working_filter.get("$and", [])
+
+def rewrite_follow_up(question, filter_metadata, student_count):
+    """Make a follow-up self-contained by naming the cohort its pronouns refer to"""
+    return f"{question}\n(Follow-up about the {student_count} students discussed so far: {describe_filter(filter_metadata)})"
+
+class SessionWorkingSet:
+    """Student rows retrieved in one conversation and the filter that selected them"""
+    def __init__(self, max_students=None):
+        self.max_students = max_students or SESSION_SETTINGS["max_students"]
+        self.filter = None
+        self.rows = OrderedDict()  # student row -> None, most recently used last
+        self.vectorstore_id = None
+
+    def __len__(self):
+        return len(self.rows)
+
+    def reset(self, vectorstore, filter_metadata):
+        """Start a new working set, e.g. when the conversation moves to another cohort"""
+        self.vectorstore_id = id(vectorstore)
+        self.filter = filter_metadata
+        self.rows.clear()
+
+    def add(self, rows):
+        """Remember student rows, dropping the least recently used beyond max_students"""
+        for row in rows:
+            self.rows[int(row)] = None
+            self.rows.move_to_end(int(row))
+        while len(self.rows) > self.max_students:
+            self.rows.popitem(last=False)
+
+    def valid_for(self, vectorstore):
+        """Rows index one vectorstore snapshot; a reload or another store invalidates them"""
+        return bool(self.rows) and self.vectorstore_id == id(vectorstore)
+
+def retrieve_with_working_set(vectorstore, question, k, filter_metadata, working_set, follow_up, trace=None):
+    """Retrieve k chunks for a conversation turn, reusing the session's students where possible
+
+    A follow-up searches only the chunks of the students already in the working
+    set that still match the filter. If fewer than k of them match (the focus
+    narrowed or moved), only the missing students are fetched from the index,
+    excluding those already held. Any other question searches the whole index
+    and replaces the working set.
+    """
+    import numpy as np
+
+    trace = trace or QueryTrace("retrieve_with_working_set")
+    columns = vectorstore.metadata_columns
+    vector = embed_question(vectorstore, question, trace)
+    with trace.span("filter"):
+        mask = columns.mask(filter_metadata)
+
+    if not (follow_up and working_set.valid_for(vectorstore)):
+        # One search fills the working set beyond k, so follow-ups have students to choose from
+        with trace.span("vector_search"):
+            _, indices = search_with_mask(vectorstore.index, vector, max(k, SESSION_SETTINGS["prefetch_k"]), mask)
+        prefetched = indices[0][indices[0] != -1]
+        positions, _ = select_diverse(vectorstore.index, columns.row_index, vector, prefetched, k)
+        working_set.reset(vectorstore, filter_metadata)
+        working_set.add(columns.row_index[prefetched[::-1]])
+        trace.count("working_set_misses", len(positions))
+    else:
+        with trace.span("working_set"):
+            cached = np.array([position for row in working_set.rows for position in columns.row_positions(row)],
+                              dtype=np.int64)
+            cached = cached[mask[cached]]
+            cached_rows = set(columns.row_index[cached].tolist())
+        trace.count("working_set_students", len(cached_rows))
+        fetched = np.empty(0, dtype=np.int64)
+        if len(cached_rows) < k:
+            # Fetch only what the working set lacks
+            missing = mask.copy()
+            missing[cached] = False
+            with trace.span("vector_search"):
+                _, indices = search_with_mask(vectorstore.index, vector, k - len(cached_rows), missing)
+            fetched = indices[0][indices[0] != -1]
+        trace.count("working_set_hits", len(cached_rows))
+        trace.count("working_set_misses", len(fetched))
+        with trace.span("vector_search"):
+            positions, _ = select_diverse(vectorstore.index, columns.row_index, vector,
+                                          np.concatenate([cached, fetched]), k)
+        working_set.filter = filter_metadata
+        working_set.add(columns.row_index[positions][::-1])
+
+    trace.count("retrieved_chunks", len(positions))
+    return [vectorstore.docstore.search(vectorstore.index_to_docstore_id[int(i)]) for i in positions]
+
+def query_rag_with_memory(vectorstore, llm, question, filter_metadata=None, memory=None, trace=None):
+    """query_rag for a conversation, reusing the students and filter of earlier turns
+
+    memory is an EnhancedConversationMemory (or None for a single question).
+    Follow-up questions ("What study habits do they mention?") that name no
+    cohort of their own (no numeric condition or demographic word, and no filter
+    beyond the one already in use) keep the cohort of the previous turn, are
+    rewritten to name it, and are answered from the session's working set of
+    students, fetching only the students it lacks. Any other question starts a
+    new working set with its own filter. Theme, comparative and list-all
+    questions that are not follow-ups, and other store types, go through query_rag.
+    """
+    if memory is None:
+        return query_rag(vectorstore, llm, question, filter_metadata, trace=trace)
+    if not question or len(question.strip()) < 3:
+        return "Please enter a longer question."
+
+    trace = trace or QueryTrace()
+    vectorstore = _current_vectorstore(vectorstore)
+    working_set = memory.working_set
+    numeric_filter = parse_numeric_filters(question)
+    # "their" in a question that names its own cohort does not refer back to earlier students
+    follow_up = (len(working_set) > 0 and is_follow_up_question(question)
+                 and _same_cohort(filter_metadata, working_set.filter)
+                 and not numeric_filter and not names_cohort(question))
+    if follow_up:
+        filter_metadata = working_set.filter
+    combined_filter = merge_filters(filter_metadata, numeric_filter)
+    trace.attributes["follow_up"] = follow_up
+    prompt_question = rewrite_follow_up(question, combined_filter, len(working_set)) if follow_up else question
+
+    # A follow-up stays with its working set even when it reads like a theme question
+    routed = not follow_up and (
+        is_comparative_question(question) or is_exhaustive_question(question)
+        or (is_theme_question(question) and isinstance(getattr(vectorstore, "theme_clusters", None), dict)))
+    if routed or not _is_chunk_store(vectorstore):
+        trace.attributes["working_set"] = False
+        response = query_rag(vectorstore, llm, prompt_question, filter_metadata, trace=trace)
+        if not follow_up:
+            working_set.reset(vectorstore, combined_filter)
+        memory.add_interaction(question, response, {"filter": combined_filter})
+        return response
+
+    try:
+        docs = retrieve_with_working_set(vectorstore, question, RETRIEVAL_SETTINGS["k"], combined_filter,
+                                         working_set, follow_up, trace)
+        response = answer_from_documents(llm, prompt_question, docs, False, combined_filter, trace)
+    except Exception as e:
+        logger.exception(f"Unexpected error: {str(e)}")
+        trace.attributes["error"] = type(e).__name__
+        response = "An error occurred. Please try again."
+    finally:
+        trace.finish()
+
+    memory.add_interaction(question, response, {"filter": combined_filter, "students": len(working_set)})
+    return response
+
+BATCH_SETTINGS = {
+    "workers": 8
+}
+
+def read_batch_questions(lines):
+    """Parse JSONL question records of the form {"question": ..., "filter": {...}, "id": ...}"""
+    for number, line in enumerate(lines, 1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            record = json.loads(line)
+            if not isinstance(record, dict) or not isinstance(record.get("question"), str):
+                raise ValueError("expected an object with a \"question\" string")
+            filter_metadata = record.get("filter")
+            if filter_metadata is not None and not isinstance(filter_metadata, dict):
+                raise ValueError("\"filter\" must be an object")
+        except ValueError as e:
+            yield {"id": number, "error": f"Invalid question on line {number}: {str(e)}"}
+            continue
+        yield {"id": record.get("id", number), "question": record["question"], "filter": filter_metadata}
+
+def _answer_batch_record(vectorstore, llm, record):
+    """Answer one batch record and describe the result, timings and token counts"""
+    if "error" in record:
+        return {"id": record["id"], "status": "invalid", "error": record["error"]}
+
+    trace = QueryTrace()
+    answer = query_rag(vectorstore, llm, record["question"], record["filter"], trace=trace)
+    if "error" in trace.attributes:
+        status = "error"
+    elif trace.attributes.get("degraded"):
+        status = "degraded"
+    else:
+        status = "ok"
+    return {
+        "id": record["id"],
+        "question": record["question"],
+        "filter": record["filter"],
+        "status": status,
+        "answer": answer,
+        "latency_ms": trace.total_ms,
+        "timings_ms": trace.timings(),
+        "prompt_tokens": trace.counters.get("prompt_tokens", 0),
+        "prompt_cached_tokens": trace.counters.get("prompt_cached_tokens", 0),
+        "completion_tokens": trace.counters.get("completion_tokens", 0),
+        "route": trace.attributes.get("route", "retrieval")
+    }
+
+def run_batch(vectorstore, llm, records, output, workers=None):
+    """Answer question records concurrently, writing one JSON line per result as it finishes
+
+    At most a few questions per worker are queued at a time, so large input files
+    are streamed rather than loaded. Returns summary counts and throughput.
+    """
+    from concurrent.futures import wait, FIRST_COMPLETED
+
+    workers = workers or BATCH_SETTINGS["workers"]
+    summary = {"questions": 0, "ok": 0, "degraded": 0, "error": 0, "invalid": 0,
+               "prompt_tokens": 0, "prompt_cached_tokens": 0, "completion_tokens": 0}
+    t0 = time.perf_counter()
+
+    def write(result):
+        output.write(json.dumps(result, default=str) + "\n")
+        output.flush()
+        summary["questions"] += 1
+        summary[result["status"]] += 1
+        summary["prompt_tokens"] += result.get("prompt_tokens", 0)
+        summary["prompt_cached_tokens"] += result.get("prompt_cached_tokens", 0)
+        summary["completion_tokens"] += result.get("completion_tokens", 0)
+
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="ragpsy-batch") as pool:
+        pending = set()
+        for record in records:
+            if len(pending) >= workers * 2:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    write(future.result())
+            pending.add(pool.submit(_answer_batch_record, vectorstore, llm, record))
+        for future in wait(pending).done:
+            write(future.result())
+
+    summary["wall_s"] = round(time.perf_counter() - t0, 3)
+    summary["questions_per_s"] = round(summary["questions"] / max(summary["wall_s"], 1e-9), 2)
+    return summary
+
+# Values swept by tune_retrieval; its grid argument overrides any of them
+TUNING_GRID = {
+    "chunk_size": [300, 500, 800],
+    "chunk_overlap": [0, 50, 100],
+    "k": [3, 5, 8],
+    "index": ["flat", "hnsw"],
+    "hnsw_ef_search": [32, 128]
+}
+
+# Metrics compared when looking for Pareto-optimal configurations
+TUNING_OBJECTIVES = {"recall_at_k": "max", "p95_ms": "min", "index_bytes": "min", "build_s": "min"}
+
+def read_labeled_questions(lines):
+    """Parse JSONL records of the form {"question": ..., "relevant": [student_id, ...], "filter": {...}}"""
+    questions = []
+    for number, line in enumerate(lines, 1):
+        line = line.strip()
+        if not line:
+            continue
+        record = json.loads(line)
+        if not isinstance(record, dict) or not isinstance(record.get("question"), str) or not record.get("relevant"):
+            raise ValueError(f"Line {number}: expected a \"question\" string and a non-empty \"relevant\" list")
+        questions.append({
+            "question": record["question"],
+            "relevant": {str(student_id) for student_id in record["relevant"]},
+            "filter": record.get("filter")
+        })
+    return questions
+
+def measure_retrieval(vectorstore, questions, k):
+    """Mean recall@k over the distinct students retrieved, and p95 retrieval latency in ms
+
+    Recall is relevant students found over min(k, relevant students), so a
+    question with many relevant students can still reach 1.0.
+    """
+    recalls, latencies = [], []
+    for item in questions:
+        t0 = time.perf_counter()
+        docs = retrieve_documents(vectorstore, item["question"], k, item["filter"])
+        latencies.append((time.perf_counter() - t0) * 1000)
+        found = {str(doc.metadata.get("student_id")) for doc in docs}
+        recalls.append(len(found & item["relevant"]) / min(k, len(item["relevant"])))
+    return round(sum(recalls) / len(recalls), 4), _percentile(sorted(latencies), 95)
+
+def pareto_front(results, objectives=None):
+    """Results that no other result matches or beats on every objective and beats on one"""
+    objectives = objectives or TUNING_OBJECTIVES
+
+    def dominates(a, b):
+        pairs = [(a[m], b[m]) if goal == "max" else (b[m], a[m]) for m, goal in objectives.items()]
+        return all(x >= y for x, y in pairs) and any(x > y for x, y in pairs)
+
+    return [r for r in results if not any(dominates(other, r) for other in results)]
+
+def select_configuration(front, min_recall=None, max_p95_ms=None):
+    """Fastest configuration meeting both targets, else the one with the best recall"""
+    meeting = [r for r in front
+               if (min_recall is None or r["recall_at_k"] >= min_recall)
+               and (max_p95_ms is None or r["p95_ms"] <= max_p95_ms)]
+    if meeting:
+        return min(meeting, key=lambda r: (r["p95_ms"], -r["recall_at_k"], r["index_bytes"]))
+    return max(front, key=lambda r: (r["recall_at_k"], -r["p95_ms"]))
+
+def _with_index(vectorstore, index):
+    """The same documents served from another FAISS index"""
+    from langchain_community.vectorstores import FAISS
+
+    variant = FAISS(vectorstore.embedding_function, index, vectorstore.docstore, vectorstore.index_to_docstore_id)
+    variant.metadata_columns = vectorstore.metadata_columns
+    variant.indexing_mode = vectorstore.indexing_mode
+    return variant
+
+def tune_retrieval(data_path, questions, embeddings=None, indexing="chunks", grid=None,
+                   min_recall=None, max_p95_ms=None, output=None, progress=None):
+    """Sweep chunking, k and index settings over labeled questions and write the chosen configuration
+
+    Every combination in grid (TUNING_GRID by default) is measured for recall@k,
+    index size, build time and p95 retrieval latency. Among the Pareto-optimal
+    combinations the fastest one that meets min_recall and max_p95_ms (or, if
+    none does, the one with the best recall) is written with its metrics and the
+    whole front to output, RETRIEVAL_CONFIG_SETTINGS["path"] by default, where setup_rag
+    picks it up. progress, if given, is called with each measured result.
+    """
+    import itertools
+    from datetime import datetime, timezone
+
+    if not questions:
+        raise ValueError("No labeled questions to tune on")
+    grid = {**TUNING_GRID, **(grid or {})}
+    embeddings = embeddings or create_embeddings()
+    df = load_data(data_path)
+    if df is None:
+        raise ValueError("Failed to load data")
+
+    if indexing == "chunks":
+        documents = create_student_documents(df)
+        chunkings = [(size, overlap) for size, overlap in itertools.product(grid["chunk_size"], grid["chunk_overlap"])
+                     if overlap < size]
+    else:
+        # Field vectors are not chunked, so only k and the index are tuned
+        chunkings = [(None, None)]
+    indexes = [{"index": "flat"}] if "flat" in grid["index"] else []
+    if "hnsw" in grid["index"]:
+        indexes += [{"index": "hnsw", "hnsw_m": RETRIEVAL_SETTINGS["hnsw_m"], "hnsw_ef_search": ef}
+                    for ef in grid["hnsw_ef_search"]]
+
+    results = []
+    for chunk_size, chunk_overlap in chunkings:
+        # Each chunking is embedded once; the other indexes reuse its vectors
+        t0 = time.perf_counter()
+        if indexing == "chunks":
+            texts, metadatas = split_student_documents(documents, chunk_size, chunk_overlap)
+            sections = None
+        else:
+            texts, metadatas, sections = create_field_documents(df)
+        base = build_vectorstore(texts, metadatas, embeddings, sections=sections, index_settings={"index": "flat"})
+        embed_s = time.perf_counter() - t0
+        vectors = base.index.reconstruct_n(0, base.index.ntotal)
+
+        for index_settings in indexes:
+            t1 = time.perf_counter()
+            if index_settings["index"] == "flat":
+                store = base
+            else:
+                index = create_faiss_index(vectors.shape[1], index_settings)
+                index.add(vectors)
+                store = _with_index(base, index)
+            build_s = round(embed_s + time.perf_counter() - t1, 3)
+
+            # Warm the question embeddings so the timed passes measure retrieval only
+            measure_retrieval(store, questions, max(grid["k"]))
+            for k in grid["k"]:
+                recall, p95_ms = measure_retrieval(store, questions, k)
+                settings = {"k": k, **index_settings}
+                if chunk_size is not None:
+                    settings.update(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+                result = {"settings": settings, "recall_at_k": recall, "p95_ms": p95_ms,
+                          "index_bytes": vectorstore_nbytes(store), "build_s": build_s}
+                results.append(result)
+                if progress is not None:
+                    progress(result)
+
+    front = pareto_front(results)
+    chosen = select_configuration(front, min_recall, max_p95_ms)
+    # Comparative questions keep twice the context of a regular question, as before
+    settings = {**chosen["settings"], "comparative_k": 2 * chosen["settings"]["k"]}
+    config = {
+        "version": 1,
+        "settings": settings,
+        "metrics": {metric: chosen[metric] for metric in TUNING_OBJECTIVES},
+        "targets": {"min_recall": min_recall, "max_p95_ms": max_p95_ms},
+        "pareto_front": front,
+        "measured": len(results),
+        "questions": len(questions),
+        "data_path": os.path.abspath(data_path),
+        "indexing": indexing,
+        "embedding_model": _embedding_model_key(embeddings),
+        "tuned_at": datetime.now(timezone.utc).isoformat()
+    }
+
+    output = output or RETRIEVAL_CONFIG_SETTINGS["path"]
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    tmp_path = f"{output}.tmp-{os.getpid()}"
+    with open(tmp_path, "w") as f:
+        json.dump(config, f, indent=2, default=str)
+        f.write("\n")
+    os.replace(tmp_path, output)
+    logger.info(f"Wrote tuned retrieval settings {settings} to {output}")
+    return config
+
 def validate_data_advanced(docs, filter_metadata):
     """Enhanced data validation with more sophisticated checks"""
     validation_results = {
@@ -350,44 +4478,122 @@ def validate_data_advanced(docs, filter_metadata):
         validation_results["data_quality"] = "unknown"
         return validation_results
     
+# Canned questions used by the interactive modes; setup_rag pre-embeds them
+EXAMPLE_QUESTIONS = {
+    "Performance Analysis": [
+        "What's the typical range of midterm scores for international students?",
+        "How do first-generation students perform in final exams?",
+        "Is there a relationship between study hours and exam performance?"
+    ],
+    "Engagement Patterns": [
+        "What attendance patterns do we see among high-performing students?",
+        "How many hours do students with above-average grades typically study?",
+        "What's the relationship between attendance and final exam scores?"
+    ],
+    "Student Feedback": [
+        "What common challenges do international students mention?",
+        "What aspects of the course do first-generation students find most helpful?",
+        "How do students describe their learning experience in this course?"
+    ]
+}
+
+# Test questions focused on demographics and performance
+TEST_QUESTIONS = [
+    {
+        "category": "Demographic Analysis",
+        "question": "What patterns do you notice in how international students describe their learning experience?",
+        "filter": {"international_student": "Yes"}
+    },
+    {
+        "category": "Demographic Analysis",
+        "question": "How do first-generation students describe their course experience?",
+        "filter": {"first_gen_student": "Yes"}
+    },
+    {
+        "category": "Performance Correlation",
+        "question": "What's the relationship between study hours and final exam scores?",
+        "filter": None
+    },
+    {
+        "category": "Performance Correlation",
+        "question": "How does attendance rate correlate with exam performance?",
+        "filter": None
+    }
+]
+
+PSYCHOLOGY_TEST_SCENARIOS = [
+    {
+        "category": "Performance Analysis",
+        "tests": [
+            {
+                "description": "Basic Grade Distribution",
+                "question": "What's the distribution of final exam scores?",
+                "expected_elements": ["average", "range", "sample size"]
+            },
+            {
+                "description": "Study Hours Impact",
+                "question": "How do study hours correlate with exam performance?",
+                "expected_elements": ["correlation", "patterns", "examples"]
+            }
+        ]
+    },
+    {
+        "category": "Student Demographics",
+        "tests": [
+            {
+                "description": "International Student Experience",
+                "question": "What common themes appear in international student feedback?",
+                "filter": {"international_student": "Yes"},
+                "expected_elements": ["challenges", "successes", "recommendations"]
+            }
+        ]
+    }
+]
+
+FEATURE_TEST_CASES = [
+    {
+        "name": "Memory Integration Test",
+        "questions": [
+            "How do international students perform in exams?",
+            "What study habits do they mention?",
+            "Do these habits seem effective based on their grades?"
+        ],
+        "filter": {"international_student": "Yes"}
+    },
+    {
+        "name": "Data Validation Test",
+        "questions": [
+            "What's the average final exam score?",
+            "How does this compare to midterm performance?",
+        ],
+        "filter": None
+    },
+    {
+        "name": "Small Sample Test",
+        "questions": [
+            "How do students with perfect attendance perform?",
+        ],
+        "filter": {"attendance_rate": 100}
+    }
+]
+
+def canned_questions():
+    """Every fixed question asked by the interactive modes and test runners"""
+    questions = [q for group in EXAMPLE_QUESTIONS.values() for q in group]
+    questions += [test["question"] for test in TEST_QUESTIONS]
+    questions += [test["question"] for scenario in PSYCHOLOGY_TEST_SCENARIOS for test in scenario["tests"]]
+    questions += [q for case in FEATURE_TEST_CASES for q in case["questions"]]
+    return list(dict.fromkeys(questions))
+
 def test_rag_features():
     """Test new RAG features with various scenarios"""
-    test_cases = [
-        {
-            "name": "Memory Integration Test",
-            "questions": [
-                "How do international students perform in exams?",
-                "What study habits do they mention?",
-                "Do these habits seem effective based on their grades?"
-            ],
-            "filter": {"international_student": "Yes"}
-        },
-        {
-            "name": "Data Validation Test",
-            "questions": [
-                "What's the average final exam score?",
-                "How does this compare to midterm performance?",
-            ],
-            "filter": None
-        },
-        {
-            "name": "Small Sample Test",
-            "questions": [
-                "How do students with perfect attendance perform?",
-            ],
-            "filter": {"attendance_rate": 100}
-        }
-    ]
-    
     print("\nRunning RAG Feature Tests...")
-    memory = ConversationBufferMemory(
-        memory_key="chat_history",
-        return_messages=True
-    )
     
-    for test in test_cases:
+    for test in FEATURE_TEST_CASES:
         print(f"\nTesting: {test['name']}")
         print("-" * 50)
+        # Each test is its own conversation
+        memory = EnhancedConversationMemory()
         
         for question in test["questions"]:
             print(f"\nQuestion: {question}")
@@ -404,10 +4610,7 @@ def test_rag_features():
 
 def enhanced_interactive_mode(vectorstore, llm):
     """Enhanced interactive mode with all new features"""
-    memory = ConversationBufferMemory(
-        memory_key="chat_history",
-        return_messages=True
-    )
+    memory = EnhancedConversationMemory()
     
     print("\nEnhanced RAG System")
     print("Commands:")
@@ -495,33 +4698,8 @@ def get_filter_metadata():
   
 def test_rag_system(vectorstore, llm):
     """Test the RAG system with focused question types"""
-    
-    # Test questions focused on demographics and performance
-    test_questions = [
-        {
-            "category": "Demographic Analysis",
-            "question": "What patterns do you notice in how international students describe their learning experience?",
-            "filter": {"international_student": "Yes"}
-        },
-        {
-            "category": "Demographic Analysis",
-            "question": "How do first-generation students describe their course experience?",
-            "filter": {"first_gen_student": "Yes"}
-        },
-        {
-            "category": "Performance Correlation",
-            "question": "What's the relationship between study hours and final exam scores?",
-            "filter": None
-        },
-        {
-            "category": "Performance Correlation",
-            "question": "How does attendance rate correlate with exam performance?",
-            "filter": None
-        }
-    ]
-    
     print("\nTesting RAG System...")
-    for test in test_questions:
+    for test in TEST_QUESTIONS:
         print(f"\nCategory: {test['category']}")
         print(f"Question: {test['question']}")
         
@@ -533,6 +4711,7 @@ def test_rag_system(vectorstore, llm):
         else:
             print("Failed to get response")
 
+@profiled("create_student_documents")
 def create_student_documents(df):
     """Create text documents for each student with proper metadata"""
     documents = []
@@ -565,6 +4744,8 @@ def create_student_documents(df):
             'international_student': row['international_student'],
             'first_gen_student': row['first_gen_student'],
             'study_hours_per_week': float(row['study_hours_per_week']),
+            'attendance_rate': float(row['attendance_rate']),
+            'midterm_grade': float(row['midterm_grade']),
             'final_exam': float(row['final_exam'])
         }
         
@@ -627,26 +4808,8 @@ def interactive_mode(vectorstore, llm):
 
 def show_example_questions():
     """Display example questions that work well with the dataset"""
-    examples = {
-        "Performance Analysis": [
-            "What's the typical range of midterm scores for international students?",
-            "How do first-generation students perform in final exams?",
-            "Is there a relationship between study hours and exam performance?"
-        ],
-        "Engagement Patterns": [
-            "What attendance patterns do we see among high-performing students?",
-            "How many hours do students with above-average grades typically study?",
-            "What's the relationship between attendance and final exam scores?"
-        ],
-        "Student Feedback": [
-            "What common challenges do international students mention?",
-            "What aspects of the course do first-generation students find most helpful?",
-            "How do students describe their learning experience in this course?"
-        ]
-    }
-    
     print("\nExample Questions You Can Ask:")
-    for category, questions in examples.items():
+    for category, questions in EXAMPLE_QUESTIONS.items():
         print(f"\n{category}:")
         for q in questions:
             print(f"- {q}")
@@ -655,36 +4818,7 @@ def run_psychology_specific_tests(vectorstore, llm):
     """Run tests specifically designed for psychology student data"""
     print("\nRunning Psychology Dataset Tests...")
     
-    test_scenarios = [
-        {
-            "category": "Performance Analysis",
-            "tests": [
-                {
-                    "description": "Basic Grade Distribution",
-                    "question": "What's the distribution of final exam scores?",
-                    "expected_elements": ["average", "range", "sample size"]
-                },
-                {
-                    "description": "Study Hours Impact",
-                    "question": "How do study hours correlate with exam performance?",
-                    "expected_elements": ["correlation", "patterns", "examples"]
-                }
-            ]
-        },
-        {
-            "category": "Student Demographics",
-            "tests": [
-                {
-                    "description": "International Student Experience",
-                    "question": "What common themes appear in international student feedback?",
-                    "filter": {"international_student": "Yes"},
-                    "expected_elements": ["challenges", "successes", "recommendations"]
-                }
-            ]
-        }
-    ]
-    
-    for scenario in test_scenarios:
+    for scenario in PSYCHOLOGY_TEST_SCENARIOS:
         print(f"\nTesting {scenario['category']}:")
         for test in scenario["tests"]:
             print(f"\nRunning: {test['description']}")
@@ -750,12 +4884,16 @@ def interpret_validation_results(validation_results):
 
 class EnhancedConversationMemory:
     def __init__(self, max_tokens=1000):
-        self.conversations = []
+        self.conversations = deque()
         self.max_tokens = max_tokens
         self.topic_tracking = {}
+        self._sizes = deque()  # rendered length of each stored interaction
+        self.working_set = SessionWorkingSet()  # students retrieved so far, reused by follow-ups
         
     def add_interaction(self, question, response, metadata=None):
         """Add an interaction with topic tracking"""
+        import pandas as pd
+
         interaction = {
             "question": question,
             "response": response,
@@ -771,6 +4909,7 @@ class EnhancedConversationMemory:
             self.topic_tracking[topic] += 1
         
         self.conversations.append(interaction)
+        self._sizes.append(len(str(interaction)))
         self._prune_old_conversations()
         
     def get_relevant_history(self, current_question):
@@ -794,8 +4933,11 @@ class EnhancedConversationMemory:
         
     def _prune_old_conversations(self):
         """Remove old conversations to stay within token limit"""
-        while len(str(self.conversations)) > self.max_tokens:
-            self.conversations.pop(0)
+        # Sizes are kept per interaction, so pruning does not re-render the whole history
+        total = sum(self._sizes)
+        while self.conversations and total > self.max_tokens:
+            self.conversations.popleft()
+            total -= self._sizes.popleft()
 
 def enhanced_interactive_mode_with_validation(vectorstore, llm):
     """Interactive mode with enhanced features"""
@@ -814,8 +4956,8 @@ def enhanced_interactive_mode_with_validation(vectorstore, llm):
         if command == 'exit':
             break
         elif command == 'analyze':
-            # Run data quality analysis
-            docs = vectorstore.similarity_search("", k=5)
+            # Run data quality analysis on a spread of stored records, without embedding a query
+            docs = sample_documents(vectorstore, 5)
             validation_results = validate_data_advanced(docs, None)
             interpretation = interpret_validation_results(validation_results)
             print("\nData Quality Analysis:")
@@ -848,14 +4990,137 @@ def enhanced_interactive_mode_with_validation(vectorstore, llm):
 
 def main():
     """Main function with proper exit handling"""
-    print("Initializing RAG system...")
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Psychology Course RAG System")
+    parser.add_argument("--profile", action="store_true",
+                        help="Profile setup_rag and query_rag (same as RAGPSY_PROFILE=1)")
+    parser.add_argument("--profile-dir", help="Directory for profiling output (default: profiles)")
+    parser.add_argument("--data-path", default='/Users/dondeerie/projects/Test-DD/data/',
+                        help="Directory with the course CSV files")
+    parser.add_argument("--indexing", choices=INDEXING_MODES, default="chunks",
+                        help="Index character chunks or one vector per review field")
+    parser.add_argument("--watch", action="store_true",
+                        help="Rebuild the index in the background when the CSV files in --data-path change")
+    parser.add_argument("--shards", help="Directory of saved per-course/term indexes to query instead of --data-path")
+    parser.add_argument("--shard", action="append",
+                        help="Shard to query, e.g. PSY101/F24 (repeatable; default: all shards)")
+    parser.add_argument("--shard-cache-mb", type=int, help="RAM cap for loaded shards")
+    parser.add_argument("--build-shards", metavar="DATA_ROOT",
+                        help="Build one index per course/term directory under DATA_ROOT into --shards and exit")
+    parser.add_argument("--embedding-backend", choices=EMBEDDING_BACKENDS,
+                        help="Run the embedding model with PyTorch or an ONNX export (default: torch)")
+    parser.add_argument("--onnx-model", help="Directory of the ONNX export for --embedding-backend onnx")
+    parser.add_argument("--export-onnx", metavar="DIR",
+                        help="Export the embedding model to ONNX (with an int8 copy) into DIR and exit")
+    parser.add_argument("--embedding-cache",
+                        help="File for cached question embeddings (default: .ragpsy_cache/question_embeddings.npz)")
+    parser.add_argument("--batch", metavar="QUESTIONS_JSONL",
+                        help="Answer the questions in a JSONL file non-interactively and exit")
+    parser.add_argument("--output", help="JSONL file for --batch results (default: stdout)")
+    parser.add_argument("--batch-workers", type=int, help="Questions answered concurrently in --batch mode")
+    parser.add_argument("--batch-llm", action="store_true",
+                        help="Send concurrent prompts as batch completions where the LLM backend supports it")
+    parser.add_argument("--tune", metavar="LABELED_JSONL",
+                        help="Tune chunking, k and index settings on labeled questions from --data-path and exit")
+    parser.add_argument("--tune-output", help="Config file written by --tune (default: the retrieval config)")
+    parser.add_argument("--tune-grid", help="JSON object overriding the swept values, e.g. '{\"k\": [3, 4]}'")
+    parser.add_argument("--target-recall", type=float, help="Minimum recall@k for --tune to choose a configuration")
+    parser.add_argument("--max-p95-ms", type=float, help="Maximum p95 retrieval latency for --tune")
+    parser.add_argument("--retrieval-config", help="Tuned retrieval settings to read and write (default: ragpsy_retrieval.json)")
+    parser.add_argument("--workers", type=int, help="Ingest processes for --build-shards (default: CPU count)")
+    parser.add_argument("--partition-size", type=int, help="Students per ingest partition")
+    args = parser.parse_args()
+
+    if args.profile:
+        PROFILE_SETTINGS["enabled"] = True
+    if args.profile_dir:
+        PROFILE_SETTINGS["output_dir"] = args.profile_dir
+
+    configure_logging()
+    if args.batch_llm:
+        LLM_CALL_SETTINGS["batching"] = True
+    if args.embedding_backend:
+        EMBEDDING_SETTINGS["backend"] = args.embedding_backend
+    if args.onnx_model:
+        EMBEDDING_SETTINGS["onnx_model_dir"] = args.onnx_model
+    if args.export_onnx:
+        export_onnx_model(args.export_onnx)
+        print(f"Exported the embedding model to {args.export_onnx}")
+        return
+    if args.embedding_cache or not EMBEDDING_CACHE_SETTINGS["path"]:
+        EMBEDDING_CACHE_SETTINGS["path"] = args.embedding_cache or DEFAULT_EMBEDDING_CACHE_PATH
+    # Batch results may go to stdout, so status messages go to stderr there
+    status = sys.stderr if args.batch else sys.stdout
+    print("Initializing RAG system...", file=status)
     
+    if args.retrieval_config:
+        RETRIEVAL_CONFIG_SETTINGS["path"] = args.retrieval_config
+    if args.tune:
+        with open(args.tune) as f:
+            questions = read_labeled_questions(f)
+        config = tune_retrieval(
+            args.data_path, questions, indexing=args.indexing,
+            grid=json.loads(args.tune_grid) if args.tune_grid else None,
+            min_recall=args.target_recall, max_p95_ms=args.max_p95_ms, output=args.tune_output,
+            progress=lambda r: print(f"{r['settings']}: recall@k {r['recall_at_k']:.3f}, "
+                                     f"p95 {r['p95_ms']:.1f} ms, {r['index_bytes'] / 1e6:.1f} MB, "
+                                     f"build {r['build_s']:.1f} s")
+        )
+        print(f"Chose {config['settings']} ({config['metrics']}) from {len(config['pareto_front'])} "
+              f"Pareto-optimal of {config['measured']} configurations")
+        return
+    load_retrieval_config()
+    if args.watch and args.shards:
+        parser.error("--watch applies to --data-path, not --shards")
+    if args.build_shards:
+        if not args.shards:
+            parser.error("--build-shards requires --shards")
+        def show_progress(done, total, shard, part):
+            print(f"\r[{done}/{total}] partitions built ({shard} part {part})", end="", flush=True)
+
+        report = build_shards(args.build_shards, args.shards, indexing=args.indexing, workers=args.workers,
+                              partition_size=args.partition_size, progress=show_progress)
+        print(f"\nBuilt {len(report['built'])} shards, {len(report['skipped'])} already up to date")
+        for shard, errors in report["failed"].items():
+            print(f"Failed {shard}: {'; '.join(errors)}")
+        if report["failed"]:
+            print("Run the same command again to retry only the failed partitions.")
+            sys.exit(1)
+        return
+
     try:
-        data_path = '/Users/dondeerie/projects/Test-DD/data/'
-        vectorstore, llm, df = setup_rag(data_path)
+        if args.shards:
+            # Shards are loaded on first use, so only the queried terms are held in memory
+            registry = ShardRegistry(
+                args.shards,
+                create_embeddings(),
+                max_bytes=args.shard_cache_mb * 1024 * 1024 if args.shard_cache_mb else None
+            )
+            vectorstore = registry.view(args.shard)
+            QUESTION_EMBEDDINGS.warm(registry.embeddings, canned_questions())
+            _enable_llm_cache()
+            llm = create_llm()
+            if LLM_CALL_SETTINGS["batching"]:
+                enable_llm_batching(llm)
+        else:
+            vectorstore, llm, df = setup_rag(args.data_path, indexing=args.indexing, watch=args.watch)
         
-        if not all([vectorstore, llm, df is not None]):
-            print("Error: Failed to initialize one or more components")
+            if not all([vectorstore, llm, df is not None]):
+                print("Error: Failed to initialize one or more components", file=status)
+                return
+
+        if args.batch:
+            # One warm index answers every question in the file
+            with open(args.batch) as questions:
+                output = open(args.output, "w") if args.output else sys.stdout
+                try:
+                    summary = run_batch(vectorstore, llm, read_batch_questions(questions), output,
+                                        workers=args.batch_workers)
+                finally:
+                    if output is not sys.stdout:
+                        output.close()
+            print(json.dumps(summary), file=sys.stderr)
             return
             
         while True:
@@ -1,14 +1,93 @@
 import unittest
 from unittest.mock import patch, MagicMock
+import numpy as np
 import pandas as pd
+import io
+import math
+import json
 import os
+import shutil
+import tempfile
+import threading
+import time
+import weakref
 from ragpsy import (
     load_data,
     create_student_documents,
     setup_rag,
     query_rag,
-    validate_data_sample
+    validate_data_sample,
+    SingleFlight,
+    LLMMicroBatcher,
+    CircuitBreaker,
+    LLM_CALL_SETTINGS,
+    MetricsRegistry,
+    QueryTrace,
+    JsonLogFormatter,
+    split_student_documents,
+    PROFILE_SETTINGS,
+    parse_numeric_filters,
+    ColumnarMetadata,
+    retrieve_documents,
+    build_vectorstore,
+    create_field_documents,
+    is_theme_question,
+    theme_question_group,
+    build_index,
+    build_shards,
+    load_vectorstore,
+    ShardRegistry,
+    read_batch_questions,
+    run_batch,
+    QuestionEmbeddingCache,
+    normalize_question,
+    canned_questions,
+    TEST_QUESTIONS,
+    DATASET_CACHE_SETTINGS,
+    OnnxEmbeddings,
+    create_embeddings,
+    LiveIndex,
+    EnhancedConversationMemory,
+    LLM_CACHE_SETTINGS,
+    RETRIEVAL_SETTINGS,
+    compute_plot_aggregates,
+    load_plot_aggregates,
+    iter_matching_students,
+    query_rag_with_memory,
+    select_diverse,
+    PROMPTS,
+    PromptRegistry,
+    retrieve_adaptive,
+    score_knee,
+    is_follow_up_question,
+    describe_filter,
+    summarize_matching_students,
+    EXHAUSTIVE_SETTINGS,
+    LLMUnavailableError,
+    call_llm_with_policy,
+    get_circuit_breaker,
+    RETRIEVAL_CONFIG_SETTINGS,
+    merge_vectorstores,
+    pareto_front,
+    select_configuration,
+    read_labeled_questions,
+    tune_retrieval
 )
+import tempfile
+import subprocess
+import sys
+from langchain_core.embeddings import DeterministicFakeEmbedding
+import json
+import logging
+import ragpsy
+
+def setUpModule():
+    """Keep dataset caches out of the repository's data directory"""
+    DATASET_CACHE_SETTINGS["dir"] = tempfile.mkdtemp()
+
+def tearDownModule():
+    shutil.rmtree(DATASET_CACHE_SETTINGS["dir"], True)
+    DATASET_CACHE_SETTINGS["dir"] = None
 
 class TestRAGSystem(unittest.TestCase):
     @classmethod
@@ -42,6 +121,59 @@ class TestRAGSystem(unittest.TestCase):
         self.assertIn('metadata', documents[0])
         self.assertIn('content', documents[0])
 
+    def test_split_student_documents(self):
+        """Test that every chunk carries its student's metadata"""
+        documents = create_student_documents(self.test_data)
+        texts, metadatas = split_student_documents(documents, chunk_size=100, chunk_overlap=10)
+        self.assertEqual(len(texts), len(metadatas))
+        self.assertGreater(len(texts), len(documents))
+        self.assertEqual(
+            {m['student_id'] for m in metadatas},
+            {'PSY101_F24_001', 'PSY101_F24_002'}
+        )
+
+    def test_setup_with_injected_components(self):
+        """Test that setup_rag accepts a custom embedding model and LLM without an API key"""
+        data_path = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'data')
+        mock_llm = MagicMock()
+        with patch.dict(os.environ, {}, clear=True):
+            vectorstore, llm, df = setup_rag(data_path, embeddings=DeterministicFakeEmbedding(size=16), llm=mock_llm)
+        self.assertIs(llm, mock_llm)
+        self.assertEqual(len(df), 25)
+        self.assertGreaterEqual(vectorstore.index.ntotal, len(df))
+
+    def test_setup_enables_llm_batching(self):
+        """Test that with batching configured, concurrent questions are answered by one batch call"""
+        from langchain_core.language_models.fake_chat_models import FakeListChatModel
+        from langchain_core.messages import AIMessage
+
+        questions = ["How do students rate the lectures?", "What do students say about exams?",
+                     "How much do students study?"]
+        batches = []
+
+        class BatchingChatModel(FakeListChatModel):
+            def batch(self, inputs, config=None, *, return_exceptions=False, **kwargs):
+                batches.append(len(inputs))
+                return [AIMessage(content=next(q for q in questions if q in prompt)) for prompt in inputs]
+
+        data_path = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'data')
+        llm = BatchingChatModel(responses=["unused"])
+        settings = {"batching": True, "batch_window_ms": 2000, "max_batch_size": len(questions)}
+        with patch.dict(LLM_CALL_SETTINGS, settings):
+            vectorstore, llm, _ = setup_rag(data_path, embeddings=DeterministicFakeEmbedding(size=16), llm=llm)
+            answers = {}
+            threads = [
+                threading.Thread(target=lambda q=q: answers.setdefault(q, query_rag(vectorstore, llm, q, None)))
+                for q in questions
+            ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        self.assertEqual(batches, [len(questions)])
+        self.assertEqual(answers, {q: q for q in questions})
+
     def test_data_validation(self):
         """Test data validation functionality"""
         mock_docs = [
@@ -112,5 +244,1495 @@ class TestRAGSystem(unittest.TestCase):
         )
         self.assertIsNotNone(response)
 
+class TestLLMCoalescing(unittest.TestCase):
+    def test_single_flight_shares_identical_calls(self):
+        """Test that concurrent identical calls run the underlying function once"""
+        flight = SingleFlight()
+        calls = []
+        started = threading.Event()
+
+        def slow_call():
+            calls.append(1)
+            started.set()
+            time.sleep(0.1)
+            return "answer"
+
+        results = []
+        threads = [
+            threading.Thread(target=lambda: results.append(flight.do("same prompt", slow_call)[0]))
+            for _ in range(5)
+        ]
+        threads[0].start()
+        started.wait()
+        for thread in threads[1:]:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, ["answer"] * 5)
+        self.assertEqual(flight.stats["shared"], 4)
+
+    def test_micro_batcher_groups_prompts(self):
+        """Test that prompts arriving within the window go out as one batch"""
+        mock_llm = MagicMock()
+        mock_llm.batch.side_effect = lambda prompts, return_exceptions: [p.upper() for p in prompts]
+        batcher = LLMMicroBatcher(mock_llm, window_ms=200, max_batch_size=3)
+
+        results = {}
+        threads = [
+            threading.Thread(target=lambda p=p: results.setdefault(p, batcher.submit(p)))
+            for p in ["a", "b", "c"]
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(results, {"a": "A", "b": "B", "c": "C"})
+        self.assertEqual(mock_llm.batch.call_count, 1)
+
+    def test_micro_batcher_skips_empty_batch(self):
+        """Test that a flusher finding nothing pending does not send an empty batch"""
+        mock_llm = MagicMock()
+        batcher = LLMMicroBatcher(mock_llm, window_ms=0, max_batch_size=2)
+        batcher._flush_overflow()
+        mock_llm.batch.assert_not_called()
+        self.assertEqual(batcher.stats["batches"], 0)
+
+class TestLLMCallPolicy(unittest.TestCase):
+    fast_policy = {
+        "timeout_s": 1,
+        "max_retries": 2,
+        "backoff_base_s": 0,
+        "backoff_max_s": 0,
+        "breaker_failure_threshold": 3,
+        "breaker_reset_s": 60
+    }
+
+    def test_retry_recovers_from_transient_error(self):
+        """Test that a retryable error is retried and the later answer returned"""
+        mock_vectorstore = MagicMock()
+        mock_vectorstore.similarity_search.return_value = [MagicMock(page_content="Test content")]
+        mock_llm = MagicMock()
+        mock_llm.invoke.side_effect = [TimeoutError("slow"), MagicMock(content="Recovered answer")]
+
+        with patch.dict(LLM_CALL_SETTINGS, self.fast_policy):
+            response = query_rag(mock_vectorstore, mock_llm, "How do students perform?", None)
+
+        self.assertEqual(response, "Recovered answer")
+        self.assertEqual(mock_llm.invoke.call_count, 2)
+
+    def test_open_breaker_returns_degraded_response(self):
+        """Test that repeated failures open the breaker and fall back to retrieved context"""
+        mock_vectorstore = MagicMock()
+        mock_vectorstore.similarity_search.return_value = [MagicMock(page_content="Retrieved record")]
+        mock_llm = MagicMock()
+        mock_llm.invoke.side_effect = TimeoutError("slow")
+
+        with patch.dict(LLM_CALL_SETTINGS, self.fast_policy):
+            for question in ["How do students perform?", "How do students study?", "How do students attend?"]:
+                response = query_rag(mock_vectorstore, mock_llm, question, None)
+                self.assertIn("Retrieved record", response)
+            # Three questions of three attempts each, counted as three breaker failures
+            self.assertEqual(mock_llm.invoke.call_count, 9)
+
+            # The breaker is now open, so the next question skips the LLM entirely
+            response = query_rag(mock_vectorstore, mock_llm, "What do students say?", None)
+            self.assertIn("Retrieved record", response)
+            self.assertEqual(mock_llm.invoke.call_count, 9)
+
+    def test_breaker_counts_failed_calls_not_attempts(self):
+        """Test that retries count as one failure and request errors are not counted"""
+        mock_llm = MagicMock()
+        attempts = []
+
+        def failing(error):
+            def fn():
+                attempts.append(error)
+                raise error
+            return fn
+
+        with patch.dict(LLM_CALL_SETTINGS, self.fast_policy):
+            with self.assertRaises(LLMUnavailableError):
+                call_llm_with_policy(mock_llm, failing(ConnectionError("reset")))
+            self.assertEqual(len(attempts), 3)
+            self.assertEqual(get_circuit_breaker(mock_llm).failures, 1)
+
+            # Other errors are not an outage: they propagate unchanged and are not counted
+            with self.assertRaises(ValueError):
+                call_llm_with_policy(mock_llm, failing(ValueError("bad request")))
+            self.assertEqual(len(attempts), 4)
+            self.assertEqual(get_circuit_breaker(mock_llm).failures, 1)
+
+    def test_request_error_does_not_close_half_open_breaker(self):
+        """Test that a rejected trial call neither closes the breaker nor blocks the next trial"""
+        mock_llm = MagicMock()
+        breaker = get_circuit_breaker(mock_llm)
+        breaker.reset_timeout = 0
+        breaker.state, breaker.opened_at = "open", 0.0
+
+        def unauthorized():
+            raise PermissionError("401 unauthorized")
+
+        with patch.dict(LLM_CALL_SETTINGS, self.fast_policy):
+            with self.assertRaises(PermissionError):
+                call_llm_with_policy(mock_llm, unauthorized)
+            self.assertEqual(breaker.state, "open")
+            self.assertEqual(call_llm_with_policy(mock_llm, lambda: "answer"), "answer")
+        self.assertEqual(breaker.state, "closed")
+
+    def test_unexpected_error_is_not_a_degraded_answer(self):
+        """Test that a bug raised during the LLM call surfaces as an error, not the degraded answer"""
+        mock_vectorstore = MagicMock()
+        mock_vectorstore.similarity_search.return_value = [MagicMock(page_content="Retrieved record")]
+        mock_llm = MagicMock()
+        mock_llm.invoke.side_effect = KeyError("missing")
+
+        trace = QueryTrace()
+        with patch.dict(LLM_CALL_SETTINGS, self.fast_policy):
+            response = query_rag(mock_vectorstore, mock_llm, "How do students perform?", None, trace=trace)
+        self.assertNotIn("Retrieved record", response)
+        self.assertEqual(trace.attributes["error"], "KeyError")
+        self.assertNotIn("degraded", trace.attributes)
+
+    def test_abandoned_calls_are_capped(self):
+        """Test that new calls fail fast while too many timed-out calls still hold workers"""
+        release = threading.Event()
+        policy = dict(self.fast_policy, timeout_s=0.05, max_retries=0, max_abandoned_calls=1)
+
+        with patch.dict(LLM_CALL_SETTINGS, policy):
+            with self.assertRaises(LLMUnavailableError):
+                call_llm_with_policy(MagicMock(), release.wait)
+            self.assertEqual(ragpsy._abandoned_llm_calls, 1)
+
+            fn = MagicMock()
+            with self.assertRaises(LLMUnavailableError):
+                call_llm_with_policy(MagicMock(), fn)
+            fn.assert_not_called()
+
+            release.set()
+            deadline = time.monotonic() + 5
+            while ragpsy._abandoned_llm_calls and time.monotonic() < deadline:
+                time.sleep(0.01)
+            self.assertEqual(ragpsy._abandoned_llm_calls, 0)
+
+    def test_breaker_half_open_after_reset(self):
+        """Test that the breaker allows a trial call once the reset timeout passes"""
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0)
+        breaker.record_failure()
+        self.assertEqual(breaker.state, "open")
+        self.assertTrue(breaker.allow())
+        self.assertFalse(breaker.allow())
+        breaker.record_success()
+        self.assertEqual(breaker.state, "closed")
+
+class TestInstrumentation(unittest.TestCase):
+    def test_query_trace_records_stages(self):
+        """Test that query_rag records stage timings and LLM cache counters"""
+        mock_vectorstore = MagicMock()
+        mock_vectorstore.similarity_search.return_value = [MagicMock(page_content="Test content")]
+        mock_llm = MagicMock()
+        mock_llm.invoke.return_value = MagicMock(content="Answer", usage_metadata={"input_tokens": 12, "output_tokens": 3})
+
+        trace = QueryTrace()
+        response = query_rag(mock_vectorstore, mock_llm, "How do students perform?", None, trace=trace)
+
+        self.assertEqual(response, "Answer")
+        timings = trace.timings()
+        for stage in ["vector_search", "context_assembly", "prompt_render", "llm_total"]:
+            self.assertIn(stage, timings)
+        self.assertEqual(trace.counters["prompt_tokens"], 12)
+        self.assertEqual(trace.counters["cache.llm_shared_miss"], 1)
+        self.assertIsNotNone(trace.total_ms)
+
+    def test_cached_prompt_tokens(self):
+        """Test that provider-reported prefix cache hits are split from uncached prompt tokens"""
+        mock_llm = MagicMock()
+        mock_llm.invoke.return_value = MagicMock(content="Answer", usage_metadata={
+            "input_tokens": 100, "output_tokens": 3, "input_token_details": {"cache_read": 64}
+        })
+        trace = QueryTrace()
+        ragpsy.invoke_llm(mock_llm, "cached prompt", trace=trace)
+        self.assertEqual(trace.counters["prompt_cached_tokens"], 64)
+        self.assertEqual(trace.counters["prompt_uncached_tokens"], 36)
+
+    def test_metrics_percentiles(self):
+        """Test histogram percentile summaries"""
+        registry = MetricsRegistry()
+        for value in range(1, 101):
+            registry.observe("latency_ms", value)
+        registry.incr("queries", 3)
+
+        snapshot = registry.snapshot()
+        summary = snapshot["histograms"]["latency_ms"]
+        self.assertEqual(summary["count"], 100)
+        self.assertEqual(summary["p50"], 50)
+        self.assertEqual(summary["p95"], 95)
+        self.assertEqual(summary["p99"], 99)
+        self.assertEqual(snapshot["counters"]["queries"], 3)
+
+    def test_json_log_formatter(self):
+        """Test that traces attached to log records are emitted as JSON"""
+        record = logging.LogRecord("ragpsy.trace", logging.INFO, __file__, 1, "query_rag", None, None)
+        record.trace = {"total_ms": 1.5}
+        payload = json.loads(JsonLogFormatter().format(record))
+        self.assertEqual(payload["message"], "query_rag")
+        self.assertEqual(payload["trace"]["total_ms"], 1.5)
+
+class TestProfiling(unittest.TestCase):
+    def test_profiling_writes_reports(self):
+        """Test that enabling profiling writes CPU, flame-graph and allocation reports"""
+        mock_vectorstore = MagicMock()
+        mock_vectorstore.similarity_search.return_value = [MagicMock(page_content="Test content")]
+        mock_llm = MagicMock()
+        mock_llm.invoke.return_value = MagicMock(content="Answer")
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            with patch.dict(PROFILE_SETTINGS, {"enabled": True, "output_dir": tmp_dir}):
+                response = query_rag(mock_vectorstore, mock_llm, "How do students perform?", None)
+            files = os.listdir(tmp_dir)
+
+        self.assertEqual(response, "Answer")
+        for suffix in [".prof", ".folded", ".alloc.txt"]:
+            self.assertTrue(any(f.startswith("query_rag") and f.endswith(suffix) for f in files), suffix)
+
+class TestStartup(unittest.TestCase):
+    def test_import_does_not_load_heavy_dependencies(self):
+        """Test that importing ragpsy and routing a question stay free of heavy imports"""
+        code = (
+            "import sys, ragpsy; ragpsy.is_comparative_question('Compare male and female students'); "
+            "print(','.join(m for m in ['pandas', 'numpy', 'faiss', 'torch', 'langchain_core', 'openai'] "
+            "if m in sys.modules))"
+        )
+        project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        result = subprocess.run([sys.executable, '-c', code], cwd=project_root, capture_output=True, text=True)
+        self.assertEqual(result.returncode, 0, result.stderr)
+        self.assertEqual(result.stdout.strip(), "")
+
+class TestNumericFilters(unittest.TestCase):
+    def test_parse_numeric_filters(self):
+        """Test that range phrases in questions become predicates on the right fields"""
+        self.assertEqual(
+            parse_numeric_filters("Among students who study more than 8 hours per week"),
+            {"study_hours_per_week": {"$gt": 8.0}}
+        )
+        self.assertEqual(
+            parse_numeric_filters("How do students with perfect attendance perform?"),
+            {"attendance_rate": {"$gte": 100.0}}
+        )
+        self.assertEqual(
+            parse_numeric_filters("Students with attendance below 80% and midterm grades under 70"),
+            {"attendance_rate": {"$lt": 80.0}, "midterm_grade": {"$lt": 70.0}}
+        )
+        self.assertEqual(
+            parse_numeric_filters("What do students who scored between 70 and 85 on the final say?"),
+            {"final_exam": {"$gte": 70.0, "$lte": 85.0}}
+        )
+        self.assertEqual(parse_numeric_filters("How do students describe the course?"), {})
+
+    def test_columnar_mask_matches_metadata(self):
+        """Test vectorized filtering against the per-document metadata"""
+        documents = create_student_documents(TestRAGSystem.test_data)
+        metadatas = [doc["metadata"] for doc in documents]
+        columns = ColumnarMetadata.from_metadatas(metadatas)
+
+        cases = [
+            ({"gender": "Female"}, [True, False]),
+            ({"attendance_rate": 100}, [False, False]),
+            ({"study_hours_per_week": {"$gt": 8}}, [True, False]),
+            ({"international_student": {"$in": ["Yes", "Maybe"]}}, [False, True]),
+            ({"$or": [{"gender": "Male"}, {"final_exam": {"$lt": 90}}]}, [True, True]),
+            ({"$and": [{"gender": {"$neq": "Male"}}, {"midterm_grade": {"$gte": 85}}]}, [True, False]),
+            ({"unknown_field": "x"}, [False, False]),
+        ]
+        for filter_metadata, expected in cases:
+            self.assertEqual(columns.mask(filter_metadata).tolist(), expected, filter_metadata)
+
+    def test_mask_cache_is_thread_safe_and_read_only(self):
+        """Test that concurrent filters share the mask cache safely and cached masks cannot be modified"""
+        import pickle
+
+        documents = create_student_documents(TestRAGSystem.test_data)
+        columns = ColumnarMetadata.from_metadatas([doc["metadata"] for doc in documents])
+        filters = [{"study_hours_per_week": {"$gt": i % 20}} for i in range(40)]
+        errors = []
+
+        def worker():
+            try:
+                for filter_metadata in filters:
+                    columns.mask(filter_metadata)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=worker) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertLessEqual(len(columns._mask_cache), 16)
+
+        mask = columns.mask({"gender": "Female"})
+        with self.assertRaises(ValueError):
+            mask[0] = False
+        self.assertEqual(columns.mask({"gender": "Female"}).tolist(), [True, False])
+        self.assertEqual(pickle.loads(pickle.dumps(columns)).mask({"gender": "Male"}).tolist(), [False, True])
+
+    def test_columnar_docstore_materializes_documents(self):
+        """Test that chunks share student rows and Documents are rebuilt on demand"""
+        documents = create_student_documents(TestRAGSystem.test_data)
+        texts, metadatas = split_student_documents(documents, chunk_size=80, chunk_overlap=0)
+        texts[0] = texts[0] + " café"
+        vectorstore = build_vectorstore(texts, metadatas, DeterministicFakeEmbedding(size=8))
+
+        columns = vectorstore.metadata_columns
+        self.assertEqual(len(columns), len(texts))
+        self.assertEqual(columns.num_rows, 2)
+        self.assertEqual(columns.mask({"gender": "Female"}).tolist(),
+                         [m["gender"] == "Female" for m in metadatas])
+
+        for position in (0, len(texts) - 1):
+            doc = vectorstore.docstore.search(vectorstore.index_to_docstore_id[position])
+            self.assertEqual(doc.page_content, texts[position])
+            self.assertEqual(doc.metadata, metadatas[position])
+
+    def test_filter_pushdown_returns_only_matches(self):
+        """Test that filtered retrieval returns every match even when matches are rare"""
+        data_path = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'data')
+        vectorstore, _, df = setup_rag(data_path, embeddings=DeterministicFakeEmbedding(size=16), llm=MagicMock())
+        filter_metadata = {"study_hours_per_week": {"$gt": 8}, "gender": "Female"}
+
+        docs = retrieve_documents(vectorstore, "study habits", 50, filter_metadata)
+
+        expected = set(df[(df.study_hours_per_week > 8) & (df.gender == "Female")].student_id)
+        self.assertEqual({doc.metadata["student_id"] for doc in docs}, expected)
+
+class TestFieldIndexing(unittest.TestCase):
+    """Test cases for field-level multi-vector indexing"""
+
+    def test_create_field_documents(self):
+        """Test that each free-text field becomes its own text with structured metadata"""
+        texts, metadatas, sections = create_field_documents(TestRAGSystem.test_data)
+
+        self.assertEqual(len(texts), 4)
+        self.assertEqual(sections, ['course_review', 'learning_outcomes_assessment'] * 2)
+        self.assertEqual(texts[0], 'Great course')
+        self.assertNotIn('Gender', texts[0])
+        self.assertEqual(metadatas[0]['gender'], 'Female')
+        self.assertEqual(metadatas[0]['study_hours_per_week'], 10.0)
+
+    def test_field_retrieval_dedupes_to_students(self):
+        """Test that field-mode retrieval returns each student once with all their fields"""
+        data_path = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'data')
+        vectorstore, _, df = setup_rag(
+            data_path, embeddings=DeterministicFakeEmbedding(size=16), llm=MagicMock(), indexing="fields"
+        )
+        self.assertEqual(vectorstore.index.ntotal, 2 * len(df))
+
+        docs = retrieve_documents(vectorstore, "office hours", 5)
+        student_ids = [doc.metadata['student_id'] for doc in docs]
+        self.assertEqual(len(student_ids), 5)
+        self.assertEqual(len(set(student_ids)), 5)
+
+        row = df[df.student_id == student_ids[0]].iloc[0]
+        self.assertIn(row['course_review'], docs[0].page_content)
+        self.assertIn(row['learning_outcomes_assessment'], docs[0].page_content)
+        self.assertIn(f"Final Exam: {row['final_exam']}", docs[0].page_content)
+
+        filtered = retrieve_documents(vectorstore, "office hours", 50, {"gender": "Female"})
+        self.assertEqual({doc.metadata['student_id'] for doc in filtered},
+                         set(df[df.gender == "Female"].student_id))
+
+class TestThemeClusters(unittest.TestCase):
+    """Test cases for precomputed review theme clusters"""
+
+    @classmethod
+    def setUpClass(cls):
+        data_path = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'data')
+        cls.vectorstore, _, cls.df = setup_rag(
+            data_path, embeddings=DeterministicFakeEmbedding(size=16), llm=MagicMock()
+        )
+
+    def test_clusters_cover_every_review(self):
+        """Test that cluster and per-group sizes account for the whole cohort"""
+        themes = self.vectorstore.theme_clusters
+        self.assertEqual(themes["review_count"], len(self.df))
+        self.assertEqual(sum(c["size"] for c in themes["clusters"]), len(self.df))
+        international = (self.df.international_student == "Yes").sum()
+        self.assertEqual(themes["groups"]["international_student"]["Yes"], international)
+        self.assertEqual(
+            sum(c["groups"]["international_student"].get("Yes", 0) for c in themes["clusters"]),
+            international
+        )
+        for cluster in themes["clusters"]:
+            self.assertTrue(cluster["snippets"])
+
+    def test_theme_question_routing(self):
+        """Test which questions and filters the precomputed clusters can answer"""
+        self.assertTrue(is_theme_question("What common challenges do international students mention?"))
+        self.assertTrue(is_theme_question("What common themes appear in student feedback?"))
+        self.assertFalse(is_theme_question("How do study hours relate to exam scores?"))
+
+        self.assertEqual(theme_question_group("What themes do international students raise?"),
+                         ('international_student', 'Yes'))
+        self.assertEqual(theme_question_group("What themes appear?", {"gender": "Female"}),
+                         ('gender', 'Female'))
+        self.assertIsNone(theme_question_group("What themes appear in the feedback?"))
+        self.assertFalse(theme_question_group("What themes appear?", {"final_exam": {"$gt": 80}}))
+        self.assertFalse(theme_question_group("Themes for international female students?"))
+
+    def test_theme_question_uses_one_llm_call(self):
+        """Test that theme questions are answered from the clusters without retrieval"""
+        mock_llm = MagicMock()
+        mock_llm.invoke.return_value = MagicMock(content="Themes summary")
+        with patch('ragpsy.retrieve_documents') as mock_retrieve:
+            response = query_rag(
+                self.vectorstore, mock_llm,
+                "What common themes appear in international student feedback?",
+                {"international_student": "Yes"}
+            )
+
+        self.assertEqual(response, "Themes summary")
+        mock_retrieve.assert_not_called()
+        self.assertEqual(mock_llm.invoke.call_count, 1)
+        prompt = mock_llm.invoke.call_args[0][0]
+        international = (self.df.international_student == "Yes").sum()
+        self.assertIn(f"international_student = Yes: {international} of {len(self.df)}", prompt)
+
+class TestSharding(unittest.TestCase):
+    """Test cases for saved shards, the shard LRU and cross-shard search"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp_dir = tempfile.mkdtemp()
+        data_path = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'data')
+        quant = pd.read_csv(os.path.join(data_path, 'psych101-quantitative.csv'))
+        qual = pd.read_csv(os.path.join(data_path, 'psych101-qualitative.csv'))
+
+        # Split the sample data into two terms of one course
+        cls.data_root = os.path.join(cls.tmp_dir, 'data')
+        for term, rows in (('F23', slice(0, 12)), ('F24', slice(12, None))):
+            term_dir = os.path.join(cls.data_root, 'PSY101', term)
+            os.makedirs(term_dir)
+            quant.iloc[rows].to_csv(os.path.join(term_dir, 'psych101-quantitative.csv'), index=False)
+            qual.iloc[rows].to_csv(os.path.join(term_dir, 'psych101-qualitative.csv'), index=False)
+
+        cls.embeddings = DeterministicFakeEmbedding(size=16)
+        cls.shards_root = os.path.join(cls.tmp_dir, 'shards')
+        cls.built = build_shards(cls.data_root, cls.shards_root, cls.embeddings)
+        cls.full_store, _, _ = setup_rag(data_path, embeddings=cls.embeddings, llm=MagicMock())
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.tmp_dir, ignore_errors=True)
+
+    def test_saved_shard_round_trip(self):
+        """Test that a loaded shard returns the same documents as the one that was saved"""
+        vectorstore, _ = build_index(os.path.join(self.data_root, 'PSY101', 'F24'), self.embeddings)
+        loaded = load_vectorstore(os.path.join(self.shards_root, 'PSY101', 'F24'), self.embeddings)
+
+        self.assertEqual(loaded.index.ntotal, vectorstore.index.ntotal)
+        for filter_metadata in (None, {"gender": "Female"}):
+            expected = retrieve_documents(vectorstore, "group work", 4, filter_metadata)
+            actual = retrieve_documents(loaded, "group work", 4, filter_metadata)
+            self.assertEqual([(d.page_content, d.metadata) for d in actual],
+                             [(d.page_content, d.metadata) for d in expected])
+        self.assertEqual(loaded.theme_clusters, vectorstore.theme_clusters)
+
+    def test_fan_out_matches_single_index(self):
+        """Test that merged cross-shard results equal a search over one combined index"""
+        self.assertEqual(self.built["built"], ['PSY101/F23', 'PSY101/F24'])
+        registry = ShardRegistry(self.shards_root, self.embeddings)
+        docs = retrieve_documents(registry.view(), "study habits", 5, {"gender": "Female"})
+        expected = retrieve_documents(self.full_store, "study habits", 5, {"gender": "Female"})
+
+        self.assertEqual([d.page_content for d in docs], [d.page_content for d in expected])
+        self.assertTrue({d.metadata["shard"] for d in docs} <= set(self.built["built"]))
+
+    def test_inner_product_scores_agree_with_and_without_diversify(self):
+        """Test that shard results report inner-product similarities whether or not MMR ran"""
+        import faiss
+
+        registry = ShardRegistry(self.shards_root, self.embeddings)
+        for name in registry.names():
+            store = registry.get(name)
+            index = faiss.IndexFlatIP(store.index.d)
+            index.add(store.index.reconstruct_n(0, store.index.ntotal))
+            store.index = index
+        view = registry.view()
+
+        with patch.dict(RETRIEVAL_SETTINGS, {"diversify": False}):
+            plain = view.search("study habits", 1000)
+        self.assertEqual([score for _, score in plain], sorted((score for _, score in plain), reverse=True))
+        similarity = {(doc.metadata["shard"], doc.page_content): score for doc, score in plain}
+
+        with patch.dict(RETRIEVAL_SETTINGS, {"diversify": True}):
+            diverse = view.search("study habits", 5)
+        self.assertEqual(len(diverse), 5)
+        for doc, score in diverse:
+            self.assertAlmostEqual(score, similarity[(doc.metadata["shard"], doc.page_content)], places=4)
+
+    def test_exhaustive_iteration_ranks_across_shards(self):
+        """Test that paging through every match over shards equals paging over one combined index"""
+        registry = ShardRegistry(self.shards_root, self.embeddings)
+        pages = list(iter_matching_students(registry.view(), "study habits", {"gender": "Female"}, page_size=4))
+        expected = list(iter_matching_students(self.full_store, "study habits", {"gender": "Female"}, page_size=4))
+
+        self.assertEqual([[d.metadata["student_id"] for d in page] for page in pages],
+                         [[d.metadata["student_id"] for d in page] for page in expected])
+        self.assertTrue({d.metadata["shard"] for page in pages for d in page} <= set(self.built["built"]))
+
+    def test_exhaustive_pages_load_each_shard_once(self):
+        """Test that a page interleaving shards loads each shard once even when only one fits in RAM"""
+        registry = ShardRegistry(self.shards_root, self.embeddings, max_bytes=1)
+        expected = list(iter_matching_students(self.full_store, "study habits", None, page_size=8))
+        with patch.object(registry, '_load', wraps=registry._load) as load:
+            pages = list(iter_matching_students(registry.view(), "study habits", None, page_size=8))
+
+        self.assertEqual([[d.metadata["student_id"] for d in page] for page in pages],
+                         [[d.metadata["student_id"] for d in page] for page in expected])
+        # One load per shard for ranking, then at most one per shard and page
+        self.assertLessEqual(load.call_count, 2 + 2 * len(pages))
+
+    def test_lru_respects_ram_cap(self):
+        """Test that shards load lazily and cold shards are evicted over the RAM cap"""
+        registry = ShardRegistry(self.shards_root, self.embeddings, max_bytes=1)
+        self.assertEqual(registry.loaded(), [])
+
+        query_rag(registry.view(['PSY101/F23']), MagicMock(), "How do students study?")
+        self.assertEqual(registry.loaded(), ['PSY101/F23'])
+
+        registry.get('PSY101/F24')
+        self.assertEqual(registry.loaded(), ['PSY101/F24'])
+
+        registry.max_bytes = 10 ** 9
+        registry.get('PSY101/F23')
+        registry.get('PSY101/F24')
+        self.assertEqual(registry.loaded(), ['PSY101/F23', 'PSY101/F24'])
+        with self.assertRaises(KeyError):
+            registry.get('PSY999/F24')
+
+class TestParallelIngest(unittest.TestCase):
+    """Test cases for partitioned, resumable shard ingest"""
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.data_root = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'data')
+        self.embeddings = DeterministicFakeEmbedding(size=16)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+    def test_process_pool_matches_single_build(self):
+        """Test that partitions built by worker processes merge into the same index"""
+        shards_root = os.path.join(self.tmp_dir, 'shards')
+        progress = []
+        report = build_shards(self.data_root, shards_root, self.embeddings, workers=2, partition_size=10,
+                              progress=lambda done, total, shard, part: progress.append((done, total)))
+
+        self.assertEqual(report["built"], ["default"])
+        self.assertEqual(progress[-1], (3, 3))
+        self.assertFalse(os.path.exists(os.path.join(shards_root, '.partitions', 'default')))
+
+        merged = load_vectorstore(os.path.join(shards_root, 'default'), self.embeddings)
+        single, _ = build_index(self.data_root, self.embeddings)
+        self.assertEqual(merged.index.ntotal, single.index.ntotal)
+        self.assertEqual(merged.metadata_columns.num_rows, 25)
+        for filter_metadata in (None, {"gender": "Female", "final_exam": {"$gt": 85}}):
+            self.assertEqual(
+                [d.page_content for d in retrieve_documents(merged, "exam stress", 5, filter_metadata)],
+                [d.page_content for d in retrieve_documents(single, "exam stress", 5, filter_metadata)]
+            )
+        self.assertEqual(merged.dataset_statistics, single.dataset_statistics)
+
+    def test_failed_partition_is_isolated_and_resumed(self):
+        """Test that a failing partition does not stop the others and a rerun builds only it"""
+        import ragpsy
+
+        shards_root = os.path.join(self.tmp_dir, 'shards')
+        real_ingest = ragpsy._ingest_partition
+
+        def flaky(task):
+            if task["part"] == 1:
+                raise RuntimeError("embedding service down")
+            return real_ingest(task)
+
+        with patch('ragpsy._ingest_partition', side_effect=flaky) as first_run:
+            report = build_shards(self.data_root, shards_root, self.embeddings, workers=1, partition_size=10)
+        self.assertEqual(first_run.call_count, 3)
+        self.assertIn("default", report["failed"])
+        self.assertFalse(os.path.exists(os.path.join(shards_root, 'default')))
+
+        with patch('ragpsy._ingest_partition', side_effect=real_ingest) as second_run:
+            report = build_shards(self.data_root, shards_root, self.embeddings, workers=1, partition_size=10)
+        self.assertEqual([call.args[0]["part"] for call in second_run.call_args_list], [1])
+        self.assertEqual(report["built"], ["default"])
+
+        report = build_shards(self.data_root, shards_root, self.embeddings, workers=1, partition_size=10)
+        self.assertEqual(report["skipped"], ["default"])
+
+class TestBatchMode(unittest.TestCase):
+    """Test cases for non-interactive batch questions"""
+
+    def test_read_batch_questions(self):
+        """Test parsing of JSONL question records, including invalid lines"""
+        lines = [
+            '{"question": "How do students study?"}\n',
+            '\n',
+            '{"id": "q2", "question": "What do women say?", "filter": {"gender": "Female"}}\n',
+            '{"question": "Bad filter", "filter": "Female"}\n',
+            'not json\n'
+        ]
+        records = list(read_batch_questions(lines))
+
+        self.assertEqual(records[0], {"id": 1, "question": "How do students study?", "filter": None})
+        self.assertEqual(records[1]["id"], "q2")
+        self.assertEqual(records[1]["filter"], {"gender": "Female"})
+        self.assertIn("line 4", records[2]["error"])
+        self.assertIn("line 5", records[3]["error"])
+
+    def test_run_batch_streams_results_with_bounded_concurrency(self):
+        """Test that every question gets one JSON line and at most `workers` run at once"""
+        mock_vectorstore = MagicMock()
+        mock_vectorstore.similarity_search.return_value = [MagicMock(page_content="Test content")]
+        active, peak, lock = [0], [0], threading.Lock()
+
+        def slow_invoke(prompt):
+            with lock:
+                active[0] += 1
+                peak[0] = max(peak[0], active[0])
+            time.sleep(0.02)
+            with lock:
+                active[0] -= 1
+            return MagicMock(content="Answer", usage_metadata={"input_tokens": 10, "output_tokens": 3})
+
+        mock_llm = MagicMock()
+        mock_llm.invoke.side_effect = slow_invoke
+        records = [{"id": i, "question": f"How do students in group {i} study?", "filter": None}
+                   for i in range(12)]
+        records.append({"id": 99, "error": "Invalid question on line 13"})
+
+        output = io.StringIO()
+        with patch.dict(LLM_CALL_SETTINGS, {"stream": False}):
+            summary = run_batch(mock_vectorstore, mock_llm, iter(records), output, workers=3)
+
+        results = [json.loads(line) for line in output.getvalue().splitlines()]
+        self.assertEqual(len(results), 13)
+        self.assertEqual(sorted(r["id"] for r in results), list(range(12)) + [99])
+        self.assertLessEqual(peak[0], 3)
+        ok = [r for r in results if r["status"] == "ok"]
+        self.assertEqual(len(ok), 12)
+        self.assertEqual(ok[0]["answer"], "Answer")
+        self.assertEqual(ok[0]["prompt_tokens"], 10)
+        self.assertIn("llm_total", ok[0]["timings_ms"])
+        self.assertEqual(summary["invalid"], 1)
+        self.assertEqual(summary["completion_tokens"], 36)
+
+class TestQuestionEmbeddingCache(unittest.TestCase):
+    """Test cases for cached and precomputed question embeddings"""
+
+    def test_normalized_questions_share_one_embedding(self):
+        """Test that case, whitespace and trailing punctuation do not cause re-embedding"""
+        embeddings = DeterministicFakeEmbedding(size=8)
+        cache = QuestionEmbeddingCache(max_entries=2)
+        with patch.object(DeterministicFakeEmbedding, "embed_query", autospec=True,
+                          side_effect=lambda self, text: [0.5] * 8) as embed_query:
+            first = cache.embed(embeddings, "How do students study?")
+            second = cache.embed(embeddings, "  how do STUDENTS   study ")
+            cache.embed(embeddings, "What do students say?")
+            cache.embed(embeddings, "Which students attend?")
+            cache.embed(embeddings, "How do students study?")
+
+        self.assertEqual(second.tolist(), first.tolist())
+        # The third and fourth questions pushed the first one out of the 2-entry LRU
+        self.assertEqual(embed_query.call_count, 4)
+        self.assertEqual(normalize_question("  How do STUDENTS study?? "), "how do students study")
+
+    def test_cache_persists_per_model(self):
+        """Test that a saved cache is reused by a new process for the same model only"""
+        path = os.path.join(tempfile.mkdtemp(), "cache", "questions.npz")
+        self.addCleanup(shutil.rmtree, os.path.dirname(os.path.dirname(path)), True)
+        cache = QuestionEmbeddingCache(path=path)
+        vector = cache.embed(DeterministicFakeEmbedding(size=8), "How do students study?")
+        self.assertEqual(cache.save(), path)
+
+        reloaded = QuestionEmbeddingCache(path=path)
+        self.assertEqual(reloaded.get(DeterministicFakeEmbedding(size=8), "how do students study").tolist(),
+                         vector.tolist())
+        self.assertIsNone(reloaded.get(DeterministicFakeEmbedding(size=16), "How do students study?"))
+
+    def test_canned_questions_skip_the_embedding_model(self):
+        """Test that setup_rag pre-embeds canned questions so retrieval never calls the model"""
+        data_path = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'data')
+        vectorstore, _, _ = setup_rag(data_path, embeddings=DeterministicFakeEmbedding(size=12), llm=MagicMock())
+        mock_llm = MagicMock()
+        mock_llm.invoke.return_value = MagicMock(content="Answer")
+
+        trace = QueryTrace()
+        with patch.object(DeterministicFakeEmbedding, "embed_query", side_effect=AssertionError("embedded")):
+            response = query_rag(vectorstore, mock_llm, TEST_QUESTIONS[2]["question"], trace=trace)
+
+        self.assertEqual(response, "Answer")
+        self.assertEqual(trace.counters.get("cache.embedding_hit"), 1)
+        self.assertIn(TEST_QUESTIONS[0]["question"], canned_questions())
+
+class TestDatasetCache(unittest.TestCase):
+    """Test cases for the Parquet cache of the merged dataset"""
+
+    def setUp(self):
+        self.data_path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.data_path, True)
+        repo_data = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'data')
+        for name in ('psych101-quantitative.csv', 'psych101-qualitative.csv'):
+            shutil.copy(os.path.join(repo_data, name), self.data_path)
+
+    def test_cached_load_skips_csv_parsing(self):
+        """Test that a second load reads the typed Parquet cache instead of the CSVs"""
+        first = load_data(self.data_path)
+        self.assertEqual(str(first['gender'].dtype), 'category')
+        self.assertLess(first['final_exam'].dtype.itemsize, 8)
+
+        with patch('pandas.read_csv', side_effect=AssertionError("parsed CSV")):
+            second = load_data(self.data_path)
+        pd.testing.assert_frame_equal(second, first)
+
+    def test_changed_csv_invalidates_cache(self):
+        """Test that editing a CSV file rebuilds the cached dataset"""
+        first = load_data(self.data_path)
+        path = os.path.join(self.data_path, 'psych101-qualitative.csv')
+        qual = pd.read_csv(path)
+        qual.loc[0, 'course_review'] = "Rewritten review"
+        qual.to_csv(path, index=False)
+        os.utime(path, ns=(time.time_ns(), time.time_ns() + 1_000_000_000))
+
+        second = load_data(self.data_path)
+        self.assertEqual(len(second), len(first))
+        row = second[second['student_id'] == qual.loc[0, 'student_id']]
+        self.assertEqual(row['course_review'].iloc[0], "Rewritten review")
+
+    def test_column_projection(self):
+        """Test that only the requested columns are returned, cached or not"""
+        columns = ['student_id', 'final_exam']
+        self.assertEqual(list(load_data(self.data_path, columns=columns).columns), columns)
+        self.assertEqual(list(load_data(self.data_path, columns=columns).columns), columns)
+
+    def test_without_pyarrow_reads_csv(self):
+        """Test that a missing pyarrow falls back to parsing the CSV files"""
+        with patch.dict(sys.modules, {'pyarrow': None}):
+            df = load_data(self.data_path)
+        self.assertIsNotNone(df)
+        self.assertFalse(os.path.exists(ragpsy._dataset_cache_path(self.data_path)))
+
+class TestPlotAggregates(unittest.TestCase):
+    """Test cases for the binned, cached aggregates behind the visualization example"""
+
+    def setUp(self):
+        self.data_path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.data_path, True)
+        repo_data = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'data')
+        for name in ('psych101-quantitative.csv', 'psych101-qualitative.csv'):
+            shutil.copy(os.path.join(repo_data, name), self.data_path)
+
+    def test_aggregates_match_row_level_statistics(self):
+        """Test that bin counts and box statistics agree with pandas over the rows"""
+        df = load_data(self.data_path)
+        aggregates = compute_plot_aggregates(df, bins=10, box_bins=4)
+
+        grades = aggregates["grade_distribution"]
+        self.assertEqual(len(grades["edges"]), 11)
+        counts = dict(zip(grades["groups"], grades["counts"].sum(axis=1)))
+        self.assertEqual(counts, df['gender'].value_counts().to_dict())
+
+        study = aggregates["study_hours"]
+        self.assertEqual(int(study["counts"].sum()), len(df))
+        self.assertEqual(len(study["groups"]), study["counts"].shape[0])
+
+        by_type = aggregates["attendance_by_type"]
+        for i, group in enumerate(by_type["groups"]):
+            values = df.loc[df['international_student'] == group, 'attendance_rate'].astype(float)
+            self.assertEqual(by_type["count"][i], len(values))
+            self.assertAlmostEqual(by_type["med"][i], values.median())
+            self.assertAlmostEqual(by_type["q1"][i], values.quantile(0.25))
+            self.assertAlmostEqual(by_type["q3"][i], values.quantile(0.75))
+            self.assertGreaterEqual(by_type["whislo"][i], values.min())
+            self.assertLessEqual(by_type["whishi"][i], values.max())
+        self.assertEqual(int(aggregates["attendance_exam"]["count"].sum()), len(df))
+
+    def test_cached_aggregates_skip_loading(self):
+        """Test that aggregates are reused until the CSV files change"""
+        first = load_plot_aggregates(self.data_path)
+        with patch('ragpsy.load_data', side_effect=AssertionError("loaded data")):
+            second = load_plot_aggregates(self.data_path)
+        np.testing.assert_array_equal(second["study_hours"]["counts"], first["study_hours"]["counts"])
+        self.assertEqual(list(second["grade_distribution"]["groups"]), list(first["grade_distribution"]["groups"]))
+
+        path = os.path.join(self.data_path, 'psych101-quantitative.csv')
+        quant = pd.read_csv(path)
+        pd.concat([quant, quant.head(1).assign(student_id="PSY101_F24_999")]).to_csv(path, index=False)
+        qual_path = os.path.join(self.data_path, 'psych101-qualitative.csv')
+        qual = pd.read_csv(qual_path)
+        pd.concat([qual, qual.head(1).assign(student_id="PSY101_F24_999")]).to_csv(qual_path, index=False)
+        os.utime(path, ns=(time.time_ns(), time.time_ns() + 1_000_000_000))
+
+        self.assertEqual(load_plot_aggregates(self.data_path)["students"], first["students"] + 1)
+
+class TestOnnxEmbeddings(unittest.TestCase):
+    """Test cases for the ONNX embedding backend's batching and pooling"""
+
+    class RecordingSession:
+        """Returns (token id, 1) as each token's hidden state and records the padded batch shapes"""
+        def __init__(self):
+            self.shapes = []
+
+        def get_inputs(self):
+            return [type("Input", (), {"name": name})() for name in ("input_ids", "attention_mask")]
+
+        def run(self, outputs, feeds):
+            ids = feeds["input_ids"]
+            self.shapes.append(ids.shape)
+            return [np.stack([ids, np.ones_like(ids)], axis=2).astype(np.float32)]
+
+    def setUp(self):
+        from tokenizers import Tokenizer
+        from tokenizers.models import WordLevel
+        from tokenizers.pre_tokenizers import Whitespace
+
+        self.model_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.model_dir, True)
+        words = ["[UNK]", "students", "study", "hard", "every", "week", "reviews", "help"]
+        tokenizer = Tokenizer(WordLevel({w: i for i, w in enumerate(words)}, unk_token="[UNK]"))
+        tokenizer.pre_tokenizer = Whitespace()
+        tokenizer.save(os.path.join(self.model_dir, "tokenizer.json"))
+
+    def test_batches_are_padded_to_their_longest_text(self):
+        """Test dynamic padding over length-sorted batches and that results keep input order"""
+        embeddings = OnnxEmbeddings(self.model_dir, batch_size=2)
+        session = self.RecordingSession()
+        embeddings._session = session
+        texts = ["students study hard every week", "help", "reviews help", "students study"]
+
+        vectors = embeddings.embed_documents(texts)
+
+        # "help" and "reviews help" share the first batch, the two longer texts the second
+        self.assertEqual(session.shapes, [(2, 2), (2, 5)])
+        self.assertEqual(vectors.shape, (4, 2))
+        # Every text's pooled vector is normalized, in the order the texts were given
+        np.testing.assert_allclose(np.linalg.norm(vectors, axis=1), 1.0, rtol=1e-5)
+        np.testing.assert_allclose(vectors[3], [1.5, 1.0] / np.hypot(1.5, 1.0), rtol=1e-5)
+        np.testing.assert_allclose(embeddings.embed_query("help"), vectors[1], rtol=1e-6)
+
+    def test_pickled_embeddings_reload_lazily(self):
+        """Test that worker copies drop the session and tokenizer"""
+        import pickle
+
+        embeddings = OnnxEmbeddings(self.model_dir)
+        embeddings._session = self.RecordingSession()
+        copy = pickle.loads(pickle.dumps(embeddings))
+        self.assertIsNone(copy._session)
+        self.assertEqual(copy.model_name, "sentence-transformers/all-MiniLM-L6-v2:onnx")
+
+    def test_backend_selection_errors(self):
+        """Test that the onnx backend needs an export directory and unknown backends are rejected"""
+        with patch.dict("ragpsy.EMBEDDING_SETTINGS", {"onnx_model_dir": None}):
+            with self.assertRaises(ValueError):
+                create_embeddings("onnx")
+        with self.assertRaises(ValueError):
+            create_embeddings("tensorflow")
+
+class TestLiveReload(unittest.TestCase):
+    """Test cases for rebuilding a watched data directory and swapping snapshots"""
+
+    def setUp(self):
+        self.data_path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.data_path, True)
+        repo_data = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'data')
+        for name in ('psych101-quantitative.csv', 'psych101-qualitative.csv'):
+            shutil.copy(os.path.join(repo_data, name), self.data_path)
+        self.quant_path = os.path.join(self.data_path, 'psych101-quantitative.csv')
+        self.qual_path = os.path.join(self.data_path, 'psych101-qualitative.csv')
+        self.live = LiveIndex(self.data_path, DeterministicFakeEmbedding(size=16))
+
+    def _drop_last_student(self):
+        for path in (self.quant_path, self.qual_path):
+            df = pd.read_csv(path)
+            df.iloc[:-1].to_csv(path, index=False)
+            os.utime(path, ns=(time.time_ns(), time.time_ns() + 1_000_000_000))
+
+    def test_changed_csv_is_swapped_in_after_settling(self):
+        """Test that a change is rebuilt on the second poll while the old snapshot stays usable"""
+        old_vectorstore, old_df = self.live.snapshot()
+        self.assertFalse(self.live.poll())
+
+        self._drop_last_student()
+        self.assertFalse(self.live.poll())  # still settling
+        self.assertTrue(self.live.poll())
+
+        self.assertEqual(self.live.generation, 1)
+        self.assertEqual(len(self.live.df), len(old_df) - 1)
+        self.assertIsNot(self.live.vectorstore, old_vectorstore)
+        # A query pinned to the old snapshot can still finish
+        self.assertEqual(len(retrieve_documents(old_vectorstore, "office hours", 3)), 3)
+
+    def test_query_uses_one_snapshot(self):
+        """Test that query_rag pins the snapshot that was current when it started"""
+        mock_llm = MagicMock()
+        old_vectorstore = self.live.vectorstore
+
+        def swap_during_llm_call(prompt):
+            self._drop_last_student()
+            self.live.reload()
+            return MagicMock(content="Answer")
+
+        mock_llm.invoke.side_effect = swap_during_llm_call
+        with patch('ragpsy.retrieve_adaptive', wraps=ragpsy.retrieve_adaptive) as retrieve:
+            self.assertEqual(query_rag(self.live, mock_llm, "What do students say about office hours?"), "Answer")
+        self.assertIs(retrieve.call_args[0][0], old_vectorstore)
+        self.assertIsNot(self.live.vectorstore, old_vectorstore)
+
+    def test_failed_rebuild_keeps_current_snapshot(self):
+        """Test that unreadable data leaves the last good snapshot in place"""
+        snapshot = self.live.snapshot()
+        with open(self.qual_path, 'w') as f:
+            f.write("student_id\nPSY101_F24_001\n")
+        os.utime(self.qual_path, ns=(time.time_ns(), time.time_ns() + 1_000_000_000))
+
+        self.live.poll()
+        self.assertFalse(self.live.poll())
+        self.assertIs(self.live.snapshot(), snapshot)
+        self.assertIsNotNone(self.live.last_error)
+        self.assertFalse(self.live.poll())  # not retried until the files change again
+
+    def test_background_watcher(self):
+        """Test that the watcher thread swaps in changed data on its own"""
+        self.live.interval_s = 0.05
+        self.live.start()
+        self.addCleanup(self.live.stop)
+        self._drop_last_student()
+
+        deadline = time.time() + 30
+        while self.live.generation == 0 and time.time() < deadline:
+            time.sleep(0.05)
+        self.assertEqual(self.live.generation, 1)
+
+class TestBoundedState(unittest.TestCase):
+    """Test cases for state that lives as long as the process"""
+
+    def test_llm_cache_is_bounded(self):
+        """Test that the LLM response cache LangChain uses evicts beyond its size"""
+        from langchain_core.globals import get_llm_cache, set_llm_cache
+        from ragpsy import _enable_llm_cache
+
+        self.addCleanup(set_llm_cache, None)
+        with patch.dict(LLM_CACHE_SETTINGS, {"max_entries": 2}):
+            _enable_llm_cache()
+        cache = get_llm_cache()
+        for i in range(5):
+            cache.update(f"prompt {i}", "llm", [MagicMock()])
+        self.assertIsNone(cache.lookup("prompt 0", "llm"))
+        self.assertIsNotNone(cache.lookup("prompt 4", "llm"))
+
+        with patch.dict(LLM_CACHE_SETTINGS, {"max_entries": 0}):
+            _enable_llm_cache()
+        self.assertIsNone(get_llm_cache())
+
+    def test_streamed_calls_use_llm_cache(self):
+        """Test that streamed chat completions are answered from and written to the response cache"""
+        from langchain_core.globals import set_llm_cache
+        from langchain_core.language_models.fake_chat_models import FakeListChatModel
+        from ragpsy import _enable_llm_cache
+
+        self.addCleanup(set_llm_cache, None)
+        _enable_llm_cache()
+        llm = FakeListChatModel(responses=["first", "second", "third"])
+        traces = [QueryTrace() for _ in range(3)]
+        with patch.dict(LLM_CALL_SETTINGS, {"stream": True}):
+            answers = [ragpsy.invoke_llm(llm, "same prompt", trace=trace).content for trace in traces]
+        self.assertEqual(answers, ["first"] * 3)
+        self.assertEqual(traces[0].counters["cache.llm_response_miss"], 1)
+        self.assertEqual(traces[2].counters["cache.llm_response_hit"], 1)
+
+        # invoke() shares the entries written by streamed calls
+        with patch.dict(LLM_CALL_SETTINGS, {"stream": False}):
+            self.assertEqual(ragpsy.invoke_llm(llm, "same prompt").content, "first")
+
+    def test_llm_registries_release_collected_llms(self):
+        """Test that per-LLM breakers and batchers neither keep the LLM alive nor outlive it"""
+        import gc
+        from langchain_core.language_models.fake import FakeListLLM
+
+        llm = FakeListLLM(responses=["answer"])
+        key = id(llm)
+        ragpsy.get_circuit_breaker(llm)
+        self.assertIsNotNone(ragpsy.enable_llm_batching(llm))
+        ref = weakref.ref(llm)
+
+        del llm
+        gc.collect()
+        self.assertIsNone(ref())
+        self.assertNotIn(key, ragpsy._llm_breakers)
+        self.assertNotIn(key, ragpsy._llm_batchers)
+
+    def test_response_cache_key_matches_invoke(self):
+        """Test that the private LangChain helpers behind _response_cache still build invoke()'s cache key
+
+        If this fails after a langchain-core upgrade, _response_cache must be updated
+        before the pin in requirements.txt is raised.
+        """
+        from langchain_core.caches import InMemoryCache
+        from langchain_core.language_models.fake_chat_models import FakeListChatModel
+
+        cache = InMemoryCache()
+        llm = FakeListChatModel(responses=["cached answer"], cache=cache)
+        llm.invoke("same prompt")
+
+        found, prompt_key, llm_string = ragpsy._response_cache(llm, "same prompt")
+        self.assertIs(found, cache)
+        generations = cache.lookup(prompt_key, llm_string)
+        self.assertIsNotNone(generations, "langchain-core changed how invoke() keys its response cache")
+        self.assertEqual(generations[0].message.content, "cached answer")
+
+    def test_conversation_memory_is_pruned(self):
+        """Test that conversation history stays within its size limit"""
+        memory = EnhancedConversationMemory(max_tokens=1000)
+        for i in range(200):
+            memory.add_interaction(f"How do students study for exam {i}?", "They review notes. " * 5)
+        self.assertLessEqual(sum(len(str(c)) for c in memory.conversations), 1000)
+        self.assertIn("exam 199", memory.conversations[-1]["question"])
+        self.assertEqual(memory.topic_tracking["exam"], 200)
+
+class TestRetrievalTuning(unittest.TestCase):
+    """Test cases for tunable retrieval settings and the autotuner"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.data_path = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'data')
+        cls.df = load_data(cls.data_path)
+
+    def test_hnsw_index_filters_and_merges(self):
+        """Test that an HNSW index serves filtered searches and can be merged"""
+        texts, metadatas = split_student_documents(create_student_documents(self.df))
+        half = len(texts) // 2
+        stores = [
+            build_vectorstore(part_texts, part_metadatas, DeterministicFakeEmbedding(size=16),
+                              index_settings={"index": "hnsw", "hnsw_ef_search": 16})
+            for part_texts, part_metadatas in ((texts[:half], metadatas[:half]), (texts[half:], metadatas[half:]))
+        ]
+        merged = merge_vectorstores(stores)
+        self.assertEqual(type(merged.index).__name__, "IndexHNSWFlat")
+        self.assertEqual(merged.index.ntotal, len(texts))
+
+        docs = retrieve_documents(merged, "study habits", 5, {"international_student": "Yes"})
+        self.assertTrue(docs)
+        self.assertTrue(all(doc.metadata["international_student"] == "Yes" for doc in docs))
+
+    def test_pareto_front_and_selection(self):
+        """Test that dominated configurations are dropped and targets pick the fastest sufficient one"""
+        def result(name, recall, p95_ms, nbytes=100, build_s=1.0):
+            return {"settings": {"name": name}, "recall_at_k": recall, "p95_ms": p95_ms,
+                    "index_bytes": nbytes, "build_s": build_s}
+
+        results = [result("exact", 0.95, 9.0), result("fast", 0.80, 2.0), result("worse", 0.80, 3.0),
+                   result("middle", 0.90, 4.0)]
+        front = pareto_front(results)
+        self.assertEqual([r["settings"]["name"] for r in front], ["exact", "fast", "middle"])
+        self.assertEqual(select_configuration(front, min_recall=0.85)["settings"]["name"], "middle")
+        self.assertEqual(select_configuration(front, min_recall=0.99)["settings"]["name"], "exact")
+        self.assertEqual(select_configuration(front, max_p95_ms=5)["settings"]["name"], "fast")
+
+    def test_tuned_config_is_used_by_setup_rag_and_query_rag(self):
+        """Test that tune_retrieval writes a configuration that setup_rag loads and query_rag follows"""
+        lines = [json.dumps({"question": row.course_review, "relevant": [row.student_id]})
+                 for row in self.df.head(8).itertuples()]
+        questions = read_labeled_questions(lines)
+        output = os.path.join(tempfile.mkdtemp(), "retrieval.json")
+        self.addCleanup(shutil.rmtree, os.path.dirname(output), True)
+        grid = {"chunk_size": [300, 500], "chunk_overlap": [50], "k": [2, 4], "index": ["flat", "hnsw"],
+                "hnsw_ef_search": [16]}
+
+        config = tune_retrieval(self.data_path, questions, DeterministicFakeEmbedding(size=16), grid=grid,
+                                output=output)
+        self.assertEqual(config["measured"], 8)
+        with open(output) as f:
+            settings = json.load(f)["settings"]
+        self.assertEqual(settings["comparative_k"], 2 * settings["k"])
+
+        with patch.dict(RETRIEVAL_SETTINGS), patch.dict(RETRIEVAL_CONFIG_SETTINGS, {"path": output}):
+            vectorstore, _, _ = setup_rag(self.data_path, embeddings=DeterministicFakeEmbedding(size=16),
+                                          llm=MagicMock())
+            self.assertEqual(RETRIEVAL_SETTINGS["k"], settings["k"])
+            self.assertEqual(type(vectorstore.index).__name__,
+                             "IndexHNSWFlat" if settings["index"] == "hnsw" else "IndexFlatL2")
+
+            mock_llm = MagicMock()
+            mock_llm.invoke.return_value = MagicMock(content="Answer")
+            with patch('ragpsy.retrieve_adaptive', wraps=ragpsy.retrieve_adaptive) as retrieve:
+                query_rag(vectorstore, mock_llm, "What do students say about the lectures?")
+            self.assertEqual(retrieve.call_args.kwargs["k"], settings["k"])
+
+class TestExhaustiveRetrieval(unittest.TestCase):
+    """Test cases for paging through every matching student and map-reduce summaries"""
+
+    class ConcurrencyRecordingLLM:
+        """Answers every prompt after a short delay and records how many calls overlap"""
+        def __init__(self):
+            self.lock = threading.Lock()
+            self.active = self.peak = 0
+            self.prompts = []
+
+        def invoke(self, prompt_text):
+            with self.lock:
+                self.active += 1
+                self.peak = max(self.peak, self.active)
+                self.prompts.append(prompt_text)
+            time.sleep(0.01)
+            with self.lock:
+                self.active -= 1
+            return MagicMock(content=f"Summary {len(prompt_text)}")
+
+    @classmethod
+    def setUpClass(cls):
+        cls.data_path = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'data')
+        cls.df = load_data(cls.data_path)
+        cls.vectorstore, _, _ = setup_rag(cls.data_path, embeddings=DeterministicFakeEmbedding(size=16),
+                                          llm=MagicMock())
+        cls.field_store, _, _ = setup_rag(cls.data_path, embeddings=DeterministicFakeEmbedding(size=16),
+                                          llm=MagicMock(), indexing="fields")
+
+    def test_pages_cover_every_match_once_in_rank_order(self):
+        """Test that every matching student is yielded once, closest first, a page at a time"""
+        filter_metadata = {"attendance_rate": {"$gte": 90}}
+        expected = set(self.df.loc[self.df['attendance_rate'] >= 90, 'student_id'])
+
+        pages = list(iter_matching_students(self.vectorstore, "attendance", filter_metadata, page_size=4))
+        docs = [doc for page in pages for doc in page]
+        self.assertTrue(all(len(page) <= 4 for page in pages))
+        self.assertEqual({doc.metadata["student_id"] for doc in docs}, expected)
+        self.assertEqual(len(docs), len(expected))
+        self.assertEqual([doc.metadata["rank"] for doc in docs], list(range(1, len(docs) + 1)))
+        scores = [doc.metadata["score"] for doc in docs]
+        self.assertEqual(scores, sorted(scores))
+
+    def test_first_page_matches_top_k_retrieval(self):
+        """Test that the ranking agrees with the usual top-k search"""
+        filter_metadata = {"international_student": "No"}
+        top = retrieve_documents(self.field_store, "group work", 5, filter_metadata)
+        first = next(iter_matching_students(self.field_store, "group work", filter_metadata, page_size=5))
+        self.assertEqual([doc.metadata["student_id"] for doc in first],
+                         [doc.metadata["student_id"] for doc in top])
+
+    def test_map_reduce_respects_concurrency_limit(self):
+        """Test that pages are summarized under the concurrency limit and reduced to one answer"""
+        llm = self.ConcurrencyRecordingLLM()
+        trace = QueryTrace()
+        with patch.dict(EXHAUSTIVE_SETTINGS, {"reduce_fan_in": 2}):
+            answer = summarize_matching_students(self.vectorstore, llm, "How do they study?",
+                                                 {"gender": ["Female", "Male"]}, page_size=3,
+                                                 max_concurrency=2, trace=trace)
+
+        matched = int(self.df['gender'].isin(["Female", "Male"]).sum())
+        pages = -(-matched // 3)
+        self.assertEqual(trace.counters["matched_students"], matched)
+        self.assertEqual(trace.counters["pages"], pages)
+        self.assertLessEqual(llm.peak, 2)
+        self.assertGreater(trace.counters["llm_calls"], pages)
+        self.assertTrue(answer.startswith("Summary"))
+        self.assertIn(f"all {matched} psychology students", llm.prompts[-1])
+        self.assertEqual(summarize_matching_students(self.vectorstore, llm, "Who?", {"gender": "Unknown"}),
+                         "No students match the filter.")
+
+    def test_query_rag_routes_list_questions(self):
+        """Test that "list all students" questions with a filter go through every match"""
+        trace = QueryTrace()
+        with patch('ragpsy.invoke_llm', side_effect=LLMUnavailableError("down")):
+            answer = query_rag(self.vectorstore, MagicMock(), "List all students with attendance below 90%",
+                               trace=trace)
+
+        self.assertEqual(trace.attributes["route"], "exhaustive")
+        self.assertTrue(trace.attributes["degraded"])
+        for student_id in self.df.loc[self.df['attendance_rate'] < 90, 'student_id']:
+            self.assertIn(student_id, answer)
+
+class TestSessionWorkingSet(unittest.TestCase):
+    """Test cases for follow-up questions answered from a conversation's working set"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.data_path = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'data')
+        cls.vectorstore, _, _ = setup_rag(cls.data_path, embeddings=DeterministicFakeEmbedding(size=16),
+                                          llm=MagicMock())
+
+    def setUp(self):
+        self.llm = MagicMock()
+        self.llm.invoke.return_value = MagicMock(content="Answer")
+        self.memory = EnhancedConversationMemory()
+
+    def ask(self, question, filter_metadata=None):
+        trace = QueryTrace()
+        with patch('ragpsy.answer_from_documents', wraps=ragpsy.answer_from_documents) as answer:
+            query_rag_with_memory(self.vectorstore, self.llm, question, filter_metadata, self.memory, trace=trace)
+        return trace, answer.call_args
+
+    def test_follow_up_reuses_cohort_and_working_set(self):
+        """Test that a follow-up keeps the first turn's filter and searches only its students"""
+        trace, _ = self.ask("How do international students perform in exams?", {"international_student": "Yes"})
+        self.assertFalse(trace.attributes["follow_up"])
+        students = set(self.memory.working_set.rows)
+        self.assertTrue(students)
+
+        with patch('ragpsy.search_with_mask', side_effect=AssertionError("searched the index")):
+            trace, call = self.ask("Do these habits seem effective based on their grades?")
+        self.assertTrue(trace.attributes["follow_up"])
+        self.assertEqual(trace.counters["working_set_misses"], 0)
+        _, question, docs = call.args[:3]
+        self.assertIn("international_student = Yes", question)
+        self.assertTrue(docs)
+        self.assertTrue(all(doc.metadata["international_student"] == "Yes" for doc in docs))
+        rows = self.vectorstore.metadata_columns.row_index
+        self.assertTrue({int(rows[int(doc.id)]) for doc in docs} <= students)
+        self.assertEqual(self.memory.conversations[-1]["metadata"]["filter"], {"international_student": "Yes"})
+
+    def test_feature_memory_sequence_reuses_working_set(self):
+        """Test that the feature-test memory turns, each sent with the same filter, are follow-ups"""
+        case = next(c for c in ragpsy.FEATURE_TEST_CASES if c["name"] == "Memory Integration Test")
+        self.assertIsInstance(getattr(self.vectorstore, "theme_clusters", None), dict)
+        first, *follow_ups = case["questions"]
+        self.ask(first, case["filter"])
+        self.assertTrue(self.memory.working_set)
+
+        for question in follow_ups:
+            with patch('ragpsy.search_with_mask', side_effect=AssertionError("searched the index")), \
+                 patch('ragpsy.query_rag', side_effect=AssertionError("routed to query_rag")):
+                trace, call = self.ask(question, case["filter"])
+            self.assertTrue(trace.attributes["follow_up"])
+            self.assertEqual(trace.counters["working_set_misses"], 0)
+            self.assertIn("Follow-up", call.args[1])
+        self.assertEqual(self.memory.working_set.filter, case["filter"])
+
+    def test_follow_up_fetches_only_missing_students(self):
+        """Test that a follow-up with too few held students only fetches the ones missing"""
+        self.ask("How do domestic students perform in exams?", {"international_student": "No"})
+        working_set = self.memory.working_set
+        while len(working_set) > 1:
+            working_set.rows.popitem(last=False)
+        held = set(working_set.rows)
+
+        trace, call = self.ask("What do they say about the exams?")
+        self.assertTrue(trace.attributes["follow_up"])
+        docs = call.args[2]
+        self.assertTrue(all(doc.metadata["international_student"] == "No" for doc in docs))
+        rows = self.vectorstore.metadata_columns.row_index
+        fetched = {int(rows[int(doc.id)]) for doc in docs} - held
+        # Only the students the working set lacked were searched for
+        self.assertEqual(trace.counters["working_set_misses"],
+                         max(0, RETRIEVAL_SETTINGS["k"] - trace.counters["working_set_students"]))
+        self.assertLessEqual(len(fetched), trace.counters["working_set_misses"])
+
+    def test_question_naming_its_cohort_is_not_a_follow_up(self):
+        """Test that a canned question saying "their" with its own filter replaces the cohort"""
+        self.ask("What do international students say about the course?", {"international_student": "Yes"})
+        canned = next(q for q in ragpsy.TEST_QUESTIONS if q["question"].startswith("How do first-generation"))
+        self.assertIn("their", canned["question"])
+        trace, call = self.ask(canned["question"], canned["filter"])
+        self.assertFalse(trace.attributes["follow_up"])
+        self.assertEqual(self.memory.working_set.filter, {"first_gen_student": "Yes"})
+        _, question, docs = call.args[:3]
+        self.assertNotIn("Follow-up", question)
+        self.assertTrue(all(doc.metadata["first_gen_student"] == "Yes" for doc in docs))
+        self.assertEqual(call.args[4], {"first_gen_student": "Yes"})
+
+        # Without a filter, a demographic word still names a new cohort
+        trace, _ = self.ask("What do male students say about their grades?")
+        self.assertFalse(trace.attributes["follow_up"])
+        self.assertIsNone(self.memory.working_set.filter)
+
+    def test_new_question_replaces_working_set(self):
+        """Test that a standalone question starts a new working set and no memory means plain query_rag"""
+        self.ask("How do international students perform in exams?", {"international_student": "Yes"})
+        self.ask("How do first-generation students feel about group work?", {"first_gen_student": "Yes"})
+        self.assertEqual(self.memory.working_set.filter, {"first_gen_student": "Yes"})
+        self.assertEqual(len(self.memory.conversations), 2)
+
+        with patch('ragpsy.query_rag', return_value="Plain") as plain:
+            self.assertEqual(query_rag_with_memory(self.vectorstore, self.llm, "What do they say?"), "Plain")
+        plain.assert_called_once()
+
+    def test_follow_up_detection_and_filter_description(self):
+        """Test follow-up detection and the cohort description used to rewrite follow-ups"""
+        self.assertTrue(is_follow_up_question("What study habits do they mention?"))
+        self.assertTrue(is_follow_up_question("And the male students?"))
+        self.assertFalse(is_follow_up_question("How do international students perform in exams?"))
+        self.assertEqual(describe_filter({"$and": [{"gender": "Female"}, {"attendance_rate": {"$lt": 80.0}}]}),
+                         "gender = Female and attendance_rate < 80")
+
+class TestDiversification(unittest.TestCase):
+    """Test cases for per-student deduplication and MMR over chunk hits"""
+
+    def test_duplicate_chunks_collapse_to_distinct_students(self):
+        """Test that a student's repeated chunks take one slot and the rest go to other students"""
+        texts = ["alpha", "alpha", "alpha", "beta", "gamma", "delta"]
+        metadatas = [{"student_id": sid, "gender": "Female"} for sid in ["A", "A", "A", "B", "C", "D"]]
+        vectorstore = build_vectorstore(texts, metadatas, DeterministicFakeEmbedding(size=16))
+
+        with patch.dict(RETRIEVAL_SETTINGS, {"diversify": False}):
+            plain = retrieve_documents(vectorstore, "alpha", 3)
+        self.assertEqual([d.metadata["student_id"] for d in plain], ["A", "A", "A"])
+
+        for filter_metadata in (None, {"gender": "Female"}):
+            docs = retrieve_documents(vectorstore, "alpha", 3, filter_metadata)
+            ids = [d.metadata["student_id"] for d in docs]
+            self.assertEqual(ids[0], "A")
+            self.assertEqual(len(set(ids)), 3)
+
+    def test_mmr_prefers_dissimilar_students(self):
+        """Test that a lower lambda trades a near-duplicate for a different student"""
+        import faiss
+
+        vectors = np.array([[1.0, 0.0], [1.0, 0.05], [0.5, 1.0]], dtype=np.float32)
+        index = faiss.IndexFlatL2(2)
+        index.add(vectors)
+        rows = np.array([0, 1, 2], dtype=np.int32)
+        query = np.array([[1.0, 0.2]], dtype=np.float32)
+
+        relevant, _ = select_diverse(index, rows, query, [0, 1, 2], 2, mmr_lambda=1.0)
+        self.assertEqual(relevant.tolist(), [1, 0])
+        diverse, scores = select_diverse(index, rows, query, [0, 1, 2], 2, mmr_lambda=0.3)
+        self.assertEqual(diverse.tolist(), [1, 2])
+        self.assertAlmostEqual(float(scores[1]), float(((vectors[2] - query[0]) ** 2).sum()), places=5)
+
+class TestPromptRegistry(unittest.TestCase):
+    """Test cases for prefix-stable prompt layouts"""
+
+    def test_static_prefix_comes_first(self):
+        """Test that rendered prompts are the shared preamble, the instructions, then the values"""
+        registry = PromptRegistry("Preamble.")
+        registry.register("demo", "Do the task.", "Context: {context}\nQuestion: {question}")
+        self.assertEqual(registry.render("demo", context="ctx", question="why?"),
+                         "Preamble.\n\nDo the task.\n\nContext: ctx\nQuestion: why?")
+        with self.assertRaises(ValueError):
+            registry.render("demo", context="ctx")
+
+    def test_query_shapes_share_prefix(self):
+        """Test that questions with different filters and context send the same static prefix"""
+        mock_vectorstore = MagicMock()
+        mock_llm = MagicMock()
+        mock_llm.invoke.return_value = MagicMock(content="Answer")
+        for question, filter_metadata in [("How do students perform?", None),
+                                          ("What do female students say about exams?", {"gender": "Female"})]:
+            mock_vectorstore.similarity_search.return_value = [MagicMock(page_content=question.upper())]
+            trace = QueryTrace()
+            query_rag(mock_vectorstore, mock_llm, question, filter_metadata, trace=trace)
+            prompt = mock_llm.invoke.call_args[0][0]
+            self.assertTrue(prompt.startswith(PROMPTS.prefix("analysis")))
+            self.assertTrue(prompt[len(PROMPTS.prefix("analysis")):].startswith(
+                f"Students: {ragpsy.describe_filter(filter_metadata)}"))
+            self.assertEqual(trace.attributes["prompt"], "analysis")
+
+        for name in ["comparison", "themes", "summary_map", "summary_reduce", "summary_answer"]:
+            self.assertTrue(PROMPTS.prefix(name).startswith(PROMPTS.preamble))
+
+    def test_prompt_describes_retrieved_students(self):
+        """Test that numeric conditions parsed from the question are named in the prompt's students line"""
+        mock_vectorstore = MagicMock()
+        mock_vectorstore.similarity_search.return_value = [MagicMock(page_content="Record")]
+        mock_llm = MagicMock()
+        mock_llm.invoke.return_value = MagicMock(content="Answer")
+        query_rag(mock_vectorstore, mock_llm, "What do students with attendance below 90% say about the course?",
+                  {"gender": "Female"})
+        prompt = mock_llm.invoke.call_args[0][0]
+        self.assertIn("Students: gender = Female and attendance_rate < 90", prompt)
+
+class TestAdaptiveK(unittest.TestCase):
+    """Test cases for score-gap and population driven result counts"""
+
+    @classmethod
+    def setUpClass(cls):
+        from langchain_core.embeddings import Embeddings
+
+        class FixedEmbeddings(Embeddings):
+            def __init__(self, vectors):
+                self.vectors = vectors
+
+            def embed_documents(self, texts):
+                return [self.vectors[text] for text in texts]
+
+            def embed_query(self, text):
+                return self.vectors[text]
+
+        # Unit vectors at squared L2 distance 0.6 + 0.005 * i from the question: flat, no gap anywhere
+        vectors = {"question": [1.0, 0.0]}
+        texts, metadatas = [], []
+        for i in range(1, 11):
+            cos = 1 - (0.6 + 0.005 * i) / 2
+            texts.append(f"even {i}")
+            vectors[f"even {i}"] = [cos, math.sqrt(1 - cos ** 2)]
+            metadatas.append({"student_id": f"E{i}", "gender": "Female" if i <= 2 else "Male"})
+        # Two students right next to a second question and far from everything else
+        for i, y in enumerate([0.01, 0.02]):
+            texts.append(f"close {i}")
+            vectors[f"close {i}"] = [-math.sqrt(1 - y ** 2), y]
+            metadatas.append({"student_id": f"C{i}", "gender": "Male"})
+        vectors["close question"] = [-1.0, 0.0]
+        cls.vectorstore = build_vectorstore(texts, metadatas, FixedEmbeddings(vectors))
+        cls.FixedEmbeddings = FixedEmbeddings
+
+    def test_score_knee(self):
+        """Test that the first gap well above the mean gap before it ends the results"""
+        self.assertEqual(score_knee([0.1, 0.12, 0.14, 0.9, 0.95]), 3)
+        self.assertIsNone(score_knee([0.1, 0.2, 0.3, 0.4]))
+        self.assertEqual(score_knee([0.1, 0.11, 0.12, 0.9], min_k=3), 3)
+        self.assertIsNone(score_knee([0.1, 0.11, 0.9], min_k=3))
+
+    def test_narrow_question_stops_at_gap(self):
+        """Test that a clear gap after the closest students keeps only them with one search"""
+        trace = QueryTrace()
+        docs = retrieve_adaptive(self.vectorstore, "close question", 3, trace=trace)
+        self.assertEqual([d.metadata["student_id"] for d in docs], ["C0", "C1"])
+        decision = trace.attributes["adaptive_k"]
+        self.assertEqual((decision["reason"], decision["probes"], decision["kept"]), ("score_gap", 1, 2))
+        self.assertEqual(trace.counters["adaptive_k.saved"], 1)
+
+    def test_broad_question_expands_to_max_k(self):
+        """Test that flat scores grow the results up to max_k"""
+        trace = QueryTrace()
+        docs = retrieve_adaptive(self.vectorstore, "question", 3, trace=trace, settings={"max_k": 8})
+        self.assertEqual(len({d.metadata["student_id"] for d in docs}), 8)
+        self.assertEqual(trace.attributes["adaptive_k"]["reason"], "max_k")
+        self.assertEqual(trace.counters["adaptive_k.added"], 5)
+
+        trace = QueryTrace()
+        docs = retrieve_adaptive(self.vectorstore, "question", 3, trace=trace, settings={"flat_spread": 0.01})
+        self.assertEqual((len(docs), trace.attributes["adaptive_k"]["reason"]), (3, "spread"))
+
+    def test_gap_applies_to_distance_order_after_mmr(self):
+        """Test that the kept results are the ones before the gap even when MMR reorders them"""
+        def at(degrees):
+            return [math.cos(math.radians(degrees)), math.sin(math.radians(degrees))]
+
+        # A and B lie just either side of the question, D further out on B's side.
+        # MMR ranks D before B, which is nearly redundant with A.
+        vectors = {"question": at(0), "A": at(10), "B": at(-10.5), "D": at(-20)}
+        metadatas = [{"student_id": name} for name in ["A", "B", "D"]]
+        vectorstore = build_vectorstore(["A", "B", "D"], metadatas, self.FixedEmbeddings(vectors))
+
+        with patch.dict(RETRIEVAL_SETTINGS, {"diversify": True, "mmr_lambda": 0.5}):
+            mmr = ragpsy.search_vectorstore(vectorstore, np.array([vectors["question"]], dtype=np.float32), 3)
+            self.assertEqual([doc.metadata["student_id"] for doc, _ in mmr], ["A", "D", "B"])
+
+            trace = QueryTrace()
+            docs = retrieve_adaptive(vectorstore, "question", 3, trace=trace)
+        self.assertEqual([d.metadata["student_id"] for d in docs], ["A", "B"])
+        self.assertEqual(trace.attributes["adaptive_k"]["reason"], "score_gap")
+
+    def test_small_population_and_disabled(self):
+        """Test that a filter matching fewer students than k stops once they are returned"""
+        trace = QueryTrace()
+        docs = retrieve_adaptive(self.vectorstore, "question", 3, {"gender": "Female"}, trace=trace)
+        self.assertEqual(sorted(d.metadata["student_id"] for d in docs), ["E1", "E2"])
+        self.assertEqual(trace.attributes["adaptive_k"]["population"], 2)
+
+        docs = retrieve_adaptive(self.vectorstore, "question", 3, trace=trace, settings={"enabled": False})
+        self.assertEqual(len(docs), 3)
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file